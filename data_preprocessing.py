@@ -1,5 +1,6 @@
 import pandas as pd
-from ols_client import EBIClient
+from gpt_fhir.annotator import Annotator
+from gpt_fhir.columnar import write_frame
 from fhirclient.models.condition import Condition
 from fhirclient.models.medicationstatement import MedicationStatement
 from fhirclient.models.procedure import Procedure
@@ -9,13 +10,15 @@ diagnosis = pd.read_csv("../data/diagnosis_notes.csv")
 medication = pd.read_csv("../data/medication_notes.csv")
 procedure = pd.read_csv("../data/procedure_notes.csv")
 
-# set up EBI client
-ebi_client = EBIClient()
+# set up annotator
+annotator = Annotator()
 
 
-# get SNOMED annotations for term
-def get_annorations(text):
-    return ebi_client.search(query=text, params={"ontology": "snomed"})
+# get first SNOMED annotation of every term of all corpora in one pass
+def get_annotations(*columns):
+    terms = [term for column in columns for term in column]
+    annotations = iter(annotator.run_many(terms))
+    return [[next(annotations)[0] for _ in column] for column in columns]
 
 
 # create FHIR JSON from diagnosis
@@ -89,31 +92,29 @@ def create_procedure(d, annotation):
 
 # process each row
 def process_condition_row(d):
-    # get first annotation
-    annotation = get_annorations(d["diagnosis"])[0]
-
     # return the created condition
-    return create_condition(d, annotation)
+    return create_condition(d, d["annotation"])
 
 
 # process each row
 def process_medication_row(d):
-    # get first annotation
-    annotation = get_annorations(d["medication"])[0]
-
     # return the created medication
-    return create_medication(d, annotation)
+    return create_medication(d, d["annotation"])
 
 
 # process each row
 def process_procedure_row(d):
-    # get first annotation
-    annotation = get_annorations(d["procedure"])[0]
-
     # return the created procedure
-    return create_procedure(d, annotation)
+    return create_procedure(d, d["annotation"])
 
 
+# annotate all terms, looking up each distinct term once
+(
+    diagnosis["annotation"],
+    medication["annotation"],
+    procedure["annotation"],
+) = get_annotations(diagnosis["diagnosis"], medication["medication"], procedure["procedure"])
+
 # apply the function to each row
 diagnosis["fhir"] = diagnosis.apply(process_condition_row, axis=1)
 medication["fhir"] = medication.apply(process_medication_row, axis=1)
@@ -130,3 +131,7 @@ combined = pd.concat(
 
 # write to file
 combined.to_csv("../data/fhir_notes.csv", index=False)
+
+# write a columnar copy with flattened key columns, notes identified by row number
+combined = combined.reset_index(drop=True)
+write_frame(combined, "../data/fhir_notes.parquet", column="fhir", extra_columns=["note"])
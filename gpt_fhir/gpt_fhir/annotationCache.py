@@ -0,0 +1,160 @@
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from gpt_fhir.snomedIndex import normalize
+
+
+class AnnotationCache:
+    """
+    This class caches SNOMED annotations in front of the annotator.
+    It has an in-process LRU tier and an optional SQLite tier that survives restarts.
+    Entries expire after a TTL, and empty results ("no annotation found") are cached
+    with their own, usually shorter, TTL.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        max_entries=10000,
+        max_disk_entries=1000000,
+        ttl=30 * 24 * 3600,
+        negative_ttl=24 * 3600,
+    ):
+        # copy settings
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        # init in-process tier: key -> (expires, annotations)
+        self.memory = OrderedDict()
+
+        # init counters
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        # the cache is shared by all threads of the process
+        self.lock = threading.Lock()
+
+        # init on-disk tier
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS annotations "
+                "(key TEXT PRIMARY KEY, value TEXT, stored REAL, expires REAL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS annotations_stored ON annotations (stored)"
+            )
+            self.db.commit()
+
+    @staticmethod
+    def key(text, ontology):
+        """build the cache key from the normalized term and the ontology"""
+
+        return f"{ontology}:{normalize(text)}"
+
+    def get(self, text, ontology):
+        """
+        This function returns the cached annotations for a term,
+        or None if the term has to be looked up.
+        """
+
+        key = self.key(text, ontology)
+        now = time.time()
+
+        with self.lock:
+            # check in-process tier
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.memory[key]
+
+            # check on-disk tier
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT value, expires FROM annotations WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    if row[1] > now:
+                        annotations = json.loads(row[0])
+                        self._remember(key, row[1], annotations)
+                        self.disk_hits += 1
+                        return annotations
+                    self.db.execute("DELETE FROM annotations WHERE key = ?", (key,))
+                    self.db.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, text, ontology, annotations):
+        """
+        This function stores the annotations for a term in both tiers.
+        """
+
+        key = self.key(text, ontology)
+        now = time.time()
+        expires = now + (self.ttl if len(annotations) > 0 else self.negative_ttl)
+
+        with self.lock:
+            self._remember(key, expires, annotations)
+
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO annotations VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(annotations), now, expires),
+                )
+
+                # evict the oldest entries once the disk tier is full
+                (size,) = self.db.execute("SELECT COUNT(*) FROM annotations").fetchone()
+                if size > self.max_disk_entries:
+                    self.db.execute(
+                        "DELETE FROM annotations WHERE key IN "
+                        "(SELECT key FROM annotations ORDER BY stored LIMIT ?)",
+                        (size - self.max_disk_entries,),
+                    )
+                self.db.commit()
+
+    def purge(self):
+        """
+        This function drops all expired entries from both tiers.
+        """
+
+        now = time.time()
+
+        with self.lock:
+            for key in [k for k, v in self.memory.items() if v[0] <= now]:
+                del self.memory[key]
+
+            if self.db is not None:
+                self.db.execute("DELETE FROM annotations WHERE expires <= ?", (now,))
+                self.db.commit()
+
+    def stats(self):
+        """
+        This function returns the hit/miss counters.
+        """
+
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "size": len(self.memory),
+        }
+
+    def _remember(self, key, expires, annotations):
+        """put an entry into the in-process tier, evicting the least recently used"""
+
+        self.memory[key] = (expires, annotations)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
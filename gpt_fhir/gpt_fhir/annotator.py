@@ -1,10 +1,168 @@
-from ols_client import EBIClient
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from ols_client import Client, EBIClient
+from gpt_fhir.metrics import metrics
+from gpt_fhir.snomedIndex import SnomedIndex, normalize
 
 
 class Annotator:
-    def __init__(self):
-        self.ebi_client = EBIClient()
+    def __init__(self, cache=None, base_url=None, rows=10):
+        # EBI OLS, or another OLS instance at base_url
+        self.ebi_client = EBIClient() if base_url is None else Client(base_url)
+        self.ontology = "snomed"
+
+        # OLS search results carry the preferred term only, without its semantic tag
+        self.semantic_tags = False
+
+        # candidates returned per term
+        self.rows = rows
+
+        # optional AnnotationCache in front of the OLS lookups
+        self.cache = cache
 
     def run(self, text):
         """get SNOMED annotations for term"""
-        return self.ebi_client.search(query=text, params={"ontology": "snomed"})
+
+        with metrics.span("annotation"):
+            # serve from cache if possible
+            if self.cache is not None:
+                annotations = self.cache.get(text, self.ontology)
+                if annotations is not None:
+                    metrics.count("annotation_cache", result="hit")
+                    return annotations
+                metrics.count("annotation_cache", result="miss")
+
+            # cold miss: ask the terminology service
+            annotations = self.search(text)
+
+            if self.cache is not None:
+                self.cache.set(text, self.ontology, annotations)
+
+            return annotations
+
+    def run_many(self, terms, max_concurrency=8):
+        """get SNOMED annotations for many terms, resolving each distinct term once"""
+
+        # deduplicate normalized terms, keeping the first spelling
+        unique = {}
+        for term in terms:
+            unique.setdefault(normalize(term), term)
+
+        # resolve distinct terms concurrently
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            resolved = dict(zip(unique, executor.map(self.run, unique.values())))
+
+        # fan results back out
+        return [resolved[normalize(term)] for term in terms]
+
+    def search(self, text):
+        """query the EBI OLS service for term"""
+        return self.ebi_client.search(
+            query=text, params={"ontology": self.ontology, "rows": self.rows}
+        )
+
+
+class OfflineAnnotator(Annotator):
+    """
+    Annotator backend that resolves terms against a local SNOMED index
+    (see gpt_fhir.snomedIndex) instead of the EBI OLS service.
+    """
+
+    def __init__(self, index_path, cache=None):
+        self.index = SnomedIndex(index_path)
+        self.ontology = "snomed"
+
+        # the index keeps the semantic tag of every fully specified name
+        self.semantic_tags = True
+        self.cache = cache
+
+    def search(self, text):
+        """look up term in the local index"""
+        return self.index.lookup(text)
+
+
+class BatchingAnnotator(Annotator):
+    """
+    Annotator wrapper that micro-batches lookups from concurrent extractions.
+    Terms requested within window seconds of each other (or until max_terms are waiting)
+    are resolved together with one run_many of the wrapped annotator, and a term already
+    waiting or being resolved is not looked up again.
+    """
+
+    def __init__(self, annotator, window=0.005, max_terms=64, max_concurrency=8):
+        self.annotator = annotator
+        self.ontology = annotator.ontology
+        self.semantic_tags = getattr(annotator, "semantic_tags", False)
+        self.cache = None
+
+        # copy settings
+        self.window = window
+        self.max_terms = max_terms
+        self.max_concurrency = max_concurrency
+
+        # (term, future) of the terms waiting for the next batch and of the ones being resolved
+        self.lock = threading.Lock()
+        self.waiting = {}
+        self.resolving = {}
+        self.full = threading.Event()
+        self.collecting = False
+
+    def run(self, text):
+        """get SNOMED annotations for term, in the next batch"""
+        return self.run_many([text])[0]
+
+    def run_many(self, terms, max_concurrency=None):
+        """get SNOMED annotations for many terms, in the next batch"""
+
+        # join the futures of terms already requested, or add the terms to the next batch
+        futures = {}
+        with self.lock:
+            for term in terms:
+                key = normalize(term)
+                if key in futures:
+                    continue
+                waiting = self.waiting.get(key) or self.resolving.get(key)
+                if waiting is None:
+                    waiting = self.waiting[key] = (term, Future())
+                futures[key] = waiting[1]
+            if len(self.waiting) >= self.max_terms:
+                self.full.set()
+
+            # the first request of a batch collects it
+            collect = bool(self.waiting) and not self.collecting
+            if collect:
+                self.collecting = True
+
+        if collect:
+            self.collect()
+
+        return [futures[normalize(term)].result() for term in terms]
+
+    def collect(self):
+        """wait for the window to close, then resolve the batch"""
+
+        self.full.wait(self.window)
+        with self.lock:
+            batch = self.waiting
+            self.waiting = {}
+            self.resolving.update(batch)
+            self.full.clear()
+            self.collecting = False
+
+        metrics.count("annotation_batches")
+        metrics.count("annotation_batch_terms", len(batch))
+        try:
+            # resolve the distinct terms of all waiting requests at once
+            resolved = self.annotator.run_many(
+                [term for term, _ in batch.values()], self.max_concurrency
+            )
+            for (_, future), annotations in zip(batch.values(), resolved):
+                future.set_result(annotations)
+        except Exception as e:
+            for _, future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            with self.lock:
+                for key in batch:
+                    self.resolving.pop(key, None)
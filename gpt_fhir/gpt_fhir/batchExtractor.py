@@ -0,0 +1,180 @@
+import json
+import time
+import logging
+from openai.types.chat import ChatCompletion
+from gpt_fhir.llmExtractor import ExtractionResult
+from gpt_fhir.extractionContext import ExtractionContext
+
+# batch states after which polling stops
+TERMINAL_STATES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchExtractor:
+    """
+    This class runs the FHIR resource extraction for many notes through the OpenAI Batch API.
+    It is meant for backfills that do not need interactive latency:
+    requests are serialized to a JSONL file, submitted as one batch, and the tool calls
+    of the downloaded results are replayed through FHIRTools to build resources per note.
+    """
+
+    def __init__(self, llm_extractor, poll_interval=60):
+        # copy over the extractor, its config, tools and OpenAI client
+        self.llm_extractor = llm_extractor
+        self.config = llm_extractor.config
+        self.fhir_tools = llm_extractor.fhir_tools
+        self.client = llm_extractor.client
+
+        # seconds between batch status checks
+        self.poll_interval = poll_interval
+
+    def write_input(self, notes, path):
+        """
+        This function serializes notes into a batch input file.
+        Notes are given as a {note_id: text} dict or a list of texts (ids are list positions).
+        """
+
+        if not isinstance(notes, dict):
+            notes = dict(enumerate(notes))
+
+        with open(path, "w") as f:
+            for note_id, text in notes.items():
+                request = {
+                    "custom_id": str(note_id),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": self.config["OPENAI"]["MODEL"],
+                        "messages": self.llm_extractor.messages(text),
+                        "tools": self.llm_extractor.tools_for(text),
+                        "tool_choice": "auto",
+                    },
+                }
+                f.write(json.dumps(request) + "\n")
+
+        return len(notes)
+
+    def submit(self, path):
+        """
+        This function uploads a batch input file and starts the batch.
+        The returned batch id is all that is needed to resume later.
+        """
+
+        with open(path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        logging.info(f"BATCH: submitted {batch.id}")
+
+        return batch.id
+
+    def wait(self, batch_id):
+        """
+        This function polls a batch until it reaches a terminal state.
+        """
+
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in TERMINAL_STATES:
+                logging.info(f"BATCH: {batch_id} {batch.status}")
+                return batch
+            time.sleep(self.poll_interval)
+
+    def download(self, batch):
+        """
+        This function downloads the results of a finished batch.
+        Failed requests from the error file are returned alongside the successful ones,
+        so replay gives them their error. A batch without any result file (failed,
+        or cancelled or expired before running a request) raises a RuntimeError.
+        """
+
+        if not (batch.output_file_id or batch.error_file_id):
+            errors = [error.message for error in (batch.errors.data or [])] if batch.errors else []
+            raise RuntimeError(
+                f"batch {batch.id} ended {batch.status} without results"
+                + (f": {'; '.join(errors)}" if errors else "")
+            )
+
+        results = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                content = self.client.files.content(file_id).text
+                results.extend(json.loads(line) for line in content.splitlines() if line)
+
+        return results
+
+    def replay(self, results):
+        """
+        This function replays the tool calls of downloaded results through FHIRTools.
+        All terms of the batch are annotated in one pass before the resources are built.
+        Returns a {note_id: ExtractionResult} dict; a failed note gets an exception instead.
+        """
+
+        # parse completions, keeping failures per note
+        completions = {}
+        extractions = {}
+        for line in results:
+            note_id = line["custom_id"]
+            response = line.get("response") or {}
+            if line.get("error") or response.get("status_code") != 200:
+                extractions[note_id] = RuntimeError(
+                    f"batch request failed: {line.get('error') or response.get('body')}"
+                )
+            else:
+                completions[note_id] = ChatCompletion.model_validate(response["body"])
+
+        # annotate the terms of all notes at once into a shared context
+        annotations = ExtractionContext()
+        tool_calls = {
+            note_id: completion.choices[0].message.tool_calls or []
+            for note_id, completion in completions.items()
+        }
+        self.fhir_tools.prefetch(
+            [tool_call for calls in tool_calls.values() for tool_call in calls],
+            annotations,
+        )
+
+        # build resources per note
+        for note_id, completion in completions.items():
+            result = ExtractionResult()
+            result.add_usage(completion)
+            context = ExtractionContext(note_id, annotations.annotations)
+            try:
+                function_responses = self.fhir_tools.run_all(tool_calls[note_id], context)
+            except Exception as e:
+                logging.exception(f"replay of note {note_id} failed")
+                extractions[note_id] = e
+                continue
+            for tool_call, function_response in zip(tool_calls[note_id], function_responses):
+                self.llm_extractor.tool_message(result, tool_call, function_response)
+            result.resources = context.resources
+            extractions[note_id] = result
+
+            # hand the resources of the note to the FHIR sinks
+            self.fhir_tools.fhir.publish(result.resources, note_id)
+
+        return extractions
+
+    def extract(self, notes=None, path="batch_input.jsonl", batch_id=None):
+        """
+        This function runs a whole backfill: serialize, submit, wait, download and replay.
+        Pass the batch_id of an earlier run to resume it without resubmitting the notes.
+        """
+
+        if batch_id is None:
+            self.write_input(notes, path)
+            batch_id = self.submit(path)
+
+        batch = self.wait(batch_id)
+        extractions = self.replay(self.download(batch))
+
+        # notes the batch returned nothing for
+        if notes is not None:
+            note_ids = notes if isinstance(notes, dict) else range(len(notes))
+            for note_id in map(str, note_ids):
+                extractions.setdefault(note_id, RuntimeError(f"batch {batch_id} has no result"))
+
+        return extractions
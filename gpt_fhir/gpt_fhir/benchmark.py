@@ -0,0 +1,151 @@
+import csv
+import copy
+import time
+import asyncio
+import itertools
+import resource
+import platform
+import threading
+from collections import defaultdict
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.annotator import Annotator
+from gpt_fhir.metrics import MetricsHook, metrics
+from gpt_fhir.fhirTools import FHIRTools
+from gpt_fhir.llmExtractor import LLMExtractor
+from gpt_fhir.mockServers import MockServers, parse_trace
+
+
+def read_corpus(path, size=None, text_column="note"):
+    """
+    This function reads the notes of a CSV corpus, repeated up to size notes.
+    """
+
+    with open(path, newline="", encoding="utf-8") as f:
+        notes = [row[text_column] for row in csv.DictReader(f)]
+
+    if size is None:
+        return notes
+    return list(itertools.islice(itertools.cycle(notes), size))
+
+
+def percentile(samples, q):
+    """nearest-rank percentile of sorted samples"""
+
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, max(0, round(q / 100 * len(samples)) - 1))]
+
+
+def summarize(samples):
+    """count, mean and percentiles of latency samples (in seconds)"""
+
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "mean": sum(samples) / len(samples) if samples else 0.0,
+        "p50": percentile(samples, 50),
+        "p95": percentile(samples, 95),
+        "p99": percentile(samples, 99),
+    }
+
+
+class StageTimer(MetricsHook):
+    """
+    This class collects the latencies of the instrumented stages of an extraction.
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def on_span(self, name, seconds, labels):
+        # first and follow-up completions are separate stages
+        stage = "follow_up" if labels.get("stage") == "follow_up" else name
+        with self.lock:
+            self.samples[stage].append(seconds)
+
+    def report(self):
+        return {stage: summarize(samples) for stage, samples in sorted(self.samples.items())}
+
+
+def run_benchmark(config, notes, trace_path, concurrency=8, latency_scale=1.0, seed=0):
+    """
+    This function replays notes through LLMExtractor/FHIRTools/FHIR against local
+    OpenAI and OLS stand-ins answering from a recorded trace, and reports throughput,
+    latency percentiles per stage and peak memory.
+    """
+
+    trace = parse_trace(trace_path)
+    with MockServers(trace, latency_scale=latency_scale, seed=seed, process=True) as servers:
+        # point the extractor at the stand-ins; responses are never served from a cache
+        config = copy.deepcopy(config)
+        config["OPENAI"]["API_KEY"] = "mock"
+        config["OPENAI"]["BASE_URL"] = servers.openai_url
+        config["GENAI"].pop("RESPONSE_CACHE", None)
+
+        # set up the extraction stack
+        annotator = Annotator(base_url=servers.ols_url)
+        fhir = FHIR(annotator, config)
+        fhir_tools = FHIRTools(config, fhir)
+        llm_extractor = LLMExtractor(config, fhir_tools)
+
+        # time the stages through the instrumentation
+        timer = StageTimer()
+        enabled = metrics.enabled
+        metrics.add_hook(timer)
+        metrics.enable(exporter=False)
+
+        # replay the corpus
+        try:
+            start = time.perf_counter()
+            results = asyncio.run(llm_extractor.extract_many(notes, max_concurrency=concurrency))
+            elapsed = time.perf_counter() - start
+        finally:
+            metrics.remove_hook(timer)
+            if not enabled:
+                metrics.disable()
+
+    # peak resident memory of the benchmark process (without the servers)
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() != "Darwin":
+        peak_memory *= 1024
+
+    completed = [result for result in results if not isinstance(result, Exception)]
+    return {
+        "notes": len(notes),
+        "failed": len(notes) - len(completed),
+        "concurrency": concurrency,
+        "latency_scale": latency_scale,
+        "seconds": elapsed,
+        "throughput": len(completed) / elapsed if elapsed else 0.0,
+        "stages": timer.report(),
+        "resources": sum(len(result.resources) for result in completed),
+        "prompt_tokens": sum(result.usage["prompt_tokens"] for result in completed),
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def compare(baseline, report, tolerance=0.1):
+    """
+    This function lists regressions of a benchmark report against a baseline report:
+    throughput lower, or stage p95 latency or peak memory higher, by more than tolerance.
+    """
+
+    regressions = []
+    if report["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(
+            f"throughput {report['throughput']:.2f} < {baseline['throughput']:.2f} notes/s"
+        )
+
+    for stage, stats in report["stages"].items():
+        if stage in baseline["stages"]:
+            p95 = baseline["stages"][stage]["p95"]
+            if stats["p95"] > p95 * (1 + tolerance):
+                regressions.append(f"{stage} p95 {stats['p95']:.6f}s > {p95:.6f}s")
+
+    if report["peak_memory_bytes"] > baseline["peak_memory_bytes"] * (1 + tolerance):
+        regressions.append(
+            f"peak memory {report['peak_memory_bytes']} > {baseline['peak_memory_bytes']} bytes"
+        )
+
+    return regressions
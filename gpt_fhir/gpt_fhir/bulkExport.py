@@ -0,0 +1,262 @@
+import os
+import re
+import zlib
+import gzip
+import json
+import datetime
+import itertools
+import threading
+
+# file name of a part of the NDJSON file of a resource type, ".tmp" while it is written
+PART = re.compile(r"^([A-Za-z]+)\.(\d+)\.ndjson\.gz(\.tmp)?$")
+
+# file of the resource counts of all parts at the last checkpoint
+CHECKPOINT = "checkpoint.json"
+
+
+def complete_lines(path):
+    """
+    This function streams the complete NDJSON lines of a gzip file,
+    stopping where a crashed writer left it truncated.
+    """
+
+    try:
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                # only the last line can be cut off
+                if line.endswith(b"\n"):
+                    yield line
+    except (EOFError, zlib.error, gzip.BadGzipFile):
+        return
+
+
+class BulkExporter:
+    """
+    This class streams resources into FHIR Bulk Data NDJSON files, as read by $import.
+    Every resource type gets its own gzip-compressed NDJSON files, rotated once a file
+    holds max_bytes of uncompressed NDJSON, and a manifest lists all files on close.
+    Resources are written as they come, so memory does not grow with the export.
+    Parts are written under a temporary name and renamed once complete.
+    With checkpoints, the resource count of every part is recorded whenever the notes
+    written so far are completed, and a resumed export drops the resources written after
+    the last checkpoint, as the notes they belong to are extracted again.
+    It is a FHIR sink: register it with fhir.add_sink(exporter).
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_bytes=256 * 1024 * 1024,
+        compresslevel=6,
+        base_url=None,
+        checkpoints=False,
+    ):
+        # copy settings
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+        self.checkpoints = checkpoints
+
+        # files are listed in the manifest under base_url, or as local paths
+        self.base_url = base_url.rstrip("/") if base_url else None
+
+        # open file, size and part number per resource type
+        self.files = {}
+        self.parts = {}
+
+        # resource counts of the completed parts by file name
+        self.counts = {}
+
+        # completed files as manifest outputs
+        self.outputs = []
+
+        self.transaction_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.resume()
+
+        # resources of a run crashing before its first checkpoint are dropped as well
+        if checkpoints:
+            with self.lock:
+                self.write_checkpoint()
+
+    def resume(self):
+        """
+        This function lists the files of an earlier run in the export directory,
+        so a resumed extraction adds new parts instead of overwriting them.
+        Parts a crashed run left unfinished are completed with their complete lines,
+        or cut to the resources they held at the last checkpoint.
+        """
+
+        # resource counts of the parts at the last checkpoint of an earlier run
+        checkpointed = None
+        if self.checkpoints and os.path.exists(os.path.join(self.directory, CHECKPOINT)):
+            with open(os.path.join(self.directory, CHECKPOINT)) as f:
+                checkpointed = json.load(f)["parts"]
+
+        for name in sorted(os.listdir(self.directory)):
+            match = PART.match(name)
+            if match is None:
+                continue
+            resource_type, part = match.group(1), int(match.group(2))
+            self.parts[resource_type] = max(part, self.parts.get(resource_type, 0))
+
+            # count resources without loading the file
+            path = os.path.join(self.directory, name)
+            limit = None
+            if checkpointed is not None:
+                limit = checkpointed.get(name[: -len(".tmp")] if match.group(3) else name, 0)
+            count = sum(1 for _ in complete_lines(path)) if not match.group(3) else None
+            if match.group(3) or (limit is not None and count > limit):
+                path, count = self.recover(path, limit)
+                name = os.path.basename(path)
+            if count == 0:
+                continue
+            self.counts[name] = count
+            self.outputs.append(
+                {
+                    "type": resource_type,
+                    "url": f"{self.base_url}/{name}" if self.base_url else path,
+                    "count": count,
+                }
+            )
+
+    def recover(self, source, limit=None):
+        """
+        This function turns an unfinished or overlong part into a complete one holding
+        its complete lines, or its first limit lines, returning the path and resource
+        count of the part.
+        """
+
+        path = source[: -len(".tmp")] if source.endswith(".tmp") else source
+        recovering = path + ".recovering"
+        count = 0
+        with gzip.open(recovering, "wb", compresslevel=self.compresslevel) as f:
+            for line in itertools.islice(complete_lines(source), limit):
+                f.write(line)
+                count += 1
+
+        if count:
+            os.replace(recovering, path)
+        else:
+            os.remove(recovering)
+        if source != path or not count:
+            os.remove(source)
+
+        return path, count
+
+    def path(self, resource_type, part):
+        """path of a part of the NDJSON file of a resource type"""
+        return os.path.join(self.directory, f"{resource_type}.{part:03d}.ndjson.gz")
+
+    def add(self, resource, note_id=None):
+        """
+        This function appends a resource to the file of its type.
+        """
+
+        line = (json.dumps(resource, separators=(",", ":")) + "\n").encode("utf-8")
+        resource_type = resource["resourceType"]
+
+        with self.lock:
+            # rotate a full file
+            current = self.files.get(resource_type)
+            if current is not None and current["bytes"] + len(line) > self.max_bytes:
+                self.finish(resource_type)
+                current = None
+
+            # start a new part
+            if current is None:
+                part = self.parts.get(resource_type, 0) + 1
+                self.parts[resource_type] = part
+                path = self.path(resource_type, part)
+                current = {
+                    "file": gzip.open(path + ".tmp", "wb", compresslevel=self.compresslevel),
+                    "path": path,
+                    "bytes": 0,
+                    "count": 0,
+                }
+                self.files[resource_type] = current
+
+            current["file"].write(line)
+            current["bytes"] += len(line)
+            current["count"] += 1
+
+    def finish(self, resource_type):
+        """close the open file of a resource type and list it in the manifest"""
+
+        current = self.files.pop(resource_type)
+        current["file"].close()
+        os.replace(current["path"] + ".tmp", current["path"])
+
+        name = os.path.basename(current["path"])
+        self.counts[name] = current["count"]
+        self.outputs.append(
+            {
+                "type": resource_type,
+                "url": f"{self.base_url}/{name}" if self.base_url else current["path"],
+                "count": current["count"],
+            }
+        )
+
+    def flush(self):
+        """
+        This function flushes the open files to disk,
+        so their lines so far survive a crash.
+        """
+
+        with self.lock:
+            for current in self.files.values():
+                current["file"].flush()
+
+    def checkpoint(self):
+        """
+        This function records the resource count of every part, once the notes of the
+        resources written so far are completed. A resumed export keeps only these.
+        """
+
+        with self.lock:
+            for current in self.files.values():
+                current["file"].flush()
+            self.write_checkpoint()
+
+    def write_checkpoint(self):
+        """write the resource counts of the completed and open parts, replacing the last ones"""
+
+        parts = dict(self.counts)
+        for current in self.files.values():
+            parts[os.path.basename(current["path"])] = current["count"]
+
+        path = os.path.join(self.directory, CHECKPOINT)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"parts": parts}, f)
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        """
+        This function closes all files and writes the manifest.
+        """
+
+        with self.lock:
+            for resource_type in list(self.files):
+                self.finish(resource_type)
+            if self.checkpoints:
+                self.write_checkpoint()
+
+            manifest = {
+                "transactionTime": self.transaction_time,
+                "request": "$export",
+                "requiresAccessToken": False,
+                "output": sorted(self.outputs, key=lambda output: output["url"]),
+                "error": [],
+            }
+            with open(os.path.join(self.directory, "manifest.json"), "w") as f:
+                json.dump(manifest, f, indent=2)
+
+        return manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,342 @@
+import re
+import math
+import asyncio
+import logging
+from collections import Counter
+from gpt_fhir.metrics import metrics
+from gpt_fhir.reranker import ngrams
+from gpt_fhir.toolRouter import DEFAULT_LEXICON
+from gpt_fhir.snomedIndex import split_semantic_tag
+from gpt_fhir.extractionContext import ExtractionContext
+from gpt_fhir.llmExtractor import ExtractionResult
+
+# words ending a term: conjunctions, prepositions, verbs, doses and frequencies
+STOP = (
+    r"and|or|with|for|since|after|before|but|which|due|in|on|at|to|of|as|per|"
+    r"is|was|were|has|had|mg|mcg|ml|units?|tablets?|daily|twice|once|every|"
+    r"when|while|because"
+)
+
+# a term of one to four words, numbers only inside it ("type 2 diabetes")
+TERM = (
+    r"(?P<term>[A-Za-z][\w-]*(?:\s+(?:\d+\s+)?(?!(?:" + STOP + r")\b)[A-Za-z][\w-]*){0,3})"
+)
+
+# phrases introducing the term of a resource, by tool
+DEFAULT_PATTERNS = {
+    "extract_fhir_condition": [
+        r"diagnosed with",
+        r"diagnosis of",
+        r"suffer(?:s|ing)? from",
+        r"present(?:ed|s)? with",
+        r"complain(?:s|ed|ing)? of",
+    ],
+    "extract_fhir_medication_statement": [
+        r"taking",
+        r"takes",
+        r"prescribed",
+        r"started on",
+        r"been on",
+        r"is on",
+    ],
+    "extract_fhir_procedure": [
+        r"underwent",
+        r"has undergone",
+        r"performed",
+    ],
+}
+
+# parameters of the resources the local tier writes; notes needing others are escalated
+DEFAULT_PARAMETERS = {
+    "extract_fhir_condition": {"clinicalStatus": "active"},
+    "extract_fhir_medication_statement": {"status": "active"},
+    "extract_fhir_procedure": {"status": "completed"},
+}
+
+# cues of notes that need the LLM's reasoning
+ESCALATION_CUES = {
+    "negation": re.compile(
+        r"\b(?:no|not|denie[sd]|deny|without|negative for|ruled? out|free of|never|absence of)\b",
+        re.IGNORECASE,
+    ),
+    "temporal": re.compile(
+        r"\b(?:ago|since|until|history of|years?|months?|weeks?|days?|yesterday|today|"
+        r"last|previous(?:ly)?|prior|former(?:ly)?|recent(?:ly)?|onset|\d{4}|\d+/\d+)\b",
+        re.IGNORECASE,
+    ),
+    "status": re.compile(
+        r"\b(?:stopped|discontinued|resolved|remission|relapse|recurr\w*|used to|"
+        r"planned|scheduled|will|considering|suspected|possible|probable|rule out|"
+        r"family history|mother|father|sibling)\b",
+        re.IGNORECASE,
+    ),
+}
+
+# a term followed by more of an enumeration
+ENUMERATION = re.compile(r"\s*(?:,|and\b|or\b|&|/)", re.IGNORECASE)
+
+# a term followed by the reason it is taken or done, usually a condition of its own
+REASON = re.compile(
+    r"\s+(?:for|due to|because of|secondary to|to (?:treat|manage|control|prevent))\b",
+    re.IGNORECASE,
+)
+
+# words of a note that are not clinical terms, besides those ending a term
+FILLER = (
+    r"patient|patients|mentioned|mentions|reported|reports|noted|notes|regularly|"
+    r"currently|now|also|still|been|be|is|are|the|an?|his|her|their|he|she|they|who|"
+    r"this|that|has|have|having|came|visited|visit|seen"
+)
+
+# boundaries of the phrases left over once the matched terms are removed
+RESIDUAL = re.compile(r"[^\w\s-]+|\b(?:" + STOP + "|" + FILLER + r")\b", re.IGNORECASE)
+
+# articles and possessives before a term
+ARTICLE = re.compile(r"(?:an?|the|his|her|their)\s+", re.IGNORECASE)
+
+
+def similarity(term, label, n=3):
+    """cosine similarity of the character n-gram counts of a term and a label"""
+
+    a, b = Counter(ngrams(term, n)), Counter(ngrams(label, n))
+    dot = sum(count * b[gram] for gram, count in a.items())
+    norm = math.sqrt(sum(v * v for v in a.values()) * sum(v * v for v in b.values()))
+
+    return dot / norm if norm else 0.0
+
+
+class Cascade:
+    """
+    This class extracts notes local first, calling the LLM only where it is needed.
+    A local matcher finds the terms a note introduces with cue phrases ("diagnosed with",
+    "taking", "underwent"), resolves them with the annotator and writes the resources
+    through the FHIR builders. Notes are escalated to the LLM extractor when the local
+    match is not confident, when it misses part of the note (a cue without a term,
+    a reason clause after a term, or a leftover phrase SNOMED knows), or when the note
+    needs negation, temporal or status reasoning. The tier of every note is counted.
+    """
+
+    def __init__(self, llm_extractor, config=None):
+        # copy the LLM extractor and its FHIR writers
+        self.llm_extractor = llm_extractor
+        self.fhir = llm_extractor.fhir_tools.fhir
+
+        # copy settings
+        cascade = (config or {}).get("GENAI", {}).get("CASCADE", {})
+        self.min_similarity = cascade.get("MIN_SIMILARITY", 0.85)
+        self.max_chars = cascade.get("MAX_CHARS", 300)
+
+        # compile one term pattern per tool, for the tools the FHIR builders know
+        patterns = {**DEFAULT_PATTERNS, **cascade.get("PATTERNS", {})}
+        self.patterns = {
+            tool_name: re.compile(
+                r"\b(?:" + "|".join(cues) + r")\s+(?:" + ARTICLE.pattern + r")?" + TERM,
+                re.IGNORECASE,
+            )
+            for tool_name, cues in patterns.items()
+            if tool_name in self.fhir.builders
+        }
+        self.parameters = {**DEFAULT_PARAMETERS, **cascade.get("PARAMETERS", {})}
+
+        # cues of every tool, to notice resources the matcher missed
+        self.lexicon = {
+            tool_name: re.compile(r"\b(?:" + "|".join(cues) + ")", re.IGNORECASE)
+            for tool_name, cues in DEFAULT_LEXICON.items()
+            if tool_name in self.fhir.builders
+        }
+
+        # notes handled by each tier, and reasons of escalations
+        self.tiers = Counter()
+        self.reasons = Counter()
+
+    def match(self, text):
+        """
+        This function returns the (tool name, term) pairs the cue phrases introduce,
+        or the reason the note cannot be extracted locally.
+        """
+
+        if len(text) > self.max_chars:
+            return [], "length"
+
+        # reasoning the local tier cannot do
+        for reason, cue in ESCALATION_CUES.items():
+            if cue.search(text):
+                return [], reason
+
+        matches = []
+        for tool_name, pattern in self.patterns.items():
+            for match in pattern.finditer(text):
+                # lists of terms are left to the LLM
+                if ENUMERATION.match(text, match.end()):
+                    return [], "enumeration"
+
+                # so are reasons ("taking Omeprazole for acid reflux")
+                if REASON.match(text, match.end()):
+                    return [], "reason"
+                matches.append((tool_name, match.group("term")))
+        if not matches:
+            return [], "no_match"
+
+        # a tool cue without a matched term means a resource would be missed
+        matched_tools = {tool_name for tool_name, _ in matches}
+        for tool_name, lexicon in self.lexicon.items():
+            if tool_name not in matched_tools and lexicon.search(text):
+                return [], "uncovered"
+
+        return matches, None
+
+    def residual(self, text):
+        """
+        This function returns the phrases of a note left over once the matched cue phrases
+        and terms are removed, split at punctuation and at words that are not terms.
+        """
+
+        for pattern in self.patterns.values():
+            text = pattern.sub(".", text)
+
+        phrases = [phrase.strip() for phrase in RESIDUAL.split(text)]
+        return [phrase for phrase in phrases if re.search(r"[A-Za-z]{4}", phrase)]
+
+    def confident(self, term, tool_name, annotations):
+        """whether the first annotation of a term is a confident match for its resource"""
+
+        if not annotations:
+            return False
+
+        label, tag = split_semantic_tag(annotations[0].get("label", ""))
+        tag = annotations[0].get("semantic_tag") or tag
+        semantic_tags = self.fhir.semantic_tags(tool_name)
+        if tag is not None and semantic_tags and tag not in semantic_tags:
+            return False
+
+        return similarity(term, label) >= self.min_similarity
+
+    def extract_local(self, text, context):
+        """
+        This function extracts a note with the local matcher.
+        Returns the result, or None and the reason if the note has to be escalated.
+        """
+
+        matches, reason = self.match(text)
+        if reason is not None:
+            return None, reason
+
+        # resolve all terms and leftover phrases in one pass,
+        # then check every match before writing any
+        residual = self.residual(text)
+        self.fhir.prefetch(
+            [term for _, term in matches] + residual,
+            context,
+            [tool_name for tool_name, _ in matches] + [None] * len(residual),
+        )
+        for tool_name, term in matches:
+            if not self.confident(term, tool_name, self.fhir.annotate(term, context, tool_name)):
+                return None, "low_confidence"
+
+        # a leftover phrase confidently coded for any resource is a resource the match misses
+        for phrase in residual:
+            annotations = self.fhir.annotate(phrase, context)
+            if any(self.confident(phrase, tool_name, annotations) for tool_name in self.patterns):
+                return None, "residual"
+
+        # write the resources through the FHIR builders
+        result = ExtractionResult(tier="local")
+        for tool_name, term in matches:
+            builder = self.fhir.builders[tool_name]
+            params = {builder.code_parameter: term, **self.parameters.get(tool_name, {})}
+            output = self.fhir.write(tool_name, params, context)
+            result.tool_calls.append({"name": tool_name, "arguments": params, "output": output})
+        result.resources = context.resources
+
+        return result, None
+
+    def count(self, tier, reason=None):
+        """count the tier (and the escalation reason) of a note"""
+
+        self.tiers[tier] += 1
+        if reason is not None:
+            self.reasons[reason] += 1
+        metrics.count("cascade_notes", tier=tier)
+
+    def extract(self, text, context=None):
+        """
+        This function extracts a note locally if possible, with the LLM otherwise.
+        """
+
+        if context is None:
+            context = ExtractionContext()
+
+        # nothing is written to the context unless the whole note is extracted locally
+        result, reason = self.extract_local(text, context)
+        if result is None:
+            self.count("llm", reason)
+            return self.llm_extractor.extract(text, context)
+
+        self.fhir.publish(result.resources, context.note_id)
+        self.count("local")
+
+        return result
+
+    async def extract_many(self, notes, max_concurrency=8, note_ids=None):
+        """
+        This function extracts many notes, the local tier first and the escalated notes
+        with LLMExtractor.extract_many (packed, if configured).
+        Results are returned in input order; a note that failed gets its exception instead.
+        """
+
+        notes = list(notes)
+        note_ids = list(range(len(notes))) if note_ids is None else list(note_ids)
+        results = [None] * len(notes)
+
+        # local tier, in worker threads as the annotator blocks
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        def extract_local(i):
+            try:
+                return self.extract_local(notes[i], ExtractionContext(note_ids[i]))
+            except Exception:
+                logging.exception(f"local extraction of note {note_ids[i]} failed")
+                return None, "error"
+
+        async def run_local(i):
+            async with semaphore:
+                return await asyncio.to_thread(extract_local, i)
+
+        local = await asyncio.gather(*(run_local(i) for i in range(len(notes))))
+
+        escalated = []
+        for i, (result, reason) in enumerate(local):
+            if result is None:
+                escalated.append(i)
+                self.count("llm", reason)
+            else:
+                results[i] = result
+                await self.fhir.apublish(result.resources, note_ids[i])
+                self.count("local")
+
+        # LLM tier
+        llm_results = await self.llm_extractor.extract_many(
+            [notes[i] for i in escalated],
+            max_concurrency=max_concurrency,
+            note_ids=[note_ids[i] for i in escalated],
+        )
+        for i, result in zip(escalated, llm_results):
+            results[i] = result
+
+        return results
+
+    def report(self):
+        """
+        This function returns the number and fraction of notes handled by each tier,
+        and the reasons notes were escalated to the LLM.
+        """
+
+        notes = sum(self.tiers.values())
+        return {
+            "notes": notes,
+            "tiers": {
+                tier: {"notes": count, "fraction": count / notes if notes else 0.0}
+                for tier, count in sorted(self.tiers.items())
+            },
+            "escalations": dict(self.reasons.most_common()),
+        }
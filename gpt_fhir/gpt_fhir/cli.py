@@ -0,0 +1,553 @@
+import os
+import csv
+import json
+import asyncio
+import logging
+import argparse
+import itertools
+import yaml
+import pandas as pd
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.cascade import Cascade
+from gpt_fhir.fhirTools import FHIRTools
+from gpt_fhir.server import ExtractionServer, result_record
+from gpt_fhir.metrics import metrics
+from gpt_fhir.bulkExport import BulkExporter
+from gpt_fhir.columnar import (
+    ColumnarDatasetWriter,
+    is_columnar,
+    iter_rows,
+    parse_resources,
+    write_frame,
+)
+from gpt_fhir.evaluation import Evaluator, read_results
+from gpt_fhir.llmExtractor import LLMExtractor
+from gpt_fhir.snomedIndex import build_index
+from gpt_fhir.toolRouter import measure_tokens, measure_latency
+from gpt_fhir.benchmark import read_corpus, run_benchmark, compare
+from gpt_fhir.mockServers import MockServers, parse_trace
+from gpt_fhir.annotationCache import AnnotationCache
+from gpt_fhir.annotator import Annotator, OfflineAnnotator
+
+
+def read_notes(path, id_column, text_column):
+    """
+    This function streams (note id, text) pairs from a CSV, JSONL, Parquet or Arrow file,
+    or a Parquet dataset directory. Notes without an id column are identified by their row number.
+    """
+
+    # columnar files are read a record batch at a time
+    if is_columnar(path):
+        for i, row in enumerate(iter_rows(path)):
+            yield str(row.get(id_column, i)), row[text_column]
+        return
+
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".ndjson")):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+
+        for i, row in enumerate(rows):
+            yield str(row.get(id_column, i)), row[text_column]
+
+
+def read_checkpoint(path):
+    """
+    This function returns the ids of notes completed by an earlier run.
+    """
+
+    if not os.path.exists(path):
+        return set()
+
+    with open(path, encoding="utf-8") as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+
+def read_completed(path):
+    """
+    This function returns the ids of notes with a result in an NDJSON output file,
+    which covers notes written just before a crash but not checkpointed.
+    A line torn by the crash is cut off, so new results start on a line of their own.
+    """
+
+    if not os.path.exists(path):
+        return set()
+
+    completed = set()
+    end = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if "error" not in record:
+                completed.add(str(record["note_id"]))
+            end += len(line)
+
+    # drop a torn last line
+    if end < os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(end)
+
+    return completed
+
+
+def build_extractor(config, args):
+    """
+    This function sets up the annotator, FHIR, FHIR tools and LLM extractor graph.
+    """
+
+    # set up annotator
+    cache = AnnotationCache(args.annotation_cache) if args.annotation_cache else None
+    if args.snomed_index:
+        annotator = OfflineAnnotator(args.snomed_index, cache=cache)
+    else:
+        annotator = Annotator(cache=cache, base_url=args.ols_url)
+
+    # set up FHIR client, tools and llm chat
+    fhir = FHIR(annotator, config)
+    fhir_tools = FHIRTools(config, fhir)
+    return LLMExtractor(config, fhir_tools)
+
+
+async def extract(args):
+    """
+    This function runs the extraction over an input file chunk by chunk,
+    appending NDJSON results and checkpointing completed note ids as it goes.
+    """
+
+    # load the config file
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+
+    llm_extractor = build_extractor(config, args)
+
+    # per-stage timers and counters, turned on once for the process
+    if args.metrics_file or config.get("METRICS", {}).get("ENABLED", False):
+        metrics.enable()
+
+    # optionally extract notes with the local matcher first, escalating the rest to the LLM
+    extractor = llm_extractor
+    if config["GENAI"].get("CASCADE", {}).get("ENABLED", False):
+        extractor = Cascade(llm_extractor, config)
+
+    # stream resources into Bulk Data NDJSON files as they are extracted
+    if args.bulk_export:
+        llm_extractor.fhir_tools.fhir.add_sink(BulkExporter(args.bulk_export, checkpoints=True))
+
+    # write resources into a Parquet dataset in row groups as they are extracted;
+    # a resumed run adds its own part files
+    if args.columnar:
+        llm_extractor.fhir_tools.fhir.add_sink(ColumnarDatasetWriter(args.columnar))
+
+    # skip notes completed by an earlier run
+    checkpoint_path = args.checkpoint or f"{args.output}.done"
+    errors_path = args.errors or f"{args.output}.errors"
+    done = read_checkpoint(checkpoint_path) | read_completed(args.output)
+    notes = (
+        (note_id, text)
+        for note_id, text in read_notes(args.input, args.id_column, args.text_column)
+        if note_id not in done
+    )
+
+    processed = failed = 0
+    with open(args.output, "a", encoding="utf-8") as output, open(
+        checkpoint_path, "a", encoding="utf-8"
+    ) as checkpoint, open(errors_path, "a", encoding="utf-8") as errors:
+        while True:
+            # take the next chunk, so memory does not grow with the input
+            chunk = list(itertools.islice(notes, args.chunk_size))
+            if not chunk:
+                break
+
+            results = await extractor.extract_many(
+                [text for _, text in chunk],
+                max_concurrency=args.concurrency,
+                note_ids=[note_id for note_id, _ in chunk],
+            )
+
+            # the resources of the chunk reach the sinks before its notes are completed
+            await asyncio.to_thread(llm_extractor.fhir_tools.fhir.flush)
+
+            # write results before checkpointing, so no note is ever lost;
+            # failed notes go to the errors file and are retried by the next run,
+            # so the output holds one record per note
+            completed = []
+            for (note_id, _), result in zip(chunk, results):
+                if isinstance(result, Exception):
+                    errors.write(json.dumps(result_record(note_id, result)) + "\n")
+                    failed += 1
+                else:
+                    output.write(json.dumps(result_record(note_id, result)) + "\n")
+                    completed.append(note_id)
+            output.flush()
+            errors.flush()
+
+            # the notes written to the output are completed, so are their resources;
+            # a resumed export drops the resources of notes that are extracted again
+            llm_extractor.fhir_tools.fhir.checkpoint()
+            checkpoint.write("".join(f"{note_id}\n" for note_id in completed))
+            checkpoint.flush()
+
+            processed += len(chunk)
+            logging.info(f"EXTRACT: {processed} notes processed, {failed} failed")
+
+    # send the resources still queued in the FHIR sinks
+    llm_extractor.fhir_tools.fhir.close()
+
+    print(f"processed {processed} notes ({failed} failed), skipped {len(done)} completed notes")
+    if llm_extractor.rate_limiter is not None:
+        print(json.dumps({"rate_limit": llm_extractor.rate_limiter.stats()}))
+    if extractor is not llm_extractor:
+        print(json.dumps(extractor.report(), indent=2))
+
+    # export the stage timers and counters of the run
+    if args.metrics_file:
+        with open(args.metrics_file, "w") as f:
+            f.write(metrics.render())
+
+
+async def route_report(args):
+    """
+    This function reports the prompt tokens saved by tool routing and compact schemas,
+    the resources routing would withhold from earlier results extracted with all tools,
+    and optionally the latency and resources of a sample of notes with and without routing.
+    """
+
+    # load the config file
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+
+    llm_extractor = build_extractor(config, args)
+    note_ids, notes = [], []
+    for note_id, text in read_notes(args.input, args.id_column, args.text_column):
+        note_ids.append(note_id)
+        notes.append(text)
+
+    # resources of every note extracted with all tools, if given
+    results = None
+    if args.results:
+        extracted = read_results(args.results, args.results_column, args.id_column)
+        if isinstance(extracted, pd.DataFrame):
+            extracted = extracted.groupby(extracted["note_id"].astype(str))["resource"].agg(
+                lambda resources: [json.loads(resource) for resource in resources]
+            )
+        extracted.index = extracted.index.astype(str)
+        results = [parse_resources(extracted.get(note_id)) for note_id in note_ids]
+
+    report = {"notes": len(notes), "tokens": measure_tokens(llm_extractor, notes, results)}
+    if args.sample:
+        report["latency"] = await measure_latency(
+            llm_extractor, notes[: args.sample], max_concurrency=args.concurrency
+        )
+
+    print(json.dumps(report, indent=2))
+
+
+def serve(args):
+    """
+    This function serves the extraction over HTTP until interrupted,
+    optionally against local OpenAI and OLS stand-ins replaying a trace.
+    """
+
+    # load the config file
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+
+    # point the extraction stack at the stand-ins
+    servers = None
+    if args.mock_trace:
+        servers = MockServers(
+            parse_trace(args.mock_trace), latency_scale=args.latency_scale
+        ).start()
+        config["OPENAI"]["API_KEY"] = "mock"
+        config["OPENAI"]["BASE_URL"] = servers.openai_url
+        args.ols_url = servers.ols_url
+
+    try:
+        ExtractionServer(build_extractor(config, args), config).run(args.host, args.port)
+    finally:
+        if servers is not None:
+            servers.stop()
+
+
+def benchmark(args):
+    """
+    This function runs the offline benchmark, saves its report and
+    returns the regressions against a baseline report, if one is given.
+    """
+
+    # load the config file
+    with open(args.config, "r") as f:
+        config = yaml.safe_load(f)
+
+    notes = read_corpus(args.notes, args.size)
+    report = run_benchmark(
+        config,
+        notes,
+        args.trace,
+        concurrency=args.concurrency,
+        latency_scale=args.latency_scale,
+    )
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+    if not args.compare:
+        return []
+    with open(args.compare) as f:
+        regressions = compare(json.load(f), report, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+
+    return regressions
+
+
+def columnar(args):
+    """
+    This function converts a resource column of a CSV corpus into a columnar file.
+    """
+
+    frame = pd.read_csv(args.input)
+    written = write_frame(
+        frame,
+        args.output,
+        column=args.column,
+        id_column=args.id_column,
+        extra_columns=args.keep,
+        row_group_size=args.row_group_size,
+    )
+    print(f"wrote {written} resources of {len(frame)} notes to {args.output}")
+
+
+def evaluate(args):
+    """
+    This function scores extracted resources against the ground truth of a corpus.
+    """
+
+    evaluator = Evaluator(fuzzy=args.fuzzy, threshold=args.threshold, attributes=args.attributes)
+    report = evaluator.evaluate(
+        read_results(args.truth, args.truth_column, args.id_column),
+        read_results(args.extracted, args.column, args.id_column),
+    )
+
+    print(report["scores"].round(3).to_string())
+    print()
+    print(report["attributes"].round(3).to_string())
+    print(f"\n{report['fuzzy_matches']} resources matched on their display")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "scores": report["scores"].to_dict(orient="index"),
+                    "attributes": [
+                        {"resource_type": resource_type, "attribute": attribute, **values}
+                        for (resource_type, attribute), values in report["attributes"]
+                        .to_dict(orient="index")
+                        .items()
+                    ],
+                    "fuzzy_matches": report["fuzzy_matches"],
+                },
+                f,
+                indent=2,
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="gpt-fhir", description="GPT-FHIR")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # extraction of FHIR resources from a file of notes
+    extract_parser = subparsers.add_parser(
+        "extract", help="extract FHIR resources from a CSV or JSONL file of notes"
+    )
+    extract_parser.add_argument("input", help="CSV or JSONL file of notes")
+    extract_parser.add_argument("output", help="NDJSON file results are appended to")
+    extract_parser.add_argument("--config", default="config.yaml", help="config file")
+    extract_parser.add_argument(
+        "--checkpoint", help="file of completed note ids (default: OUTPUT.done)"
+    )
+    extract_parser.add_argument(
+        "--errors", help="NDJSON file of failed notes' errors (default: OUTPUT.errors)"
+    )
+    extract_parser.add_argument("--id-column", default="id", help="note id column")
+    extract_parser.add_argument("--text-column", default="note", help="note text column")
+    extract_parser.add_argument(
+        "--chunk-size", type=int, default=100, help="notes read and checkpointed at once"
+    )
+    extract_parser.add_argument(
+        "--concurrency", type=int, default=8, help="notes extracted in parallel"
+    )
+    extract_parser.add_argument("--annotation-cache", help="SQLite annotation cache file")
+    extract_parser.add_argument("--snomed-index", help="offline SNOMED index file")
+    extract_parser.add_argument("--ols-url", help="OLS instance to annotate with (default: EBI)")
+    extract_parser.add_argument("--log-file", help="write logs to this file")
+    extract_parser.add_argument(
+        "--metrics-file", help="write Prometheus-format stage metrics to this file"
+    )
+    extract_parser.add_argument(
+        "--bulk-export", help="directory of FHIR Bulk Data NDJSON files to write"
+    )
+    extract_parser.add_argument(
+        "--columnar", help="Parquet dataset directory of flattened resources to write"
+    )
+
+    # tool routing report
+    route_parser = subparsers.add_parser(
+        "route-report", help="measure prompt tokens and latency saved by tool routing"
+    )
+    route_parser.add_argument("input", help="CSV or JSONL file of notes")
+    route_parser.add_argument("--config", default="config.yaml", help="config file")
+    route_parser.add_argument("--id-column", default="id", help="note id column")
+    route_parser.add_argument("--text-column", default="note", help="note text column")
+    route_parser.add_argument(
+        "--results",
+        help="resources of the notes extracted with all tools (output of extract, CSV or columnar)",
+    )
+    route_parser.add_argument(
+        "--results-column", default="extracted", help="resource column of a CSV results file"
+    )
+    route_parser.add_argument(
+        "--sample", type=int, default=0, help="notes to extract live for the latency report"
+    )
+    route_parser.add_argument(
+        "--concurrency", type=int, default=8, help="notes extracted in parallel"
+    )
+    route_parser.add_argument("--annotation-cache", help="SQLite annotation cache file")
+    route_parser.add_argument("--snomed-index", help="offline SNOMED index file")
+    route_parser.add_argument("--ols-url", help="OLS instance to annotate with (default: EBI)")
+
+    # HTTP extraction service
+    serve_parser = subparsers.add_parser(
+        "serve", help="serve the extraction over HTTP with micro-batching and backpressure"
+    )
+    serve_parser.add_argument("--config", default="config.yaml", help="config file")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    serve_parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    serve_parser.add_argument("--annotation-cache", help="SQLite annotation cache file")
+    serve_parser.add_argument("--snomed-index", help="offline SNOMED index file")
+    serve_parser.add_argument("--ols-url", help="OLS instance to annotate with (default: EBI)")
+    serve_parser.add_argument(
+        "--mock-trace", help="serve against local OpenAI and OLS stand-ins replaying this log"
+    )
+    serve_parser.add_argument(
+        "--latency-scale", type=float, default=1.0, help="factor on the recorded latencies"
+    )
+    serve_parser.add_argument("--log-file", help="write logs to this file")
+
+    # offline benchmark against local OpenAI and OLS stand-ins
+    benchmark_parser = subparsers.add_parser(
+        "benchmark", help="benchmark the extraction against local OpenAI and OLS stand-ins"
+    )
+    benchmark_parser.add_argument("--config", default="config.yaml", help="config file")
+    benchmark_parser.add_argument(
+        "--notes", default="data/fhir_notes.csv", help="CSV corpus with a note column"
+    )
+    benchmark_parser.add_argument(
+        "--trace", default="notebooks/logs.txt", help="log of an extraction run to replay"
+    )
+    benchmark_parser.add_argument("--size", type=int, help="notes to extract (default: corpus)")
+    benchmark_parser.add_argument(
+        "--concurrency", type=int, default=8, help="notes extracted in parallel"
+    )
+    benchmark_parser.add_argument(
+        "--latency-scale", type=float, default=1.0, help="factor on the recorded latencies"
+    )
+    benchmark_parser.add_argument(
+        "--output", default="benchmark.json", help="file the JSON report is written to"
+    )
+    benchmark_parser.add_argument("--compare", help="baseline report to check for regressions")
+    benchmark_parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="relative change counted as a regression"
+    )
+
+    # columnar copy of a corpus
+    columnar_parser = subparsers.add_parser(
+        "columnar", help="convert a resource column of a CSV corpus to Parquet or Arrow"
+    )
+    columnar_parser.add_argument("input", help="CSV corpus, e.g. data/fhir_notes.csv")
+    columnar_parser.add_argument("output", help="Parquet (or .arrow) file to write")
+    columnar_parser.add_argument("--column", default="fhir", help="column of FHIR resources")
+    columnar_parser.add_argument("--id-column", help="note id column (default: row number)")
+    columnar_parser.add_argument(
+        "--keep", nargs="*", default=["note"], help="columns copied next to the resources"
+    )
+    columnar_parser.add_argument(
+        "--row-group-size", type=int, default=10000, help="resources per row group"
+    )
+
+    # scores against the ground truth
+    evaluate_parser = subparsers.add_parser(
+        "evaluate", help="score extracted resources against the ground truth of a corpus"
+    )
+    evaluate_parser.add_argument(
+        "truth", help="CSV corpus, extraction NDJSON or columnar file of expected resources"
+    )
+    evaluate_parser.add_argument(
+        "extracted", help="CSV corpus, extraction NDJSON or columnar file of extracted resources"
+    )
+    evaluate_parser.add_argument(
+        "--truth-column", default="fhir", help="CSV column of expected resources"
+    )
+    evaluate_parser.add_argument(
+        "--column", default="extracted", help="CSV column of extracted resources"
+    )
+    evaluate_parser.add_argument("--id-column", help="CSV note id column (default: row number)")
+    evaluate_parser.add_argument(
+        "--fuzzy", action="store_true", help="match leftover resources on their display"
+    )
+    evaluate_parser.add_argument(
+        "--threshold", type=float, default=0.8, help="display similarity of a fuzzy match"
+    )
+    evaluate_parser.add_argument(
+        "--attributes",
+        nargs="*",
+        default=["status", "onset", "bodySite"],
+        help="attributes checked on matched resources (none if given without values)",
+    )
+    evaluate_parser.add_argument("--output", help="file the JSON report is written to")
+
+    # offline SNOMED index
+    index_parser = subparsers.add_parser(
+        "index", help="build an offline SNOMED index from a terminology file"
+    )
+    index_parser.add_argument("source", help="RF2 description snapshot or conceptId<TAB>term file")
+    index_parser.add_argument("index", help="index file to write")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "extract":
+            logging.basicConfig(
+                filename=args.log_file,
+                format="%(asctime)s %(levelname)s %(message)s",
+                level=logging.INFO,
+            )
+            asyncio.run(extract(args))
+        case "route-report":
+            asyncio.run(route_report(args))
+        case "serve":
+            logging.basicConfig(
+                filename=args.log_file,
+                format="%(asctime)s %(levelname)s %(message)s",
+                level=logging.INFO,
+            )
+            serve(args)
+        case "benchmark":
+            if benchmark(args):
+                raise SystemExit(1)
+        case "columnar":
+            columnar(args)
+        case "evaluate":
+            evaluate(args)
+        case "index":
+            n_concepts, n_terms = build_index(args.source, args.index)
+            print(f"indexed {n_terms} terms of {n_concepts} concepts into {args.index}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+import os
+import ast
+import json
+import math
+import datetime
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from gpt_fhir.resourceBuilder import DEFAULT_RESOURCES
+
+# element holding the SNOMED code of each resource type
+CODE_PATHS = {
+    mapping["resourceType"]: mapping["code"]["path"] for mapping in DEFAULT_RESOURCES.values()
+}
+
+# flattened key columns of a resource, next to its raw JSON
+SCHEMA = pa.schema(
+    [
+        ("note_id", pa.string()),
+        ("resource_type", pa.string()),
+        ("code", pa.string()),
+        ("display", pa.string()),
+        ("text", pa.string()),
+        ("status", pa.string()),
+        ("resource", pa.string()),
+    ]
+)
+
+
+def is_arrow(path):
+    """Arrow IPC files are written for .arrow and .feather paths, Parquet otherwise"""
+    return path.endswith((".arrow", ".feather"))
+
+
+def is_columnar(path):
+    """Parquet and Arrow files, and Parquet dataset directories"""
+    return path.endswith((".parquet", ".arrow", ".feather")) or os.path.isdir(path)
+
+
+def parse_resources(value):
+    """
+    This function returns the resources of a corpus cell as a list of dicts.
+    Cells hold a resource or a list of resources, as objects or as
+    stringified Python dicts (as written by pandas) or JSON.
+    """
+
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return []
+    if isinstance(value, str):
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            value = json.loads(value)
+    if isinstance(value, dict):
+        return [value]
+
+    return list(value)
+
+
+def status(resource):
+    """status element, or the text (or first code) of the clinical status"""
+
+    value = resource.get("status")
+    if value is None and "clinicalStatus" in resource:
+        clinical_status = resource["clinicalStatus"]
+        value = clinical_status.get("text")
+        if value is None and clinical_status.get("coding"):
+            value = clinical_status["coding"][0].get("code")
+
+    return value
+
+
+def key_elements(resource, code_paths=None):
+    """
+    This function returns the resource type, SNOMED code, display, term and status of a resource.
+    """
+
+    resource_type = resource.get("resourceType")
+    code_path = (code_paths or CODE_PATHS).get(resource_type, "code")
+    concept = resource.get(code_path) or {}
+
+    # first SNOMED coding, or the first coding of another system
+    codings = concept.get("coding") or [{}]
+    coding = next(
+        (coding for coding in codings if coding.get("system") == "http://snomed.info/sct"),
+        codings[0],
+    )
+
+    return {
+        "resource_type": resource_type,
+        "code": coding.get("code"),
+        "display": coding.get("display"),
+        "text": concept.get("text"),
+        "status": status(resource),
+    }
+
+
+def flatten(resource, note_id=None, code_paths=None):
+    """
+    This function returns the row of a resource: its key elements and its JSON.
+    """
+
+    return {
+        "note_id": None if note_id is None else str(note_id),
+        **key_elements(resource, code_paths),
+        "resource": json.dumps(resource, separators=(",", ":")),
+    }
+
+
+class ColumnarWriter:
+    """
+    This class writes resources to a Parquet (or Arrow IPC) file with flattened key
+    columns next to the raw resource JSON, one row group per row_group_size resources.
+    Rows are buffered only until their row group is written, so results can be
+    streamed in as notes are extracted. It is a FHIR sink: register it with
+    fhir.add_sink(writer). extra_columns are string columns filled from the
+    keyword arguments of add, e.g. the note text.
+    """
+
+    def __init__(
+        self, path, row_group_size=10000, extra_columns=(), code_paths=None, compression="zstd"
+    ):
+        # copy settings
+        self.path = path
+        self.row_group_size = row_group_size
+        self.code_paths = code_paths
+        self.extra_columns = list(extra_columns)
+        self.compression = compression
+
+        # schema with the extra columns
+        self.schema = SCHEMA
+        for column in self.extra_columns:
+            self.schema = self.schema.append(pa.field(column, pa.string()))
+
+        # rows of the next row group
+        self.rows = []
+        self.lock = threading.Lock()
+        self.written = 0
+
+        # open file writer
+        self.writer = self.open()
+
+    def open(self):
+        """open the file writer"""
+
+        if is_arrow(self.path):
+            return pa.ipc.new_file(self.path, self.schema)
+        return pq.ParquetWriter(self.path, self.schema, compression=self.compression)
+
+    def add(self, resource, note_id=None, **values):
+        """
+        This function appends the row of a resource,
+        writing a row group once row_group_size rows are buffered.
+        """
+
+        row = flatten(resource, note_id, self.code_paths)
+        for column in self.extra_columns:
+            value = values.get(column)
+            row[column] = None if value is None else str(value)
+
+        with self.lock:
+            self.rows.append(row)
+            if len(self.rows) >= self.row_group_size:
+                self.write_rows()
+
+    def write_rows(self):
+        """write the buffered rows as a row group"""
+
+        if not self.rows:
+            return
+        table = pa.Table.from_pylist(self.rows, schema=self.schema)
+        self.write_table(table)
+        self.written += len(self.rows)
+        self.rows = []
+
+    def write_table(self, table):
+        """write a table as a row group"""
+        self.writer.write_table(table)
+
+    def flush(self):
+        """
+        This function writes the buffered rows as a (smaller) row group.
+        """
+
+        with self.lock:
+            self.write_rows()
+
+    def close(self):
+        """
+        This function writes the buffered rows and the file footer.
+        """
+
+        with self.lock:
+            self.write_rows()
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ColumnarDatasetWriter(ColumnarWriter):
+    """
+    This class writes resources to a Parquet dataset directory, which a run only adds
+    files to, so extractions can be resumed into it and a crash loses no written row group.
+    Every run writes its own partition run=<start time>, and every row group is a complete
+    part file, written under a hidden temporary name and renamed once complete.
+    Readers keep the rows of the latest run of every note (see read_resources).
+    """
+
+    def open(self):
+        """start the partition of the run"""
+
+        self.run = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        self.directory = os.path.join(self.path, f"run={self.run}")
+        self.parts = 0
+
+        return None
+
+    def write_table(self, table):
+        """write a table as the next part file of the run"""
+
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"part-{self.parts:05d}.parquet"
+        temp = os.path.join(self.directory, f".{name}.tmp")
+        pq.write_table(table, temp, compression=self.compression)
+        os.replace(temp, os.path.join(self.directory, name))
+        self.parts += 1
+
+    def close(self):
+        """
+        This function writes the buffered rows.
+        """
+
+        with self.lock:
+            self.write_rows()
+
+
+def write_frame(
+    frame, path, column="fhir", id_column=None, extra_columns=(), row_group_size=10000
+):
+    """
+    This function writes the resources of a column of a corpus DataFrame to a columnar file.
+    Notes are identified by id_column, or by their row index if there is none.
+    """
+
+    with ColumnarWriter(path, row_group_size, extra_columns) as writer:
+        for index, row in frame.iterrows():
+            note_id = row[id_column] if id_column else index
+            values = {extra: row[extra] for extra in extra_columns}
+            for resource in parse_resources(row[column]):
+                writer.add(resource, note_id, **values)
+
+    return writer.written
+
+
+def open_dataset(path):
+    """
+    This function opens a dataset directory written by ColumnarDatasetWriter,
+    returning the dataset and the latest run of every note (None if it is empty).
+    """
+
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    if not dataset.files:
+        return None, {}
+
+    runs = dataset.to_table(columns=["note_id", "run"]).to_pandas()
+    return dataset, runs.groupby("note_id")["run"].max().to_dict()
+
+
+def latest(rows, runs):
+    """whether rows belong to the latest run of their note; rows without a note are kept"""
+    return rows["note_id"].isna() | (rows["run"] == rows["note_id"].map(runs))
+
+
+def read_resources(path, columns=None, filters=None):
+    """
+    This function reads the resource rows of a columnar file or dataset directory
+    as a DataFrame. Only the given columns are read, and Parquet row groups are skipped
+    by filters, e.g. filters=[("resource_type", "=", "Condition")]. Of a dataset, only
+    the rows of the latest run of every note are read, so a resumed run replaces the
+    resources an interrupted one wrote for the same note.
+    """
+
+    if os.path.isdir(path):
+        dataset, runs = open_dataset(path)
+        if dataset is None:
+            return pd.DataFrame(columns=columns or SCHEMA.names)
+        names = columns or [name for name in dataset.schema.names if name != "run"]
+        table = dataset.to_table(
+            columns=list(dict.fromkeys([*names, "note_id", "run"])),
+            filter=pq.filters_to_expression(filters) if filters is not None else None,
+        )
+        frame = table.to_pandas()
+        return frame[latest(frame, runs)][names].reset_index(drop=True)
+
+    if is_arrow(path):
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+        if filters is not None:
+            table = table.filter(pq.filters_to_expression(filters))
+        if columns is not None:
+            table = table.select(columns)
+    else:
+        table = pq.read_table(path, columns=columns, filters=filters)
+
+    return table.to_pandas()
+
+
+def iter_rows(path, columns=None, batch_size=1000):
+    """
+    This function streams the rows of a columnar file or dataset directory as dicts,
+    one record batch at a time (of a dataset, those of the latest run of every note).
+    """
+
+    if os.path.isdir(path):
+        dataset, runs = open_dataset(path)
+        if dataset is None:
+            return
+        names = columns or [name for name in dataset.schema.names if name != "run"]
+        for batch in dataset.to_batches(
+            columns=list(dict.fromkeys([*names, "note_id", "run"])), batch_size=batch_size
+        ):
+            rows = batch.to_pandas()
+            yield from rows[latest(rows, runs)][names].to_dict("records")
+        return
+
+    if is_arrow(path):
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if columns is not None:
+                    batch = batch.select(columns)
+                yield from batch.to_pylist()
+    else:
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns):
+            yield from batch.to_pylist()
@@ -0,0 +1,295 @@
+import json
+import numpy as np
+import pandas as pd
+from gpt_fhir.reranker import Reranker
+from gpt_fhir.snomedIndex import normalize
+from gpt_fhir.columnar import is_columnar, key_elements, parse_resources, read_resources, status
+
+
+def text_values(element):
+    """texts of a CodeableConcept or a list of them"""
+
+    elements = element if isinstance(element, list) else [element]
+    texts = []
+    for element in elements:
+        if isinstance(element, dict):
+            coding = (element.get("coding") or [{}])[0]
+            text = element.get("text") or coding.get("display") or coding.get("code")
+            if text:
+                texts.append(str(text))
+    return texts
+
+
+# elements of the onset of a resource and the key of their value, in order of preference
+ONSETS = [
+    (prefix + suffix, key)
+    for prefix in ("onset", "performed", "effective")
+    for suffix, key in (("DateTime", None), ("String", None), ("Age", "value"), ("Period", "start"))
+]
+
+
+def onset(resource):
+    """onset (or performed time, or effective time) of a resource"""
+
+    for element, key in ONSETS:
+        value = resource.get(element)
+        if value is not None and key is not None:
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is not None:
+            return str(value)
+
+    return None
+
+
+def body_site(resource):
+    """body sites of a resource, in a stable order"""
+
+    sites = sorted(normalize(text) for text in text_values(resource.get("bodySite")))
+    return "; ".join(sites) if sites else None
+
+
+# attribute checks: name -> value of a resource
+ATTRIBUTES = {
+    "status": status,
+    "onset": onset,
+    "bodySite": body_site,
+}
+
+
+def read_results(path, column="extracted", id_column=None):
+    """
+    This function reads the resources of every note of a corpus or a results file:
+    a column of a CSV corpus, the NDJSON output of gpt-fhir extract, or a columnar file
+    or dataset directory.
+    """
+
+    if is_columnar(path):
+        return read_resources(path)
+
+    if path.endswith((".jsonl", ".ndjson")):
+        records = pd.read_json(path, lines=True, dtype={"note_id": str})
+        if "error" in records:
+            records = records[records["error"].isna()]
+
+        # outputs of older runs can repeat a note; its last result counts
+        records = records.drop_duplicates("note_id", keep="last")
+        return pd.Series(records["resources"].values, index=records["note_id"].astype(str))
+
+    frame = pd.read_csv(path)
+    if id_column:
+        frame = frame.set_index(id_column)
+
+    return frame[column]
+
+
+class Evaluator:
+    """
+    This class scores extracted resources against the ground truth of a corpus.
+    Resources of a note are matched on resource type and SNOMED code, then optionally
+    on a fuzzy match of their display, and precision, recall and F1 are computed per
+    resource type. Matched resources are also checked attribute by attribute.
+    Parsing is one pass over the resources; matching and scoring are table joins
+    and aggregations over the whole corpus.
+    """
+
+    def __init__(self, fuzzy=False, threshold=0.8, attributes=("status", "onset", "bodySite")):
+        # copy settings
+        self.fuzzy = fuzzy
+        self.threshold = threshold
+        self.attributes = list(attributes)
+
+        # character n-gram vectors of displays for the fuzzy matching
+        self.reranker = Reranker()
+
+    def frame(self, results, note_ids=None):
+        """
+        This function flattens results into a table with a row per resource.
+        results are the resources of every note: a Series or list of resource lists
+        (or their stringified cells), extraction results, a list of resources of one
+        note (as returned by FHIR.get_resources()), or a table from read_resources.
+        """
+
+        # resource rows of a columnar file, with the key elements flattened already
+        if isinstance(results, pd.DataFrame):
+            frame = results[["note_id", "resource_type", "code", "display"]].reset_index(drop=True)
+            frame["note_id"] = frame["note_id"].astype(str)
+            attributes = [attribute for attribute in self.attributes if attribute != "status"]
+            if "status" in self.attributes:
+                frame["status"] = results["status"].map(normalize, na_action="ignore").values
+            resources = map(json.loads, results["resource"]) if attributes else []
+            return self.add_attributes(frame, resources, attributes)
+
+        # resources of every note, identified by index or position
+        if isinstance(results, pd.Series):
+            note_ids = note_ids or results.index.astype(str).tolist()
+            results = results.tolist()
+        elif results and isinstance(results[0], dict):
+            results = [results]
+        note_ids = note_ids or [str(i) for i in range(len(results))]
+
+        rows, resources = [], []
+        for note_id, result in zip(note_ids, results):
+            for resource in parse_resources(getattr(result, "resources", result)):
+                elements = key_elements(resource)
+                rows.append(
+                    (str(note_id), elements["resource_type"], elements["code"], elements["display"])
+                )
+                resources.append(resource)
+
+        frame = pd.DataFrame(rows, columns=["note_id", "resource_type", "code", "display"])
+        return self.add_attributes(frame, resources, self.attributes)
+
+    def add_attributes(self, frame, resources, attributes):
+        """add the normalized checked attributes of the resources as columns"""
+
+        values = {attribute: [] for attribute in attributes}
+        for resource in resources:
+            for attribute in attributes:
+                value = ATTRIBUTES[attribute](resource)
+                values[attribute].append(None if value is None else normalize(value))
+        for attribute in attributes:
+            frame[attribute] = pd.Series(values[attribute], dtype=object)
+
+        return frame
+
+    def match(self, truth, extracted):
+        """
+        This function pairs every extracted resource with at most one ground truth resource.
+        Resources match on note, resource type and code (duplicates one to one),
+        and the ones left over optionally on the similarity of their displays.
+        Returns the pairs as (truth row, extracted row, kind).
+        """
+
+        keys = ["note_id", "resource_type", "code"]
+
+        # number the duplicates of a key, so the i-th truth matches the i-th extraction
+        truth = truth.assign(row=np.arange(len(truth)), rank=truth.groupby(keys).cumcount())
+        extracted = extracted.assign(
+            row=np.arange(len(extracted)), rank=extracted.groupby(keys).cumcount()
+        )
+        pairs = truth[[*keys, "rank", "row"]].merge(
+            extracted[[*keys, "rank", "row"]], on=[*keys, "rank"], suffixes=("_truth", "")
+        )
+        pairs = pairs.rename(columns={"row_truth": "truth", "row": "extracted"})[
+            ["truth", "extracted"]
+        ]
+        pairs["kind"] = "code"
+
+        if not self.fuzzy:
+            return pairs
+
+        # candidate pairs of the unmatched resources of the same note and type
+        left_truth = truth[~truth["row"].isin(pairs["truth"])]
+        left_extracted = extracted[~extracted["row"].isin(pairs["extracted"])]
+        candidates = left_truth[["note_id", "resource_type", "display", "row"]].merge(
+            left_extracted[["note_id", "resource_type", "display", "row"]],
+            on=["note_id", "resource_type"],
+            suffixes=("_truth", ""),
+        )
+        if candidates.empty:
+            return pairs
+
+        # cosine similarity of the displays of all candidate pairs at once
+        displays = pd.concat([candidates["display_truth"], candidates["display"]]).fillna("")
+        matrix = self.reranker.vectorize(displays.tolist())
+        n = len(candidates)
+        candidates["similarity"] = np.asarray(
+            matrix[:n].multiply(matrix[n:]).sum(axis=1)
+        ).ravel()
+
+        # greedily keep the most similar pair of every resource
+        fuzzy = (
+            candidates[candidates["similarity"] >= self.threshold]
+            .sort_values("similarity", ascending=False)
+            .drop_duplicates("row")
+            .drop_duplicates("row_truth")
+            .rename(columns={"row_truth": "truth", "row": "extracted"})[["truth", "extracted"]]
+        )
+        fuzzy["kind"] = "fuzzy"
+
+        return pd.concat([pairs, fuzzy], ignore_index=True)
+
+    def score(self, truth, extracted, pairs):
+        """
+        This function returns the counts, precision, recall and F1 per resource type,
+        with the micro average over all types as the row "all".
+        """
+
+        counts = pd.DataFrame(
+            {
+                "truth": truth.groupby("resource_type").size(),
+                "extracted": extracted.groupby("resource_type").size(),
+                "tp": truth["resource_type"].iloc[pairs["truth"]].value_counts(),
+            }
+        ).fillna(0)
+        counts.loc["all"] = counts.sum()
+        counts = counts.astype(int)
+
+        counts["fp"] = counts["extracted"] - counts["tp"]
+        counts["fn"] = counts["truth"] - counts["tp"]
+        counts["precision"] = counts["tp"] / counts["extracted"].replace(0, np.nan)
+        counts["recall"] = counts["tp"] / counts["truth"].replace(0, np.nan)
+        counts["f1"] = (
+            2
+            * counts["precision"]
+            * counts["recall"]
+            / (counts["precision"] + counts["recall"]).replace(0, np.nan)
+        )
+        counts.index.name = "resource_type"
+
+        return counts.fillna(0.0)
+
+    def check_attributes(self, truth, extracted, pairs):
+        """
+        This function returns the accuracy of every attribute of the matched resources
+        per resource type, over the pairs whose ground truth has the attribute.
+        """
+
+        # nothing to check
+        if not self.attributes:
+            return pd.DataFrame(
+                {"checked": [], "correct": [], "accuracy": []},
+                index=pd.MultiIndex.from_tuples([], names=["resource_type", "attribute"]),
+            )
+
+        matched_truth = truth.iloc[pairs["truth"]].reset_index(drop=True)
+        matched_extracted = extracted.iloc[pairs["extracted"]].reset_index(drop=True)
+
+        checks = []
+        for attribute in self.attributes:
+            present = matched_truth[attribute].notna()
+            correct = matched_truth[attribute] == matched_extracted[attribute]
+            checks.append(
+                pd.DataFrame(
+                    {
+                        "resource_type": matched_truth["resource_type"][present],
+                        "attribute": attribute,
+                        "correct": correct[present],
+                    }
+                )
+            )
+
+        checks = pd.concat(checks, ignore_index=True)
+        report = checks.groupby(["resource_type", "attribute"])["correct"].agg(
+            checked="size", correct="sum"
+        )
+        report["accuracy"] = report["correct"] / report["checked"]
+
+        return report
+
+    def evaluate(self, truth, extracted, note_ids=None):
+        """
+        This function scores extracted resources against the ground truth.
+        Both take any of the forms of frame, with the same note ids.
+        Returns the scores per resource type and the attribute accuracies.
+        """
+
+        truth = self.frame(truth, note_ids)
+        extracted = self.frame(extracted, note_ids)
+        pairs = self.match(truth, extracted)
+
+        return {
+            "scores": self.score(truth, extracted, pairs),
+            "attributes": self.check_attributes(truth, extracted, pairs),
+            "fuzzy_matches": int((pairs["kind"] == "fuzzy").sum()),
+        }
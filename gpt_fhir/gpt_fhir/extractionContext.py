@@ -0,0 +1,24 @@
+class ExtractionContext:
+    """
+    This class collects the FHIR resources extracted from one note.
+    A new context is passed through every extraction, so a single
+    FHIR/FHIRTools/LLMExtractor stack can serve many notes concurrently.
+    """
+
+    def __init__(self, note_id=None, annotations=None):
+        # optional id of the processed note
+        self.note_id = note_id
+
+        # init FHIR resources
+        self.resources = []
+
+        # SNOMED annotations resolved ahead of the writers, by normalized term;
+        # may be shared by the contexts of a batch of notes
+        self.annotations = {} if annotations is None else annotations
+
+    def add(self, resource):
+        """
+        This function adds a resource to the context.
+        """
+
+        self.resources.append(resource)
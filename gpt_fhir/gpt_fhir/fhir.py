@@ -1,18 +1,11 @@
+import asyncio
 import logging
 from fhirclient.client import FHIRClient
-
-# FHIR types
-from fhirclient.models.age import Age
-from fhirclient.models.period import Period
-from fhirclient.models.dosage import Dosage
-from fhirclient.models.fhirdate import FHIRDate
-from fhirclient.models.procedure import Procedure
-from fhirclient.models.condition import Condition
-from fhirclient.models.annotation import Annotation
-from fhirclient.models.condition import ConditionStage
-from fhirclient.models.condition import ConditionEvidence
-from fhirclient.models.codeableconcept import CodeableConcept
-from fhirclient.models.medicationstatement import MedicationStatement
+from gpt_fhir.metrics import metrics
+from gpt_fhir.fhirSink import FHIRSink
+from gpt_fhir.reranker import Reranker
+from gpt_fhir.snomedIndex import normalize
+from gpt_fhir.resourceBuilder import compile_builders
 
 
 class FHIR:
@@ -22,16 +15,50 @@ class FHIR:
     that were extracted from doctor's notes to the FHIR server.
     """
 
-    def __init__(self, annotator):
+    def __init__(self, annotator, config=None):
         # copy annotator
         self.annotator = annotator
 
+        # compile resource builders from the tool schemas and field mappings
+        self.builders = compile_builders(config)
+
+        # optionally rerank the SNOMED candidates of the annotator instead of taking the first
+        self.reranker = None
+        rerank = (config or {}).get("FHIR", {}).get("RERANK", {})
+        if rerank.get("ENABLED", False):
+            # without semantic tags in the candidates (OLS) the tag fit cannot be scored
+            tag_weight = rerank.get("TAG_WEIGHT", 0.3)
+            if tag_weight and not getattr(annotator, "semantic_tags", False):
+                logging.warning("RERANK: the annotator gives no semantic tags, TAG_WEIGHT is 0")
+                tag_weight = 0.0
+            self.reranker = Reranker(
+                n=rerank.get("NGRAM", 3),
+                tag_weight=tag_weight,
+                rank_weight=rerank.get("RANK_WEIGHT", 0.05),
+            )
+
         # init FHIR resources
         self.resources = []
 
+        # destinations of the resources of every extracted note
+        self.sinks = []
+        server = (config or {}).get("FHIR", {}).get("SERVER")
+        if server is not None:
+            self.add_sink(
+                FHIRSink(
+                    server["URL"],
+                    bundle_size=server.get("BUNDLE_SIZE", 100),
+                    bundle_type=server.get("BUNDLE_TYPE", "batch"),
+                    max_in_flight=server.get("MAX_IN_FLIGHT", 4),
+                    headers=server.get("HEADERS"),
+                    conditional=server.get("CONDITIONAL", True),
+                )
+            )
+
     def empty_resources(self):
         """
-        This function empties the resources list.
+        This function empties the resources list
+        of resources written without an extraction context.
         """
 
         self.resources = []
@@ -43,416 +70,171 @@ class FHIR:
 
         return self.resources
 
-    def write_condition(self, params):
+    def store(self, resource, context=None):
         """
-        This function writes a condition to the FHIR server.
+        This function stores a resource in the extraction context,
+        or in the shared resources list if there is no context.
         """
 
-        logging.info(f"FROM LLM: {params}")
-
-        # annotate condition code
-        annotations = self.annotator.run(params["condition"])
-        if len(annotations) > 0:
-            annotation = annotations[0]
-
-            # create FHIR condition
-            condition = Condition(
-                {
-                    "code": {
-                        "coding": [
-                            {
-                                "system": "http://snomed.info/sct",
-                                "code": annotation["obo_id"].split(":")[1],
-                                "display": annotation["label"],
-                            }
-                        ],
-                        "text": params["condition"],
-                    },
-                    "subject": {"reference": "Patient/1"},
-                    "clinicalStatus": {"text": params["clinicalStatus"]},
-                }
-            )
+        if context is None:
+            self.resources.append(resource)
+            self.publish([resource])
+        else:
+            context.add(resource)
 
-            # add abatementAge if present
-            if "abatementAge" in params:
-                condition.abatementAge = Age({"value": params["abatementAge"]})
-
-            # add abatementDateTime if present
-            if "abatementDateTime" in params:
-                condition.abatementDateTime = FHIRDate(params["abatementDateTime"])
-
-            # add abatementPeriod if present
-            if "abatementPeriod" in params:
-                if (
-                    type(params["abatementPeriod"]) == dict
-                    and "start" in params["abatementPeriod"]
-                    and "end" in params["abatementPeriod"]
-                ):
-                    condition.abatementPeriod = Period(
-                        {
-                            "start": params["abatementPeriod"]["start"],
-                            "end": params["abatementPeriod"]["end"],
-                        }
-                    )
-
-            # add abatementString if present
-            if "abatementString" in params:
-                condition.abatementString = params["abatementString"]
-
-            # add bodySite if present
-            if "bodySite" in params:
-                if type(params["bodySite"]) == list:
-                    condition.bodySite = [
-                        CodeableConcept({"text": bodySite})
-                        for bodySite in params["bodySite"]
-                    ]
-                else:
-                    condition.bodySite = [CodeableConcept({"text": params["bodySite"]})]
-
-            # add category if present
-            if "category" in params:
-                if type(params["category"]) == list:
-                    condition.category = [
-                        CodeableConcept({"text": category})
-                        for category in params["category"]
-                    ]
-                else:
-                    condition.category = [CodeableConcept({"text": params["category"]})]
-
-            # add evidence if present
-            if "evidence" in params:
-                if type(params["evidence"]) == list:
-                    condition.evidence = [
-                        ConditionEvidence({"code": [{"text": evidence}]})
-                        for evidence in params["evidence"]
-                    ]
-                else:
-                    condition.evidence = [
-                        ConditionEvidence({"code": [{"text": params["evidence"]}]})
-                    ]
-
-            # add "note" if present
-            if "note" in params:
-                if type(params["note"]) == list:
-                    condition.note = [
-                        Annotation({"text": note}) for note in params["note"]
-                    ]
-                else:
-                    condition.note = [Annotation({"text": params["note"]})]
-
-            # add onsetAge if present
-            if "onsetAge" in params:
-                condition.onsetAge = Age({"value": params["onsetAge"]})
-
-            # add onsetDateTime if present
-            if "onsetDateTime" in params:
-                condition.onsetDateTime = FHIRDate(params["onsetDateTime"])
-
-            # add onsetPeriod if present
-            if "onsetPeriod" in params:
-                if (
-                    type(params["onsetPeriod"]) == dict
-                    and "start" in params["onsetPeriod"]
-                    and "end" in params["onsetPeriod"]
-                ):
-                    condition.onsetPeriod = Period(
-                        {
-                            "start": params["onsetPeriod"]["start"],
-                            "end": params["onsetPeriod"]["end"],
-                        }
-                    )
-
-            # add onsetString if present
-            if "onsetString" in params:
-                condition.onsetString = params["onsetString"]
-
-            # add recordedDate if present
-            if "recordedDate" in params:
-                condition.recordedDate = FHIRDate(params["recordedDate"])
-
-            # add severity if present
-            if "severity" in params:
-                condition.severity = CodeableConcept({"text": params["severity"]})
-
-            # add stage if present
-            if "stage" in params:
-                if type(params["stage"]) == list:
-                    condition.stage = [
-                        ConditionStage({"summary": {"text": stage}})
-                        for stage in params["stage"]
-                    ]
-                else:
-                    condition.stage = [
-                        ConditionStage({"summary": {"text": params["stage"]}})
-                    ]
-
-            # add verificationStatus if present
-            if "verificationStatus" in params:
-                condition.verificationStatus = CodeableConcept(
-                    {"text": params["verificationStatus"]}
-                )
+    def add_sink(self, sink):
+        """
+        This function registers a destination of extracted resources,
+        any object with add(resource, note_id), flush() and close() methods.
+        """
 
-            logging.info(f"FHIR: {condition.as_json()}")
+        self.sinks.append(sink)
 
-            # add condition to resources list
-            self.resources.append(condition.as_json())
+    def publish(self, resources, note_id=None):
+        """
+        This function hands the final resources of a note to the sinks.
+        """
 
-            return "Condition was added"
+        for sink in self.sinks:
+            for resource in resources:
+                sink.add(resource, note_id)
 
-        else:
-            return "Condition was not added because code was not found"
+    async def apublish(self, resources, note_id=None):
+        """
+        This function hands the final resources of a note to the sinks from a worker
+        thread, as a sink blocks while all of its Bundles are in flight.
+        """
 
-    def write_procedure(self, params):
+        if self.sinks and resources:
+            await asyncio.to_thread(self.publish, resources, note_id)
+
+    def flush(self):
         """
-        This function writes a procedure to the FHIR server.
+        This function sends everything the sinks have queued.
+        """
+
+        for sink in self.sinks:
+            sink.flush()
+
+    def checkpoint(self):
+        """
+        This function tells the sinks keeping checkpoints that the notes
+        of the resources handed to them so far are completed.
+        """
+
+        for sink in self.sinks:
+            if hasattr(sink, "checkpoint"):
+                sink.checkpoint()
+
+    def close(self):
+        """
+        This function flushes and closes the sinks.
+        """
+
+        for sink in self.sinks:
+            sink.close()
+
+    def prefetch(self, terms, context, tool_names=None):
+        """
+        This function resolves the annotations of many terms in one pass
+        and keeps them in the extraction context for the writers.
+        tool_names gives the tool of each term, whose resource type the candidates are ranked for.
         """
 
-        logging.info(f"FROM LLM: {params}")
-
-        # annotate procedure code
-        annotations = self.annotator.run(params["procedure"])
-        if len(annotations) > 0:
-            annotation = annotations[0]
-
-            # create FHIR procedure
-            procedure = Procedure(
-                {
-                    "code": {
-                        "coding": [
-                            {
-                                "system": "http://snomed.info/sct",
-                                "code": annotation["obo_id"].split(":")[1],
-                                "display": annotation["label"],
-                            }
-                        ],
-                        "text": params["procedure"],
-                    },
-                    "status": params["status"],
-                    "subject": {"reference": "Patient/1"},
-                }
+        # distinct terms not resolved yet, with their tools
+        tool_names = tool_names or [None] * len(terms)
+        unique = {}
+        for term, tool_name in zip(terms, tool_names):
+            if normalize(term) not in context.annotations:
+                unique.setdefault(normalize(term), (term, tool_name))
+        if not unique:
+            return
+        terms = [term for term, _ in unique.values()]
+
+        candidates = self.annotator.run_many(terms)
+
+        # rerank the candidates of all terms at once
+        if self.reranker is not None:
+            candidates = self.reranker.rerank_many(
+                terms,
+                candidates,
+                [self.semantic_tags(tool_name) for _, tool_name in unique.values()],
             )
 
-            # add bodySite if present
-            if "bodySite" in params:
-                if type(params["bodySite"]) == list:
-                    procedure.bodySite = [
-                        CodeableConcept({"text": bodySite})
-                        for bodySite in params["bodySite"]
-                    ]
-                else:
-                    procedure.bodySite = [CodeableConcept({"text": params["bodySite"]})]
-
-            # add category if present
-            if "category" in params:
-                procedure.category = CodeableConcept({"text": params["category"]})
-
-            # add complication if present
-            if "complication" in params:
-                if type(params["complication"]) == list:
-                    procedure.complication = [
-                        CodeableConcept({"text": complication})
-                        for complication in params["complication"]
-                    ]
-                else:
-                    procedure.complication = [
-                        CodeableConcept({"text": params["complication"]})
-                    ]
-
-            # add followUp if present
-            if "followUp" in params:
-                if type(params["followUp"]) == list:
-                    procedure.followUp = [
-                        CodeableConcept({"text": followUp})
-                        for followUp in params["followUp"]
-                    ]
-                else:
-                    procedure.followUp = [CodeableConcept({"text": params["followUp"]})]
-
-            # add note if present
-            if "note" in params:
-                if type(params["note"]) == list:
-                    procedure.note = [
-                        Annotation({"text": note}) for note in params["note"]
-                    ]
-                else:
-                    procedure.note = [Annotation({"text": params["note"]})]
-
-            # add outcome if present
-            if "outcome" in params:
-                procedure.outcome = CodeableConcept({"text": params["outcome"]})
-
-            # add performedAge if present
-            if "performedAge" in params:
-                procedure.performedAge = Age({"value": params["performedAge"]})
-
-            # add performedDateTime if present
-            if "performedDateTime" in params:
-                procedure.performedDateTime = FHIRDate(params["performedDateTime"])
-
-            # add performedPeriod if present
-            if "performedPeriod" in params:
-                if (
-                    type(params["performedPeriod"]) == dict
-                    and "start" in params["performedPeriod"]
-                    and "end" in params["performedPeriod"]
-                ):
-                    procedure.performedPeriod = Period(
-                        {
-                            "start": params["performedPeriod"]["start"],
-                            "end": params["performedPeriod"]["end"],
-                        }
-                    )
-
-            # add performedString if present
-            if "performedString" in params:
-                procedure.performedString = params["performedString"]
-
-            # add reasonCode if present
-            if "reasonCode" in params:
-                if type(params["reasonCode"]) == list:
-                    procedure.reasonCode = [
-                        CodeableConcept({"text": reasonCode})
-                        for reasonCode in params["reasonCode"]
-                    ]
-                else:
-                    procedure.reasonCode = [
-                        CodeableConcept({"text": params["reasonCode"]})
-                    ]
-
-            # add statusReason if present
-            if "statusReason" in params:
-                procedure.statusReason = CodeableConcept(
-                    {"text": params["statusReason"]}
-                )
+        for term, annotations in zip(terms, candidates):
+            context.annotations[normalize(term)] = annotations
+
+    def semantic_tags(self, tool_name):
+        """SNOMED semantic tags fitting the resource of a tool"""
 
-            # add usedCode if present
-            if "usedCode" in params:
-                if type(params["usedCode"]) == list:
-                    procedure.usedCode = [
-                        CodeableConcept({"text": usedCode})
-                        for usedCode in params["usedCode"]
-                    ]
-                else:
-                    procedure.usedCode = [CodeableConcept({"text": params["usedCode"]})]
+        builder = self.builders.get(tool_name)
+        return builder.semantic_tags if builder is not None else None
 
-            logging.info(f"FHIR: {procedure.as_json()}")
+    def annotate(self, term, context=None, tool_name=None):
+        """
+        This function returns the annotations of a term, best first,
+        preferring the ones prefetched into the extraction context.
+        """
 
-            # add procedure to resources list
-            self.resources.append(procedure.as_json())
+        if context is not None:
+            annotations = context.annotations.get(normalize(term))
+            if annotations is not None:
+                return annotations
 
-            return "Procedure was added"
+        annotations = self.annotator.run(term)
+        if self.reranker is not None:
+            annotations = self.reranker.rerank_many(
+                [term], [annotations], [self.semantic_tags(tool_name)]
+            )[0]
 
-        else:
-            return "Procedure was not added because code was not found"
+        return annotations
 
-    def write_medication_statement(self, params):
+    def write(self, tool_name, params, context=None):
         """
-        This function writes a medication statement to the FHIR server.
+        This function writes the resource of a tool call to the FHIR server.
+        The resource is collected in the extraction context if one is given.
         """
 
-        logging.info(f"FROM LLM: {params}")
-
-        # annotate medication code
-        annotations = self.annotator.run(params["medication_statement"])
-        if len(annotations) > 0:
-            annotation = annotations[0]
-
-            # create FHIR medication statement
-            medication_statement = MedicationStatement(
-                {
-                    "medicationCodeableConcept": {
-                        "coding": [
-                            {
-                                "system": "http://snomed.info/sct",
-                                "code": annotation["obo_id"].split(":")[1],
-                                "display": annotation["label"],
-                            }
-                        ],
-                        "text": params["medication_statement"],
-                    },
-                    "subject": {"reference": "Patient/1"},
-                    "status": params["status"],
-                }
-            )
+        if tool_name not in self.builders:
+            return f"Tool {tool_name} does not exist"
+        builder = self.builders[tool_name]
 
-            # add category if present
-            if "category" in params:
-                medication_statement.category = CodeableConcept(
-                    {"text": params["category"]}
-                )
+        with metrics.span("fhir_write", tool=tool_name):
+            logging.info(f"FROM LLM: {params}")
 
-            # add dateAsserted if present
-            if "dateAsserted" in params:
-                medication_statement.dateAsserted = FHIRDate(params["dateAsserted"])
-
-            # add dosage if present
-            if "dosage" in params:
-                if type(params["dosage"]) == list:
-                    medication_statement.dosage = [
-                        Dosage({"text": dosage}) for dosage in params["dosage"]
-                    ]
-                else:
-                    medication_statement.dosage = [Dosage({"text": params["dosage"]})]
-
-            # add effectiveDateTime if present
-            if "effectiveDateTime" in params:
-                medication_statement.effectiveDateTime = FHIRDate(
-                    params["effectiveDateTime"]
-                )
+            # annotate resource code
+            annotations = self.annotate(params[builder.code_parameter], context, tool_name)
+            if len(annotations) > 0:
+                # create FHIR resource
+                resource = builder.build(params, annotations[0])
 
-            # add effectivePeriod if present
-            if "effectivePeriod" in params:
-                if (
-                    type(params["effectivePeriod"]) == dict
-                    and "start" in params["effectivePeriod"]
-                    and "end" in params["effectivePeriod"]
-                ):
-                    medication_statement.effectivePeriod = Period(
-                        {
-                            "start": params["effectivePeriod"]["start"],
-                            "end": params["effectivePeriod"]["end"],
-                        }
-                    )
-
-            # add note if present
-            if "note" in params:
-                if type(params["note"]) == list:
-                    medication_statement.note = [
-                        Annotation({"text": note}) for note in params["note"]
-                    ]
-                else:
-                    medication_statement.note = [Annotation({"text": params["note"]})]
-
-            # add reasonCode if present
-            if "reasonCode" in params:
-                if type(params["reasonCode"]) == list:
-                    medication_statement.reasonCode = [
-                        CodeableConcept({"text": reasonCode})
-                        for reasonCode in params["reasonCode"]
-                    ]
-                else:
-                    medication_statement.reasonCode = [
-                        CodeableConcept({"text": params["reasonCode"]})
-                    ]
-
-            # add statusReason if present
-            if "statusReason" in params:
-                if type(params["statusReason"]) == list:
-                    medication_statement.statusReason = [
-                        CodeableConcept({"text": statusReason})
-                        for statusReason in params["statusReason"]
-                    ]
-                else:
-                    medication_statement.statusReason = [
-                        CodeableConcept({"text": params["statusReason"]})
-                    ]
-
-            logging.info(f"FHIR: {medication_statement.as_json()}")
-
-            # add medication statement to resources list
-            self.resources.append(medication_statement.as_json())
-
-            return "Medication statement was added"
+                logging.info(f"FHIR: {resource}")
 
-        else:
-            return "Medication statement was not added because code was not found"
+                # add resource to resources list
+                self.store(resource, context)
+
+                return f"{builder.name} was added"
+
+            else:
+                return f"{builder.name} was not added because code was not found"
+
+    def write_condition(self, params, context=None):
+        """
+        This function writes a condition to the FHIR server.
+        """
+
+        return self.write("extract_fhir_condition", params, context)
+
+    def write_procedure(self, params, context=None):
+        """
+        This function writes a procedure to the FHIR server.
+        """
+
+        return self.write("extract_fhir_procedure", params, context)
+
+    def write_medication_statement(self, params, context=None):
+        """
+        This function writes a medication statement to the FHIR server.
+        """
+
+        return self.write("extract_fhir_medication_statement", params, context)
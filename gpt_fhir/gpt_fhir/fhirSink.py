@@ -0,0 +1,264 @@
+import json
+import uuid
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# system of the identifiers the sink gives resources, so they are created only once
+IDENTIFIER_SYSTEM = "urn:gpt-fhir:resource"
+
+
+def resource_identifier(note_id, resource):
+    """
+    This function returns the identifier of a resource of a note: its own first one,
+    or a hash of the note id and the resource, which is the same when a note is
+    extracted again with the same result.
+    """
+
+    identifiers = resource.get("identifier")
+    if identifiers and identifiers[0].get("value"):
+        return identifiers[0].get("system", ""), identifiers[0]["value"]
+
+    content = json.dumps([note_id, resource], sort_keys=True, separators=(",", ":"))
+    return IDENTIFIER_SYSTEM, hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class RejectionRetry(Retry):
+    """
+    This class retries POSTs only when the server cannot have processed them:
+    failed connections, and 429/503 responses asking for a retry with Retry-After.
+    Read errors and gateway errors are not retried, as the Bundle may have been stored.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        return has_retry_after and super().is_retry(method, status_code, has_retry_after)
+
+
+class FHIRSink:
+    """
+    This class writes resources to a FHIR server in transaction or batch Bundles.
+    Resources are grouped into Bundles of bundle_size entries, which are POSTed over
+    one pooled keep-alive session with up to max_in_flight Bundles in flight.
+    Failed entries are recorded with their note id instead of failing the extraction.
+    Only requests the server rejected unprocessed are retried, so entries are not duplicated.
+    Resources of notes are created conditionally on an identifier derived from the note id
+    and the resource, so notes extracted again after a resumed run are not stored twice.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        bundle_size=100,
+        bundle_type="batch",
+        max_in_flight=4,
+        timeout=60,
+        headers=None,
+        max_retries=3,
+        conditional=True,
+    ):
+        # copy settings
+        self.base_url = base_url.rstrip("/")
+        self.bundle_size = bundle_size
+        self.bundle_type = bundle_type
+        self.timeout = timeout
+        self.conditional = conditional
+
+        # pooled keep-alive connections, one per Bundle in flight;
+        # connection failures and overloaded servers are retried with backoff
+        retry = RejectionRetry(
+            total=max_retries,
+            read=0,
+            other=0,
+            backoff_factor=0.5,
+            status_forcelist=(429, 503),
+            allowed_methods=["POST"],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(
+            {"Content-Type": "application/fhir+json", "Accept": "application/fhir+json"}
+        )
+        self.session.headers.update(headers or {})
+
+        # Bundles are sent in the background; adding blocks while max_in_flight are pending
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.futures = []
+
+        # entries waiting for the next Bundle
+        self.entries = []
+        self.lock = threading.Lock()
+
+        # init counters
+        self.bundles = 0
+        self.written = 0
+        self.errors = []
+
+    def add(self, resource, note_id=None):
+        """
+        This function queues a resource, sending a Bundle once bundle_size are queued.
+        """
+
+        with self.lock:
+            self.entries.append((note_id, resource))
+            if len(self.entries) < self.bundle_size:
+                return
+            entries, self.entries = self.entries, []
+
+        self.submit(entries)
+
+    def submit(self, entries):
+        """send a Bundle in the background, waiting for a free slot"""
+
+        self.in_flight.acquire()
+        future = self.executor.submit(self.send, entries)
+        future.add_done_callback(lambda _: self.in_flight.release())
+        with self.lock:
+            self.futures = [pending for pending in self.futures if not pending.done()]
+            self.futures.append(future)
+
+    def bundle(self, entries):
+        """
+        This function creates the Bundle of resources.
+        """
+
+        return {
+            "resourceType": "Bundle",
+            "type": self.bundle_type,
+            "entry": [self.entry(note_id, resource) for note_id, resource in entries],
+        }
+
+    def entry(self, note_id, resource):
+        """
+        This function creates the Bundle entry of a resource, created only if no resource
+        has its identifier yet when the note is known.
+        """
+
+        request = {"method": "POST", "url": resource["resourceType"]}
+        if self.conditional and note_id is not None:
+            system, value = resource_identifier(note_id, resource)
+            if not resource.get("identifier"):
+                resource = {**resource, "identifier": [{"system": system, "value": value}]}
+            request["ifNoneExist"] = f"identifier={system}|{value}"
+
+        return {"fullUrl": f"urn:uuid:{uuid.uuid4()}", "resource": resource, "request": request}
+
+    def send(self, entries):
+        """
+        This function POSTs a Bundle and records the outcome of each of its entries.
+        """
+
+        try:
+            response = self.session.post(
+                self.base_url, json=self.bundle(entries), timeout=self.timeout
+            )
+        except requests.RequestException as e:
+            return self.fail(entries, None, repr(e))
+
+        if response.status_code >= 400:
+            # a failed transaction is rolled back as a whole
+            return self.fail(entries, str(response.status_code), response.text)
+
+        try:
+            outcomes = response.json().get("entry", [])
+        except ValueError:
+            return self.fail(entries, str(response.status_code), response.text)
+        written = 0
+        errors = []
+        for (note_id, resource), outcome in zip(entries, outcomes):
+            status = outcome.get("response", {}).get("status", "")
+            if status[:1] in ("2", "3"):
+                written += 1
+            else:
+                errors.append(
+                    {
+                        "note_id": note_id,
+                        "resourceType": resource["resourceType"],
+                        "status": status,
+                        "outcome": outcome.get("response", {}).get("outcome"),
+                    }
+                )
+
+        # entries the response Bundle leaves out cannot be told apart from failed ones
+        for note_id, resource in entries[len(outcomes) :]:
+            errors.append(
+                {
+                    "note_id": note_id,
+                    "resourceType": resource["resourceType"],
+                    "status": None,
+                    "outcome": "missing from the response Bundle",
+                }
+            )
+
+        with self.lock:
+            self.bundles += 1
+            self.written += written
+            self.errors.extend(errors)
+        if errors:
+            logging.warning(f"FHIR SINK: {len(errors)} of {len(entries)} entries failed")
+
+    def fail(self, entries, status, outcome):
+        """record all entries of a Bundle as failed"""
+
+        logging.error(f"FHIR SINK: Bundle of {len(entries)} entries failed ({status})")
+        with self.lock:
+            self.bundles += 1
+            self.errors.extend(
+                {
+                    "note_id": note_id,
+                    "resourceType": resource["resourceType"],
+                    "status": status,
+                    "outcome": outcome,
+                }
+                for note_id, resource in entries
+            )
+
+    def flush(self):
+        """
+        This function sends the queued resources and waits for all Bundles in flight.
+        """
+
+        with self.lock:
+            entries, self.entries = self.entries, []
+        if entries:
+            self.submit(entries)
+
+        with self.lock:
+            futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """
+        This function flushes the sink and releases its connections.
+        """
+
+        self.flush()
+        self.executor.shutdown()
+        self.session.close()
+
+    def stats(self):
+        """
+        This function returns the Bundle and entry counters.
+        """
+
+        return {
+            "bundles": self.bundles,
+            "written": self.written,
+            "failed": len(self.errors),
+            "queued": len(self.entries),
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,4 +1,11 @@
 import json
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from openai.types.chat import ChatCompletionMessageToolCall
+from gpt_fhir.metrics import metrics
+from gpt_fhir.notePacker import NOTE_ID_PARAMETER, leaked
+from gpt_fhir.extractionContext import ExtractionContext
 
 
 class FHIRTools:
@@ -14,18 +21,213 @@ class FHIRTools:
         # copy over the fhir client
         self.fhir = fhir
 
-    def run(self, tool_call):
-        """Run a tool"""
+        # tool calls of one response are run in parallel, each blocking on its own annotation
+        self.concurrency = config["GENAI"].get("TOOL_CONCURRENCY", 8)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def run(self, tool_call, context=None):
+        """Run a tool, collecting the created resources in the extraction context"""
 
         # extract tool name and params
         tool_name = tool_call.function.name
         tool_parameters = json.loads(tool_call.function.arguments)
 
-        # run tool
-        match tool_name:
-            case "extract_fhir_condition":
-                return self.fhir.write_condition(tool_parameters)
-            case "extract_fhir_medication_statement":
-                return self.fhir.write_medication_statement(tool_parameters)
-            case "extract_fhir_procedure":
-                return self.fhir.write_procedure(tool_parameters)
+        # run tool through the resource builder of its name
+        with metrics.span("tool_call", tool=tool_name):
+            return self.fhir.write(tool_name, tool_parameters, context)
+
+    def run_all(self, tool_calls, context=None):
+        """
+        Run all tool calls of one LLM response in parallel.
+        Responses and resources are returned in the original tool call order.
+        """
+
+        # resolve all terms in one deduplicated pass
+        batch = ExtractionContext() if context is None else context
+        self.prefetch(tool_calls, batch)
+
+        # every tool call collects its resources separately
+        contexts = [ExtractionContext(batch.note_id, batch.annotations) for _ in tool_calls]
+        futures = [
+            self.executor.submit(self.run, tool_call, tool_context)
+            for tool_call, tool_context in zip(tool_calls, contexts)
+        ]
+        responses = [future.result() for future in futures]
+
+        # merge resources in tool call order
+        self.merge(contexts, context)
+
+        return responses
+
+    async def arun_all(self, tool_calls, context=None):
+        """
+        Run all tool calls of one LLM response concurrently without blocking the event loop.
+        Responses and resources are returned in the original tool call order.
+        """
+
+        # resolve all terms in one deduplicated pass
+        batch = ExtractionContext() if context is None else context
+        await asyncio.to_thread(self.prefetch, tool_calls, batch)
+
+        # every tool call collects its resources separately
+        contexts = [ExtractionContext(batch.note_id, batch.annotations) for _ in tool_calls]
+        loop = asyncio.get_running_loop()
+        responses = await asyncio.gather(
+            *(
+                loop.run_in_executor(self.executor, self.run, tool_call, tool_context)
+                for tool_call, tool_context in zip(tool_calls, contexts)
+            )
+        )
+
+        # merge resources in tool call order
+        self.merge(contexts, context)
+
+        return list(responses)
+
+    def demultiplex(self, tool_calls, texts):
+        """
+        Assign the tool calls of a packed request to its notes by their note_id argument.
+        Returns (note position, tool call without note_id) pairs; the position is None
+        for calls naming no note of the request, which are counted as unassigned.
+        Calls whose term is not in their note but in another one are counted as leaks
+        between notes.
+        """
+
+        routed = []
+        for tool_call in tool_calls:
+            try:
+                tool_parameters = json.loads(tool_call.function.arguments)
+                index = int(tool_parameters.pop(NOTE_ID_PARAMETER)) - 1
+            except (json.JSONDecodeError, AttributeError, KeyError, TypeError, ValueError):
+                index = None
+            if index is None or not 0 <= index < len(texts):
+                logging.warning(f"PACKING: {tool_call.function.name} call names no note")
+                metrics.count("packing_unassigned")
+                routed.append((None, tool_call))
+                continue
+
+            # check the term against the note it was assigned to
+            builder = self.fhir.builders.get(tool_call.function.name)
+            term = tool_parameters.get(builder.code_parameter) if builder is not None else None
+            if isinstance(term, str):
+                owner = leaked(term, index, texts)
+                if owner is not None:
+                    logging.warning(f"PACKING: {term} of note {index + 1} is in note {owner + 1}")
+                    metrics.count("packing_leaks")
+
+            routed.append(
+                (
+                    index,
+                    ChatCompletionMessageToolCall(
+                        id=tool_call.id,
+                        type="function",
+                        function={
+                            "name": tool_call.function.name,
+                            "arguments": json.dumps(tool_parameters),
+                        },
+                    ),
+                )
+            )
+
+        return routed
+
+    def run_routed(self, index, tool_call, context):
+        """Run a demultiplexed tool call, refusing calls that name no note"""
+
+        if index is None:
+            return f"Tool call has no valid {NOTE_ID_PARAMETER}; the resource was not added"
+        return self.run(tool_call, context)
+
+    def run_packed(self, tool_calls, contexts, texts):
+        """
+        Run all tool calls of a packed LLM response in parallel, collecting the resources
+        of every note in its own context. Responses are returned in the original tool call
+        order, with the note position of every call.
+        """
+
+        routed = self.demultiplex(tool_calls, texts)
+
+        # resolve all terms of all notes in one deduplicated pass
+        batch = ExtractionContext(annotations=contexts[0].annotations)
+        self.prefetch([tool_call for _, tool_call in routed], batch)
+
+        # every tool call collects its resources separately
+        tool_contexts = [
+            ExtractionContext(
+                None if index is None else contexts[index].note_id, batch.annotations
+            )
+            for index, _ in routed
+        ]
+        futures = [
+            self.executor.submit(self.run_routed, index, tool_call, tool_context)
+            for (index, tool_call), tool_context in zip(routed, tool_contexts)
+        ]
+        responses = [future.result() for future in futures]
+
+        # merge resources into the context of their note, in tool call order
+        self.merge_packed(routed, tool_contexts, contexts)
+
+        return responses, [index for index, _ in routed]
+
+    async def arun_packed(self, tool_calls, contexts, texts):
+        """
+        Run all tool calls of a packed LLM response concurrently without blocking the
+        event loop, collecting the resources of every note in its own context.
+        """
+
+        routed = self.demultiplex(tool_calls, texts)
+
+        # resolve all terms of all notes in one deduplicated pass
+        batch = ExtractionContext(annotations=contexts[0].annotations)
+        await asyncio.to_thread(self.prefetch, [tool_call for _, tool_call in routed], batch)
+
+        # every tool call collects its resources separately
+        tool_contexts = [
+            ExtractionContext(
+                None if index is None else contexts[index].note_id, batch.annotations
+            )
+            for index, _ in routed
+        ]
+        loop = asyncio.get_running_loop()
+        responses = await asyncio.gather(
+            *(
+                loop.run_in_executor(self.executor, self.run_routed, index, tool_call, tool_context)
+                for (index, tool_call), tool_context in zip(routed, tool_contexts)
+            )
+        )
+
+        # merge resources into the context of their note, in tool call order
+        self.merge_packed(routed, tool_contexts, contexts)
+
+        return list(responses), [index for index, _ in routed]
+
+    def merge_packed(self, routed, tool_contexts, contexts):
+        """Move resources of per-tool-call contexts into the contexts of their notes"""
+
+        for (index, _), tool_context in zip(routed, tool_contexts):
+            if index is not None:
+                self.merge([tool_context], contexts[index])
+
+    def prefetch(self, tool_calls, context):
+        """Resolve the annotations of all terms in the tool calls in one pass"""
+
+        terms = []
+        tool_names = []
+        for tool_call in tool_calls:
+            builder = self.fhir.builders.get(tool_call.function.name)
+            try:
+                tool_parameters = json.loads(tool_call.function.arguments)
+            except json.JSONDecodeError:
+                continue
+            if builder is not None and isinstance(tool_parameters.get(builder.code_parameter), str):
+                terms.append(tool_parameters[builder.code_parameter])
+                tool_names.append(tool_call.function.name)
+
+        self.fhir.prefetch(terms, context, tool_names)
+
+    def merge(self, contexts, context=None):
+        """Move resources of per-tool-call contexts into the extraction context"""
+
+        for tool_context in contexts:
+            for resource in tool_context.resources:
+                self.fhir.store(resource, context)
@@ -1,5 +1,127 @@
+import json
+import asyncio
+import logging
 import datetime
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from openai import OpenAI, AsyncOpenAI
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+from gpt_fhir.toolRouter import ToolRouter
+from gpt_fhir.metrics import NULL_SPAN, metrics
+from gpt_fhir.rateLimiter import RateLimiter
+from gpt_fhir.noteChunker import NoteChunker, merge_resources
+from gpt_fhir.notePacker import PACKED_PROMPT, NotePacker, pack, pack_tools
+from gpt_fhir.responseCache import ResponseCache, render_date, strip_date
+from gpt_fhir.extractionContext import ExtractionContext
+
+
+@dataclass
+class ExtractionResult:
+    """
+    This class holds the outcome of one extraction.
+    """
+
+    # FHIR resources built from the note
+    resources: list = field(default_factory=list)
+
+    # tool calls made by the LLM with their outcomes
+    tool_calls: list = field(default_factory=list)
+
+    # token usage summed over all completions
+    usage: dict = field(
+        default_factory=lambda: {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+        }
+    )
+
+    # last raw OpenAI response
+    response: object = None
+
+    # whether the tool calls were replayed from the response cache
+    cached: bool = False
+
+    # tier that extracted the note: "llm", or "local" for the cascade's matcher
+    tier: str = "llm"
+
+    def add_usage(self, response):
+        """add token usage of a completion"""
+
+        self.response = response
+        if response.usage is not None:
+            for key in self.usage:
+                self.usage[key] += getattr(response.usage, key, 0) or 0
+            metrics.count("prompt_tokens", response.usage.prompt_tokens or 0)
+            metrics.count("completion_tokens", response.usage.completion_tokens or 0)
+
+
+class ToolCallAssembler:
+    """
+    This class assembles tool calls from streamed completion chunks.
+    A tool call is complete as soon as its arguments parse as a JSON object.
+    """
+
+    def __init__(self):
+        self.content = ""
+        self.calls = {}
+        self.completed = {}
+
+    def add(self, chunk):
+        """add a chunk, returning the tool calls it completed as (index, tool_call) pairs"""
+
+        completed = []
+        for choice in chunk.choices:
+            self.content += choice.delta.content or ""
+            for delta in choice.delta.tool_calls or []:
+                call = self.calls.setdefault(
+                    delta.index, {"id": None, "name": "", "arguments": ""}
+                )
+                if delta.id:
+                    call["id"] = delta.id
+                if delta.function is not None:
+                    call["name"] += delta.function.name or ""
+                    call["arguments"] += delta.function.arguments or ""
+
+                # a JSON object can only parse once its closing brace arrived
+                if delta.index not in self.completed and call["arguments"].endswith("}"):
+                    try:
+                        json.loads(call["arguments"])
+                    except json.JSONDecodeError:
+                        continue
+                    completed.append((delta.index, self.complete(delta.index)))
+
+        return completed
+
+    def finish(self):
+        """return the tool calls that never parsed, so they fail like unstreamed ones"""
+
+        return [
+            (index, self.complete(index))
+            for index in sorted(self.calls)
+            if index not in self.completed
+        ]
+
+    def complete(self, index):
+        """build the tool call object at index"""
+
+        call = self.calls[index]
+        self.completed[index] = ChatCompletionMessageToolCall(
+            id=call["id"],
+            type="function",
+            function={"name": call["name"], "arguments": call["arguments"]},
+        )
+        return self.completed[index]
+
+    def message(self):
+        """build the assistant message of the streamed completion"""
+
+        tool_calls = [self.completed[index] for index in sorted(self.completed)]
+        return ChatCompletionMessage(
+            role="assistant",
+            content=self.content or None,
+            tool_calls=tool_calls or None,
+        )
 
 
 class LLMExtractor:
@@ -14,19 +136,124 @@ class LLMExtractor:
         # copy functions
         self.fhir_tools = fhir_tools
 
-        # set up openai client
-        self.client = OpenAI(api_key=config["OPENAI"]["API_KEY"])
+        # the second completion only produces a natural-language reply; skip it unless configured
+        self.follow_up = config["GENAI"].get("FOLLOW_UP_COMPLETION", True)
 
-    def extract(self, text):
-        """run the LLM model on the text"""
+        # stream the first completion, running tool calls while later ones are generated
+        self.stream = config["GENAI"].get("STREAM", False)
+
+        # optional on-disk cache of first completions
+        self.response_cache = None
+        if "RESPONSE_CACHE" in config["GENAI"]:
+            self.response_cache = ResponseCache(
+                config["GENAI"]["RESPONSE_CACHE"]["PATH"],
+                max_bytes=config["GENAI"]["RESPONSE_CACHE"].get("MAX_BYTES", 512 * 1024 * 1024),
+                replay_only=config["GENAI"]["RESPONSE_CACHE"].get("REPLAY_ONLY", False),
+            )
+
+        # optionally split long notes into overlapping windows extracted in parallel
+        self.chunker = None
+        if "CHUNKING" in config["GENAI"]:
+            self.chunker = NoteChunker(
+                max_chars=config["GENAI"]["CHUNKING"].get("MAX_CHARS", 4000),
+                overlap=config["GENAI"]["CHUNKING"].get("OVERLAP", 1),
+                concurrency=config["GENAI"]["CHUNKING"].get("CONCURRENCY", 4),
+            )
+
+        # optional local pre-router sending each note only the tools it needs
+        self.tool_router = None
+        routing = config["GENAI"].get("TOOL_ROUTING", {})
+        if routing.get("ENABLED", False):
+            self.tool_router = ToolRouter(
+                fhir_tools.tools,
+                lexicon=routing.get("LEXICON"),
+                always=routing.get("ALWAYS"),
+                compact=routing.get("COMPACT", False),
+            )
+
+        # optionally extract several short notes in one request, as many as fit a token budget
+        self.packer = None
+        self.packed_tools = {}
+        packing = config["GENAI"].get("PACKING", {})
+        if packing.get("ENABLED", False):
+            self.packer = NotePacker(
+                config["GENAI"]["SYSTEM_PROMPT"],
+                fhir_tools.tools,
+                token_budget=packing.get("TOKEN_BUDGET", 4000),
+                max_notes=packing.get("MAX_NOTES", 16),
+                completion_tokens=packing.get("COMPLETION_TOKENS", 150),
+            )
+
+        # optional scheduler admitting requests against the account's RPM/TPM limits;
+        # it owns the retries of rate-limited, 5xx, timed out and unconnected requests
+        self.rate_limiter = None
+        max_retries = 2
+        if "RATE_LIMIT" in config["OPENAI"]:
+            self.rate_limiter = RateLimiter(
+                rpm=config["OPENAI"]["RATE_LIMIT"]["RPM"],
+                tpm=config["OPENAI"]["RATE_LIMIT"]["TPM"],
+                completion_tokens=config["OPENAI"]["RATE_LIMIT"].get("COMPLETION_TOKENS", 256),
+            )
+            max_retries = 0
+
+        # set up openai clients, optionally against a compatible endpoint
+        self.client = OpenAI(
+            api_key=config["OPENAI"]["API_KEY"],
+            base_url=config["OPENAI"].get("BASE_URL"),
+            max_retries=max_retries,
+        )
+        self.async_client = AsyncOpenAI(
+            api_key=config["OPENAI"]["API_KEY"],
+            base_url=config["OPENAI"].get("BASE_URL"),
+            max_retries=max_retries,
+        )
 
-        # create initial conversation
-        messages = [
+    def completion_span(self, kwargs):
+        """
+        span timing a completion request; streams are timed by their consumer instead,
+        as their request returns before the completion is generated
+        """
+
+        if kwargs.get("stream"):
+            return NULL_SPAN
+        return metrics.span("completion", stage="first" if "tools" in kwargs else "follow_up")
+
+    def create(self, **kwargs):
+        """request a chat completion, through the rate limiter if configured"""
+
+        with self.completion_span(kwargs):
+            if self.rate_limiter is None:
+                return self.client.chat.completions.create(**kwargs)
+            return self.rate_limiter.call(self.client.chat.completions.create, **kwargs)
+
+    async def acreate(self, **kwargs):
+        """request a chat completion with the async client, through the rate limiter if configured"""
+
+        with self.completion_span(kwargs):
+            if self.rate_limiter is None:
+                return await self.async_client.chat.completions.create(**kwargs)
+            return await self.rate_limiter.acall(
+                self.async_client.chat.completions.create, **kwargs
+            )
+
+    def prompt_date(self):
+        """today's date, or the date pinned in the config"""
+
+        return self.config["GENAI"].get("PROMPT_DATE") or datetime.datetime.now().strftime(
+            "%Y-%m-%d"
+        )
+
+    def system_prompt(self):
+        """system prompt rendered with the prompt date"""
+        return self.config["GENAI"]["SYSTEM_PROMPT"].format(date=self.prompt_date())
+
+    def messages(self, text):
+        """create initial conversation"""
+
+        return [
             {
                 "role": "system",
-                "content": self.config["GENAI"]["SYSTEM_PROMPT"].format(
-                    date=datetime.datetime.now().strftime("%Y-%m-%d")
-                ),
+                "content": self.system_prompt(),
             },
             {
                 "role": "user",
@@ -34,14 +261,213 @@ class LLMExtractor:
             },
         ]
 
-        # initial llm request
-        response = self.client.chat.completions.create(
-            model=self.config["OPENAI"]["MODEL"],
-            messages=messages,
-            tools=self.fhir_tools.tools,
-            tool_choice="auto",
+    def packed_messages(self, texts):
+        """create initial conversation of a packed request"""
+
+        messages = self.messages(pack(texts))
+        messages[0]["content"] += PACKED_PROMPT.format(count=len(texts))
+        return messages
+
+    def tools_for_packed(self, text):
+        """tool schemas with a note_id parameter sent with a packed request"""
+
+        tools = self.tools_for(text)
+        names = tuple(tool["function"]["name"] for tool in tools)
+        if names not in self.packed_tools:
+            self.packed_tools[names] = pack_tools(tools)
+        return self.packed_tools[names]
+
+    def windows(self, text):
+        """windows of the text extracted separately"""
+
+        if self.chunker is None:
+            return [text]
+        return self.chunker.windows(text)
+
+    def merge_windows(self, window_results, context):
+        """
+        combine the results of the windows of a note, merging resources
+        of the same type and SNOMED code found in several windows
+        """
+
+        result = ExtractionResult()
+        resources = []
+        for window_result in window_results:
+            resources.extend(window_result.resources)
+            result.tool_calls.extend(window_result.tool_calls)
+            for key in result.usage:
+                result.usage[key] += window_result.usage[key]
+            result.response = window_result.response
+        result.cached = all(window_result.cached for window_result in window_results)
+
+        # code element of each resource type
+        code_paths = {
+            builder.resource_type: builder.code_path
+            for builder in self.fhir_tools.fhir.builders.values()
+        }
+        for resource in merge_resources(resources, code_paths):
+            context.add(resource)
+        result.resources = context.resources
+
+        return result
+
+    def tools_for(self, text):
+        """tool schemas sent with the text"""
+
+        if self.tool_router is None:
+            return self.fhir_tools.tools
+        return self.tool_router.select(text)
+
+    def cached_response(self, text, tools, result):
+        """
+        look up the first completion of the text in the response cache;
+        returns the cache key and the cached assistant message (or None)
+        """
+
+        if self.response_cache is None:
+            return None, None
+
+        # the key holds the unrendered prompt, so entries are replayed on any date
+        key = ResponseCache.key(
+            self.config["OPENAI"]["MODEL"],
+            self.config["GENAI"]["SYSTEM_PROMPT"],
+            tools,
+            text,
+            {"tool_choice": "auto"},
+        )
+        entry = self.response_cache.get(key)
+        metrics.count("response_cache", result="miss" if entry is None else "hit")
+
+        if entry is None:
+            if self.response_cache.replay_only:
+                raise LookupError(f"no cached response for note (key {key})")
+            return key, None
+
+        # stamp the dates the model took from the prompt with the current prompt date
+        date = self.prompt_date()
+        result.cached = True
+        return key, ChatCompletionMessage(
+            role="assistant",
+            content=render_date(entry["content"], date),
+            tool_calls=[
+                ChatCompletionMessageToolCall(
+                    id=tool_call["id"],
+                    type="function",
+                    function={
+                        "name": tool_call["name"],
+                        "arguments": render_date(tool_call["arguments"], date),
+                    },
+                )
+                for tool_call in entry["tool_calls"]
+            ]
+            or None,
+        )
+
+    def cache_response(self, key, response_message, result):
+        """store the first completion in the response cache"""
+
+        if key is None:
+            return
+
+        # keep the prompt date out of the entry, as it is replayed on other dates
+        date = self.prompt_date()
+        self.response_cache.set(
+            key,
+            {
+                "content": strip_date(response_message.content, date),
+                "tool_calls": [
+                    {
+                        "id": tool_call.id,
+                        "name": tool_call.function.name,
+                        "arguments": strip_date(tool_call.function.arguments, date),
+                    }
+                    for tool_call in response_message.tool_calls or []
+                ],
+                "usage": dict(result.usage),
+            },
         )
-        response_message = response.choices[0].message
+
+    def tool_message(self, result, tool_call, function_response):
+        """record a tool call outcome and create its conversation message"""
+
+        result.tool_calls.append(
+            {
+                "id": tool_call.id,
+                "name": tool_call.function.name,
+                "arguments": tool_call.function.arguments,
+                "output": function_response,
+            }
+        )
+
+        return {
+            "tool_call_id": tool_call.id,
+            "role": "tool",
+            "name": tool_call.function.name,
+            "content": function_response,
+        }
+
+    def extract(self, text, context=None):
+        """run the LLM model on the text"""
+
+        with metrics.span("extraction"):
+            # collect resources of this note in its own context
+            if context is None:
+                context = ExtractionContext()
+
+            # extract windows of long notes in parallel
+            windows = self.windows(text)
+            if len(windows) > 1:
+                with ThreadPoolExecutor(self.chunker.concurrency) as executor:
+                    window_contexts = [
+                        ExtractionContext(context.note_id, context.annotations) for _ in windows
+                    ]
+                    window_results = list(
+                        executor.map(self.extract_text, windows, window_contexts)
+                    )
+                result = self.merge_windows(window_results, context)
+            else:
+                result = self.extract_text(text, context)
+
+            # hand the resources of the note to the FHIR sinks
+            self.fhir_tools.fhir.publish(result.resources, context.note_id)
+
+            return result
+
+    def extract_text(self, text, context):
+        """run the LLM model on one text, a note or a window of it"""
+
+        result = ExtractionResult()
+
+        # create initial conversation with the tools the note needs
+        messages = self.messages(text)
+        tools = self.tools_for(text)
+
+        # replay a cached first completion if there is one
+        key, response_message = self.cached_response(text, tools, result)
+
+        # initial llm request, applying all function calls in parallel
+        if response_message is not None:
+            function_responses = self.fhir_tools.run_all(
+                response_message.tool_calls or [], context
+            )
+        elif self.stream:
+            response_message, function_responses = self.stream_tool_calls(
+                messages, tools, result, context
+            )
+            self.cache_response(key, response_message, result)
+        else:
+            response = self.create(
+                model=self.config["OPENAI"]["MODEL"],
+                messages=messages,
+                tools=tools,
+                tool_choice="auto",
+            )
+            result.add_usage(response)
+            response_message = response.choices[0].message
+            self.cache_response(key, response_message, result)
+            function_responses = self.fhir_tools.run_all(
+                response_message.tool_calls or [], context
+            )
         tool_calls = response_message.tool_calls
 
         # check if the model wanted to call a function
@@ -49,28 +475,320 @@ class LLMExtractor:
             # extend conversation with assistant's reply
             messages.append(response_message)
 
-            # apply all function calls
-            for tool_call in tool_calls:
-                # run the function call
-                function_response = self.fhir_tools.run(tool_call)
+            # extend conversation with function responses
+            for tool_call, function_response in zip(tool_calls, function_responses):
+                messages.append(self.tool_message(result, tool_call, function_response))
 
-                # extend conversation with function response
-                messages.append(
-                    {
-                        "tool_call_id": tool_call.id,
-                        "role": "tool",
-                        "name": tool_call.function.name,
-                        "content": function_response,
-                    }
+            # send the conversation back to the model (not for replayed responses)
+            if self.follow_up and not result.cached:
+                second_response = self.create(
+                    model=self.config["OPENAI"]["MODEL"],
+                    messages=messages,
+                )
+                result.add_usage(second_response)
+
+        result.resources = context.resources
+
+        return result
+
+    async def aextract(self, text, context=None):
+        """run the LLM model on the text using the async OpenAI client"""
+
+        with metrics.span("extraction"):
+            # collect resources of this note in its own context
+            if context is None:
+                context = ExtractionContext()
+
+            # extract windows of long notes in parallel
+            windows = self.windows(text)
+            if len(windows) > 1:
+                semaphore = asyncio.Semaphore(self.chunker.concurrency)
+
+                async def extract_window(window):
+                    async with semaphore:
+                        return await self.aextract_text(
+                            window, ExtractionContext(context.note_id, context.annotations)
+                        )
+
+                window_results = await asyncio.gather(
+                    *(extract_window(window) for window in windows)
+                )
+                result = self.merge_windows(window_results, context)
+            else:
+                result = await self.aextract_text(text, context)
+
+            # hand the resources of the note to the FHIR sinks
+            await self.fhir_tools.fhir.apublish(result.resources, context.note_id)
+
+            return result
+
+    async def aextract_text(self, text, context):
+        """run the LLM model on one text, a note or a window of it, using the async OpenAI client"""
+
+        result = ExtractionResult()
+
+        # create initial conversation with the tools the note needs
+        messages = self.messages(text)
+        tools = self.tools_for(text)
+
+        # replay a cached first completion if there is one
+        key, response_message = self.cached_response(text, tools, result)
+
+        # initial llm request, applying all function calls in parallel
+        if response_message is not None:
+            function_responses = await self.fhir_tools.arun_all(
+                response_message.tool_calls or [], context
+            )
+        elif self.stream:
+            response_message, function_responses = await self.astream_tool_calls(
+                messages, tools, result, context
+            )
+            self.cache_response(key, response_message, result)
+        else:
+            response = await self.acreate(
+                model=self.config["OPENAI"]["MODEL"],
+                messages=messages,
+                tools=tools,
+                tool_choice="auto",
+            )
+            result.add_usage(response)
+            response_message = response.choices[0].message
+            self.cache_response(key, response_message, result)
+            function_responses = await self.fhir_tools.arun_all(
+                response_message.tool_calls or [], context
+            )
+        tool_calls = response_message.tool_calls
+
+        # check if the model wanted to call a function
+        if tool_calls:
+            # extend conversation with assistant's reply
+            messages.append(response_message)
+
+            # extend conversation with function responses
+            for tool_call, function_response in zip(tool_calls, function_responses):
+                messages.append(self.tool_message(result, tool_call, function_response))
+
+            # send the conversation back to the model (not for replayed responses)
+            if self.follow_up and not result.cached:
+                second_response = await self.acreate(
+                    model=self.config["OPENAI"]["MODEL"],
+                    messages=messages,
                 )
+                result.add_usage(second_response)
 
-            # send the conversation back to the model
-            second_response = self.client.chat.completions.create(
+        result.resources = context.resources
+
+        return result
+
+    def stream_tool_calls(self, messages, tools, result, context):
+        """
+        request the first completion as a stream and hand every tool call to FHIRTools
+        as soon as its arguments are complete, while the later ones are still generated
+        """
+
+        assembler = ToolCallAssembler()
+        dispatched = {}
+
+        def dispatch(index, tool_call):
+            tool_context = ExtractionContext(context.note_id, context.annotations)
+            future = self.fhir_tools.executor.submit(self.fhir_tools.run, tool_call, tool_context)
+            dispatched[index] = (future, tool_context)
+
+        # the completion span ends with the last chunk of the stream
+        with metrics.span("completion", stage="first"):
+            stream = self.create(
                 model=self.config["OPENAI"]["MODEL"],
                 messages=messages,
+                tools=tools,
+                tool_choice="auto",
+                stream=True,
+                stream_options={"include_usage": True},
             )
+            for chunk in stream:
+                if chunk.usage is not None:
+                    result.add_usage(chunk)
+                for index, tool_call in assembler.add(chunk):
+                    dispatch(index, tool_call)
+        for index, tool_call in assembler.finish():
+            dispatch(index, tool_call)
+
+        # collect responses and resources in tool call order
+        indexes = sorted(dispatched)
+        function_responses = [dispatched[index][0].result() for index in indexes]
+        self.fhir_tools.merge([dispatched[index][1] for index in indexes], context)
+
+        return assembler.message(), function_responses
+
+    async def astream_tool_calls(self, messages, tools, result, context):
+        """
+        request the first completion as a stream and hand every tool call to FHIRTools
+        as soon as its arguments are complete, while the later ones are still generated
+        """
+
+        assembler = ToolCallAssembler()
+        dispatched = {}
+        loop = asyncio.get_running_loop()
+
+        def dispatch(index, tool_call):
+            tool_context = ExtractionContext(context.note_id, context.annotations)
+            future = loop.run_in_executor(
+                self.fhir_tools.executor, self.fhir_tools.run, tool_call, tool_context
+            )
+            dispatched[index] = (future, tool_context)
+
+        # the completion span ends with the last chunk of the stream
+        with metrics.span("completion", stage="first"):
+            stream = await self.acreate(
+                model=self.config["OPENAI"]["MODEL"],
+                messages=messages,
+                tools=tools,
+                tool_choice="auto",
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    result.add_usage(chunk)
+                for index, tool_call in assembler.add(chunk):
+                    dispatch(index, tool_call)
+        for index, tool_call in assembler.finish():
+            dispatch(index, tool_call)
+
+        # collect responses and resources in tool call order
+        indexes = sorted(dispatched)
+        function_responses = await asyncio.gather(
+            *(dispatched[index][0] for index in indexes)
+        )
+        self.fhir_tools.merge([dispatched[index][1] for index in indexes], context)
 
-            return second_response
+        return assembler.message(), list(function_responses)
 
+    async def aextract_packed(self, texts, contexts):
+        """
+        run the LLM model on several notes in one request using the async OpenAI client;
+        tool calls are demultiplexed by their note_id into one result per note, whose
+        resources the caller publishes once the whole request succeeded
+        """
+
+        with metrics.span("packed_extraction"):
+            result = ExtractionResult()
+
+            # create initial conversation of all notes with the tools they need
+            text = pack(texts)
+            messages = self.packed_messages(texts)
+            tools = self.tools_for_packed(text)
+
+            # replay a cached first completion if there is one
+            key, response_message = self.cached_response(text, tools, result)
+
+            # initial llm request, applying all function calls in parallel
+            if response_message is None:
+                response = await self.acreate(
+                    model=self.config["OPENAI"]["MODEL"],
+                    messages=messages,
+                    tools=tools,
+                    tool_choice="auto",
+                )
+                result.add_usage(response)
+                response_message = response.choices[0].message
+                self.cache_response(key, response_message, result)
+            tool_calls = response_message.tool_calls or []
+            function_responses, indexes = await self.fhir_tools.arun_packed(
+                tool_calls, contexts, texts
+            )
+
+            # record tool calls in the result of their note
+            results = [ExtractionResult(cached=result.cached) for _ in texts]
+            if tool_calls:
+                # extend conversation with assistant's reply
+                messages.append(response_message)
+
+                # extend conversation with function responses
+                for tool_call, function_response, index in zip(
+                    tool_calls, function_responses, indexes
+                ):
+                    note_result = result if index is None else results[index]
+                    messages.append(self.tool_message(note_result, tool_call, function_response))
+
+                # send the conversation back to the model (not for replayed responses)
+                if self.follow_up and not result.cached:
+                    second_response = await self.acreate(
+                        model=self.config["OPENAI"]["MODEL"],
+                        messages=messages,
+                    )
+                    result.add_usage(second_response)
+
+            # share the token usage of the request among its notes
+            for note_result, context in zip(results, contexts):
+                note_result.resources = context.resources
+                note_result.response = result.response
+                for name in note_result.usage:
+                    note_result.usage[name] = result.usage[name] // len(texts)
+            for name in result.usage:
+                results[0].usage[name] += result.usage[name] % len(texts)
+
+            return results
+
+    def packable(self, text):
+        """whether a note can share a request with others"""
+
+        return len(self.windows(text)) == 1
+
+    async def extract_many(self, notes, max_concurrency=8, note_ids=None):
+        """
+        This function runs the extraction on many notes, keeping max_concurrency requests
+        in flight. With packing, short notes are extracted several to a request.
+        Results are returned in input order; a note that failed gets its exception instead.
+        Notes are identified by note_ids if given, by their position otherwise.
+        """
+
+        notes = list(notes)
+        note_ids = list(range(len(notes))) if note_ids is None else list(note_ids)
+        results = [None] * len(notes)
+
+        # one note per request, or packed requests of several notes
+        if self.packer is None:
+            batches = [[i] for i in range(len(notes))]
         else:
-            return response
+            batches = self.packer.batches(notes, self.packable)
+        queue = iter(batches)
+
+        async def extract_one(i):
+            try:
+                context = ExtractionContext(note_id=note_ids[i])
+                results[i] = await self.aextract(notes[i], context)
+            except Exception as e:
+                logging.exception(f"extraction of note {note_ids[i]} failed")
+                results[i] = e
+
+        async def worker():
+            # pull the next request until all notes are taken
+            for batch in queue:
+                if len(batch) == 1:
+                    await extract_one(batch[0])
+                    continue
+
+                # notes of a packed request share their annotations
+                annotations = {}
+                contexts = [ExtractionContext(note_ids[i], annotations) for i in batch]
+                try:
+                    packed = await self.aextract_packed([notes[i] for i in batch], contexts)
+                except Exception:
+                    # fall back to one request per note; nothing of the request was published
+                    logging.exception(f"packed extraction of {len(batch)} notes failed")
+                    for i in batch:
+                        await extract_one(i)
+                    continue
+
+                # hand the resources of every note to the FHIR sinks
+                for i, result in zip(batch, packed):
+                    try:
+                        await self.fhir_tools.fhir.apublish(result.resources, note_ids[i])
+                        results[i] = result
+                    except Exception as e:
+                        logging.exception(f"publishing note {note_ids[i]} failed")
+                        results[i] = e
+
+        await asyncio.gather(*(worker() for _ in range(max(1, max_concurrency))))
+
+        return results
@@ -0,0 +1,200 @@
+import time
+import threading
+import contextlib
+from collections import defaultdict
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+# span returned while metrics are disabled
+NULL_SPAN = contextlib.nullcontext()
+
+
+class MetricsHook:
+    """
+    This class is the interface of metrics consumers.
+    Subclasses override the events they are interested in.
+    """
+
+    def on_span(self, name, seconds, labels):
+        """called with the duration of a finished span"""
+
+    def on_count(self, name, value, labels):
+        """called when a counter is incremented"""
+
+    def on_gauge(self, name, value, labels):
+        """called when a gauge is set"""
+
+
+class Span:
+    """
+    This class times a block of code and reports it to the hooks when it exits.
+    """
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self.start
+        for hook in self.metrics.hooks:
+            hook.on_span(self.name, seconds, self.labels)
+
+
+class PrometheusExporter(MetricsHook):
+    """
+    This class aggregates spans into latency histograms, counters into totals
+    and gauges into their last value, and renders them in the Prometheus text exposition format.
+    """
+
+    def __init__(self, namespace="gpt_fhir"):
+        self.namespace = namespace
+        self.histograms = defaultdict(lambda: [[0] * len(BUCKETS), 0.0])
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def on_span(self, name, seconds, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms[key]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+
+    def on_count(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def on_gauge(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def render(self):
+        """
+        This function returns all metrics in the Prometheus text format.
+        """
+
+        def format_labels(labels, **extra):
+            labels = [*labels, *extra.items()]
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+
+        # span latencies as histograms
+        seen = set()
+        for (name, labels), (buckets, total) in histograms:
+            metric = f"{self.namespace}_{name}_seconds"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            for bound, count in zip(BUCKETS, buckets):
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{metric}_bucket{format_labels(labels, le=le)} {count}")
+            lines.append(f"{metric}_sum{format_labels(labels)} {total}")
+            lines.append(f"{metric}_count{format_labels(labels)} {buckets[-1]}")
+
+        # counters as totals
+        for (name, labels), value in counters:
+            metric = f"{self.namespace}_{name}_total"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{format_labels(labels)} {value:g}")
+
+        # gauges as their last value
+        for (name, labels), value in gauges:
+            metric = f"{self.namespace}_{name}"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric}{format_labels(labels)} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+
+class Metrics:
+    """
+    This class is the entry point of the instrumentation: code opens spans around
+    the stages of an extraction and increments counters, and every event is passed
+    to the registered hooks. While disabled, spans and counters cost a single check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.hooks = []
+        self.exporter = None
+
+    def enable(self, exporter=True):
+        """
+        This function turns the instrumentation on,
+        by default with a Prometheus exporter.
+        """
+
+        if exporter and self.exporter is None:
+            self.exporter = PrometheusExporter()
+            self.hooks.append(self.exporter)
+        self.enabled = True
+
+    def disable(self):
+        """
+        This function turns the instrumentation off.
+        """
+
+        self.enabled = False
+
+    def add_hook(self, hook):
+        """register a metrics consumer"""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """unregister a metrics consumer"""
+        self.hooks.remove(hook)
+
+    def span(self, name, **labels):
+        """time a block of code as the stage name"""
+
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, labels)
+
+    def count(self, name, value=1, **labels):
+        """increment the counter name"""
+
+        if not self.enabled:
+            return
+        for hook in self.hooks:
+            hook.on_count(name, value, labels)
+
+    def gauge(self, name, value, **labels):
+        """set the gauge name to value"""
+
+        if not self.enabled:
+            return
+        for hook in self.hooks:
+            hook.on_gauge(name, value, labels)
+
+    def render(self):
+        """
+        This function returns the metrics of the Prometheus exporter.
+        """
+
+        return self.exporter.render() if self.exporter is not None else ""
+
+
+# instrumentation shared by all extraction stacks of the process
+metrics = Metrics()
@@ -0,0 +1,566 @@
+import ast
+import json
+import time
+import random
+import datetime
+import threading
+import multiprocessing
+import email.policy
+from email.parser import BytesParser
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from gpt_fhir.snomedIndex import normalize
+from gpt_fhir.notePacker import NOTE_ID_PARAMETER, unpack
+from gpt_fhir.rateLimiter import estimate_prompt_tokens
+from gpt_fhir.resourceBuilder import DEFAULT_RESOURCES
+
+# log line: "2023-12-27 19:23:38,744 INFO FROM LLM: {...}"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S,%f"
+
+
+def parse_trace(path, resources=None):
+    """
+    This function reads a logs.txt-style trace of an extraction run into the material
+    of the mock servers: the tool calls made for every note, the SNOMED annotation
+    chosen for every term, and the observed latencies of the first completion,
+    the OLS lookups and the follow-up completion (in seconds).
+    """
+
+    # tool of each code parameter
+    resources = resources or DEFAULT_RESOURCES
+    tools = {mapping["code"]["parameter"]: name for name, mapping in resources.items()}
+    code_paths = {
+        mapping["code"]["parameter"]: mapping["code"]["path"] for mapping in resources.values()
+    }
+
+    trace = {
+        "notes": {},
+        "annotations": {},
+        "latency": {"completion": [], "annotation": [], "follow_up": []},
+    }
+    note = None
+    params = None
+    requests = 0
+    last = None
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                timestamp = datetime.datetime.strptime(line[:23], TIMESTAMP_FORMAT).timestamp()
+            except ValueError:
+                continue
+            message = line[23:].split(" ", 2)[-1].rstrip("\n")
+
+            # a new note starts its first completion
+            if message.startswith("NOTE: "):
+                note = message[len("NOTE: ") :]
+                trace["notes"][note] = []
+                requests = 0
+                last = timestamp
+
+            # a finished completion: the first one after the note, then the follow-up
+            elif message.startswith("HTTP Request: POST") and "chat/completions" in message:
+                if note is not None and last is not None:
+                    stage = "completion" if requests == 0 else "follow_up"
+                    trace["latency"][stage].append(timestamp - last)
+                requests += 1
+                last = None
+
+            # tool call parameters, followed by the resource built from them
+            elif message.startswith("FROM LLM: ") and note is not None:
+                params = ast.literal_eval(message[len("FROM LLM: ") :])
+                last = timestamp
+
+            elif message.startswith("FHIR: ") and params is not None:
+                resource = ast.literal_eval(message[len("FHIR: ") :])
+                parameter = next((key for key in params if key in tools), None)
+                if parameter is not None:
+                    trace["notes"][note].append(
+                        {"name": tools[parameter], "term": params[parameter], "arguments": params}
+                    )
+                    coding = resource.get(code_paths[parameter], {}).get("coding", [{}])[0]
+                    if "code" in coding:
+                        trace["annotations"][normalize(params[parameter])] = [
+                            {
+                                "iri": f"http://snomed.info/id/{coding['code']}",
+                                "obo_id": f"SNOMED:{coding['code']}",
+                                "label": coding.get("display", params[parameter]),
+                            }
+                        ]
+                    trace["latency"]["annotation"].append(timestamp - last)
+                params = None
+                last = timestamp
+
+    return trace
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """
+    This class answers chat completion, batch, file and OLS search requests
+    from a recorded trace.
+    """
+
+    # quiet the default request logging
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        # batch status and file contents
+        if "/batches/" in url.path:
+            batch = self.server.mock.retrieve_batch(url.path.rsplit("/", 1)[1])
+            return self.send_json(batch) if batch else self.send_json({"error": "not found"}, 404)
+        if url.path.endswith("/content") and "/files/" in url.path:
+            data = self.server.mock.files.get(url.path.split("/")[-2], {}).get("content")
+            if data is None:
+                return self.send_json({"error": "not found"}, 404)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            return self.wfile.write(data)
+
+        if not url.path.endswith("/api/search"):
+            return self.send_json({"error": "not found"}, 404)
+
+        # OLS search
+        query = parse_qs(url.query).get("q", [""])[0]
+        self.server.mock.sleep("annotation")
+        docs = self.server.mock.trace["annotations"].get(normalize(query), [])
+        self.send_json({"response": {"numFound": len(docs), "start": 0, "docs": docs}})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+
+        # uploads of batch input files
+        if path.endswith("/files"):
+            return self.send_json(self.server.mock.upload(self.headers["Content-Type"], body))
+
+        request = json.loads(body)
+
+        # FHIR transaction/batch Bundles
+        if path.rstrip("/").endswith("/fhir"):
+            return self.send_json(*self.server.mock.process_bundle(request))
+
+        # batches of chat completions
+        if path.endswith("/batches"):
+            return self.send_json(self.server.mock.create_batch(request))
+
+        if not path.endswith("/chat/completions"):
+            return self.send_json({"error": "not found"}, 404)
+
+        # notes made to fail are rejected
+        text = next(m["content"] for m in reversed(request["messages"]) if m["role"] == "user")
+        if normalize(text) in self.server.mock.failing_notes:
+            error = {"message": "the note was rejected", "type": "invalid_request_error"}
+            return self.send_json({"error": error}, 400)
+
+        # the first completion gets tool calls, the follow-up a text reply
+        follow_up = any(message.get("role") == "tool" for message in request["messages"])
+        self.server.mock.sleep("follow_up" if follow_up else "completion")
+        completion = self.server.mock.completion(request)
+        if not request.get("stream"):
+            return self.send_json(completion)
+
+        # server-sent events, one chunk per tool call
+        message = completion["choices"][0]["message"]
+        deltas = [
+            {"tool_calls": [{"index": i, **call}]}
+            for i, call in enumerate(message.get("tool_calls", []))
+        ]
+        if message["content"]:
+            deltas.append({"role": "assistant", "content": message["content"]})
+        base = {key: completion[key] for key in ("id", "created", "model")}
+        chunks = [
+            {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta}]}
+            for delta in deltas
+        ]
+        chunks.append(
+            {**base, "object": "chat.completion.chunk", "choices": [], "usage": completion["usage"]}
+        )
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+class MockServers:
+    """
+    This class runs local stand-ins of the OpenAI chat completions endpoint and the
+    OLS search endpoint, answering with the tool calls, annotations and latencies
+    recorded in a trace (see parse_trace). Latencies are sampled from the recorded ones
+    and multiplied by latency_scale, so benchmarks run without OpenAI and EBI.
+    A FHIR endpoint accepts transaction and batch Bundles, rejecting resources without
+    a subject, and counts the resources it stored (conditional creates only once);
+    the next Bundles are answered with the errors queued in fhir_errors as (status, headers, stored) tuples, after storing the
+    Bundle if stored is set (as when a gateway loses the response). The files and batches endpoints run
+    uploaded Batch API inputs through the same completions: a batch is in progress for
+    batch_polls status checks, then ends in batch_status, and requests whose note is in
+    failing_notes are written to its error file (chat completions of them are rejected).
+    """
+
+    def __init__(self, trace, latency_scale=1.0, seed=0, port=0, process=False):
+        # copy settings
+        self.trace = trace
+        self.latency_scale = latency_scale
+        self.random = random.Random(seed)
+
+        # serve from a forked process, so the servers do not compete with the measured code
+        self.process = process
+
+        # tool calls by normalized note text
+        self.notes = {normalize(note): calls for note, calls in trace["notes"].items()}
+
+        # resources stored by the FHIR endpoint, by type
+        self.stored = {}
+        self.bundles = 0
+
+        # ifNoneExist searches of the stored resources, so conditional creates store once
+        self.conditions = set()
+        self.fhir_errors = []
+        self.lock = threading.Lock()
+
+        # uploaded files and submitted batches of the Batch API stand-in
+        self.files = {}
+        self.batches = {}
+        self.batch_polls = 1
+        self.batch_status = "completed"
+        self.failing_notes = set()
+
+        # set up the HTTP server
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.worker = None
+
+    @property
+    def openai_url(self):
+        """base URL of the OpenAI stand-in"""
+        return f"http://127.0.0.1:{self.server.server_port}/v1"
+
+    @property
+    def fhir_url(self):
+        """base URL of the FHIR stand-in"""
+        return f"http://127.0.0.1:{self.server.server_port}/fhir"
+
+    @property
+    def ols_url(self):
+        """base URL of the OLS stand-in"""
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def sleep(self, stage):
+        """wait for a latency sampled from the trace"""
+
+        latencies = self.trace["latency"].get(stage)
+        if latencies and self.latency_scale:
+            time.sleep(self.random.choice(latencies) * self.latency_scale)
+
+    def process_bundle(self, bundle):
+        """
+        This function processes a transaction or batch Bundle, returning the response
+        Bundle (or OperationOutcome), its HTTP status and its headers.
+        """
+
+        def outcome(message):
+            return {
+                "resourceType": "OperationOutcome",
+                "issue": [{"severity": "error", "code": "required", "diagnostics": message}],
+            }
+
+        # queued errors answer the next Bundles, stored or not
+        with self.lock:
+            error = self.fhir_errors.pop(0) if self.fhir_errors else None
+        if error is not None:
+            status, headers, stored = error
+            if stored:
+                self.process_bundle(bundle)
+            return outcome(f"error {status}"), status, headers
+
+        # validate the entries; conditional creates of stored resources only match them
+        responses = []
+        for entry in bundle.get("entry", []):
+            resource = entry.get("resource", {})
+            if "subject" not in resource:
+                responses.append(
+                    {"status": "400 Bad Request", "outcome": outcome("subject is required")}
+                )
+            elif entry.get("request", {}).get("ifNoneExist") in self.conditions:
+                responses.append({"status": "200 OK"})
+            else:
+                responses.append({"status": "201 Created"})
+
+        # a transaction is stored as a whole or not at all
+        failed = [response for response in responses if response["status"][0] != "2"]
+
+        if bundle.get("type") == "transaction" and failed:
+            return outcome(f"{len(failed)} invalid entries"), 400, None
+
+        with self.lock:
+            self.bundles += 1
+            for entry, response in zip(bundle.get("entry", []), responses):
+                if response["status"] == "201 Created":
+                    resource_type = entry["resource"]["resourceType"]
+                    self.stored[resource_type] = self.stored.get(resource_type, 0) + 1
+                    response["location"] = (
+                        f"{resource_type}/{self.stored[resource_type]}/_history/1"
+                    )
+                    if "ifNoneExist" in entry.get("request", {}):
+                        self.conditions.add(entry["request"]["ifNoneExist"])
+
+        return {
+            "resourceType": "Bundle",
+            "type": f"{bundle.get('type', 'batch')}-response",
+            "entry": [{"response": response} for response in responses],
+        }, 200, None
+
+    def tool_calls(self, text):
+        """
+        This function returns the recorded tool calls of a text: those of the note itself,
+        or of all recorded notes contained in it, or else those whose terms it mentions.
+        The calls of every note of a packed request carry its number as note_id.
+        """
+
+        notes = unpack(text)
+        if notes:
+            return [
+                {**call, "arguments": {**call["arguments"], NOTE_ID_PARAMETER: number}}
+                for number, note in enumerate(notes, start=1)
+                for call in self.tool_calls(note)
+            ]
+
+        text = normalize(text)
+        if text in self.notes:
+            return self.notes[text]
+
+        contained = [call for note, calls in self.notes.items() if note in text for call in calls]
+        if contained:
+            return contained
+
+        return [
+            call
+            for calls in self.notes.values()
+            for call in calls
+            if normalize(call["term"]) in text
+        ]
+
+    def completion(self, request):
+        """
+        This function returns the chat completion of a request: the recorded tool calls
+        of its note for a first completion, a text reply for the follow-up.
+        """
+
+        messages = request["messages"]
+        follow_up = any(message.get("role") == "tool" for message in messages)
+        tool_calls = []
+        if request.get("tools") and not follow_up:
+            text = next(m["content"] for m in reversed(messages) if m.get("role") == "user")
+            names = {tool["function"]["name"] for tool in request["tools"]}
+            tool_calls = [
+                {
+                    "id": f"call_{i}",
+                    "type": "function",
+                    "function": {
+                        "name": tool_call["name"],
+                        "arguments": json.dumps(tool_call["arguments"]),
+                    },
+                }
+                for i, tool_call in enumerate(
+                    call for call in self.tool_calls(text) if call["name"] in names
+                )
+            ]
+
+        message = {"role": "assistant", "content": None}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        else:
+            message["content"] = "The FHIR resources were extracted."
+        prompt_tokens = estimate_prompt_tokens(messages, request.get("tools"))
+        completion_tokens = sum(len(call["function"]["arguments"]) for call in tool_calls) // 4 + 10
+
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": "tool_calls" if tool_calls else "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def add_file(self, content, filename, purpose):
+        """store a file, returning its file object"""
+
+        with self.lock:
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = {
+                "id": file_id,
+                "object": "file",
+                "bytes": len(content),
+                "created_at": int(time.time()),
+                "filename": filename,
+                "purpose": purpose,
+                "status": "processed",
+                "content": content,
+            }
+        return {key: value for key, value in self.files[file_id].items() if key != "content"}
+
+    def upload(self, content_type, body):
+        """
+        This function stores a multipart/form-data file upload.
+        """
+
+        message = BytesParser(policy=email.policy.default).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body
+        )
+        fields = {
+            part.get_param("name", header="content-disposition"): part
+            for part in message.iter_parts()
+        }
+
+        return self.add_file(
+            fields["file"].get_payload(decode=True),
+            fields["file"].get_filename() or "upload.jsonl",
+            fields["purpose"].get_content().strip(),
+        )
+
+    def create_batch(self, request):
+        """
+        This function runs the requests of an uploaded batch input file
+        and keeps their results for when the batch completes.
+        """
+
+        lines = self.files[request["input_file_id"]]["content"].decode("utf-8").splitlines()
+        outputs, errors = [], []
+        for line in filter(None, lines):
+            line = json.loads(line)
+            body = line["body"]
+            text = next(m["content"] for m in reversed(body["messages"]) if m["role"] == "user")
+            if normalize(text) in self.failing_notes:
+                response = {"status_code": 500, "body": {"error": {"message": "server error"}}}
+                errors.append({"custom_id": line["custom_id"], "response": response})
+            else:
+                response = {"status_code": 200, "body": self.completion(body)}
+                outputs.append({"custom_id": line["custom_id"], "response": response})
+
+        with self.lock:
+            batch_id = f"batch_{len(self.batches) + 1}"
+            self.batches[batch_id] = {
+                "batch": {
+                    "id": batch_id,
+                    "object": "batch",
+                    "endpoint": request["endpoint"],
+                    "input_file_id": request["input_file_id"],
+                    "completion_window": request["completion_window"],
+                    "status": "in_progress",
+                    "created_at": int(time.time()),
+                    "request_counts": {
+                        "total": len(outputs) + len(errors),
+                        "completed": len(outputs),
+                        "failed": len(errors),
+                    },
+                },
+                "outputs": outputs,
+                "errors": errors,
+                "polls": 0,
+            }
+
+        return self.batches[batch_id]["batch"]
+
+    def retrieve_batch(self, batch_id):
+        """
+        This function returns a batch, finishing it once it was polled batch_polls times.
+        A completed or expired batch gets its output and error files.
+        """
+
+        with self.lock:
+            state = self.batches.get(batch_id)
+            if state is None:
+                return None
+            batch = state["batch"]
+            state["polls"] += 1
+            if batch["status"] != "in_progress" or state["polls"] <= self.batch_polls:
+                return batch
+            batch["status"] = self.batch_status
+
+        # requests of an expired batch are not run, and end up in its error file
+        outputs, errors = state["outputs"], state["errors"]
+        if batch["status"] == "expired":
+            errors = errors + [
+                {
+                    "custom_id": line["custom_id"],
+                    "response": None,
+                    "error": {"code": "batch_expired", "message": "the batch expired"},
+                }
+                for line in outputs
+            ]
+            outputs = []
+
+        if batch["status"] in ("completed", "expired"):
+            for key, lines in (("output_file_id", outputs), ("error_file_id", errors)):
+                if lines:
+                    content = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+                    output = self.add_file(content, f"{batch_id}_{key}.jsonl", "batch_output")
+                    batch[key] = output["id"]
+        elif batch["status"] == "failed":
+            batch["errors"] = {
+                "object": "list",
+                "data": [{"code": "invalid_request", "message": "the batch input is invalid"}],
+            }
+
+        return batch
+
+    def start(self):
+        """
+        This function starts serving in a background thread or process.
+        """
+
+        if self.process:
+            self.worker = multiprocessing.get_context("fork").Process(
+                target=self.server.serve_forever, daemon=True
+            )
+        else:
+            self.worker = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.worker.start()
+        return self
+
+    def stop(self):
+        """
+        This function stops the servers.
+        """
+
+        if self.process:
+            self.worker.terminate()
+            self.worker.join()
+        else:
+            self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,131 @@
+import re
+
+# section headings on a line of their own, e.g. "HOSPITAL COURSE:" or "Medications:"
+HEADING = re.compile(r"^\s*[A-Za-z][A-Za-z /&()-]{1,60}:\s*$")
+
+# sentence ends followed by the start of the next sentence
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9(\"'])")
+
+
+def split_sections(text):
+    """split a note into sections at blank lines and heading lines"""
+
+    sections = []
+    lines = []
+    for line in text.splitlines():
+        if (not line.strip() or HEADING.match(line)) and lines:
+            sections.append("\n".join(lines))
+            lines = []
+        if line.strip():
+            lines.append(line)
+    if lines:
+        sections.append("\n".join(lines))
+
+    return sections
+
+
+def split_sentences(section):
+    """split a section into sentences"""
+
+    return [sentence for sentence in SENTENCE_END.split(section) if sentence.strip()]
+
+
+def merge_attributes(target, resource):
+    """
+    merge the elements of a duplicate resource into the first one:
+    missing elements are added, lists are extended by new items, objects are merged,
+    and elements present in both keep the first value
+    """
+
+    for key, value in resource.items():
+        if key not in target:
+            target[key] = value
+        elif isinstance(value, list) and isinstance(target[key], list):
+            target[key] = target[key] + [item for item in value if item not in target[key]]
+        elif isinstance(value, dict) and isinstance(target[key], dict):
+            merge_attributes(target[key], value)
+
+
+def merge_resources(resources, code_paths):
+    """
+    This function deduplicates resources extracted from overlapping windows.
+    Resources of the same type with the same SNOMED code are merged into the first one;
+    code_paths maps each resource type to the element holding its code.
+    """
+
+    merged = []
+    seen = {}
+    for resource in resources:
+        # identify the resource by its type and SNOMED code
+        code = resource.get(code_paths.get(resource["resourceType"]), {})
+        codes = tuple(sorted(coding["code"] for coding in code.get("coding", [])))
+        if not codes:
+            merged.append(resource)
+            continue
+        key = (resource["resourceType"], codes)
+
+        if key in seen:
+            target = seen[key]
+            merge_attributes(target, resource)
+
+            # keep the element order of the resource builders
+            elements = sorted(item for item in target.items() if item[0] != "resourceType")
+            resource_type = target["resourceType"]
+            target.clear()
+            target.update(elements)
+            target["resourceType"] = resource_type
+        else:
+            seen[key] = resource
+            merged.append(resource)
+
+    return merged
+
+
+class NoteChunker:
+    """
+    This class splits long notes into overlapping windows of whole sentences.
+    Windows follow section boundaries where possible, and each one repeats the last
+    sentences of the previous window, so findings on a boundary are seen in full.
+    """
+
+    def __init__(self, max_chars=4000, overlap=1, concurrency=4):
+        # copy settings
+        self.max_chars = max_chars
+        self.overlap = overlap
+
+        # windows of a note extracted in parallel
+        self.concurrency = concurrency
+
+    def windows(self, text):
+        """
+        This function returns the windows of a note.
+        Notes up to max_chars are a single window, so they are extracted as a whole.
+        """
+
+        if len(text) <= self.max_chars:
+            return [text]
+
+        windows = []
+        window = []
+        size = 0
+        for section in split_sections(text):
+            # a section that fits starts a new window rather than being cut
+            start_section = len(section) <= self.max_chars and size + len(section) > self.max_chars
+
+            for i, sentence in enumerate(split_sentences(section)):
+                if window and (size + len(sentence) > self.max_chars or (i == 0 and start_section)):
+                    windows.append(" ".join(window))
+
+                    # carry over the last sentences, if they leave room for the next one
+                    window = window[-self.overlap :] if self.overlap else []
+                    size = sum(len(carried) + 1 for carried in window)
+                    if size + len(sentence) > self.max_chars:
+                        window, size = [], 0
+
+                window.append(sentence)
+                size += len(sentence) + 1
+
+        if window:
+            windows.append(" ".join(window))
+
+        return windows
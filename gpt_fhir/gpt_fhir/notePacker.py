@@ -0,0 +1,152 @@
+import re
+import copy
+from gpt_fhir.snomedIndex import normalize
+from gpt_fhir.rateLimiter import estimate_prompt_tokens
+
+# line opening every note of a packed request
+DELIMITER = "### Note {number}"
+NOTE = re.compile(r"^### Note (\d+)$", re.MULTILINE)
+
+# tool parameter naming the note of a resource
+NOTE_ID_PARAMETER = "note_id"
+
+# instructions added to the system prompt of packed requests
+PACKED_PROMPT = """
+The text holds {count} separate notes, each starting with a line "### Note <number>".
+Extract the resources of every note separately and set note_id to the number of the note
+the resource is found in. Never combine information from different notes.
+"""
+
+# words of a term that identify it in a note
+WORD = re.compile(r"\w{3,}")
+STOPWORDS = {"the", "and", "for", "with", "from", "into", "without"}
+
+
+def pack(texts):
+    """
+    This function joins notes into the text of one request, each after its delimiter.
+    """
+
+    return "\n\n".join(
+        f"{DELIMITER.format(number=number)}\n{text.strip()}"
+        for number, text in enumerate(texts, start=1)
+    )
+
+
+def unpack(text):
+    """
+    This function splits the text of a packed request back into its notes
+    (an empty list if the text is not packed).
+    """
+
+    parts = NOTE.split(text)
+    return [part.strip() for part in parts[2::2]]
+
+
+def pack_tools(tools):
+    """
+    This function returns a copy of the tool schemas with a required note_id parameter.
+    """
+
+    tools = copy.deepcopy(tools)
+    for tool in tools:
+        parameters = tool["function"].setdefault("parameters", {"type": "object"})
+        parameters.setdefault("properties", {})[NOTE_ID_PARAMETER] = {
+            "type": "integer",
+            "description": "Number of the note the resource is found in",
+        }
+        parameters["required"] = [*parameters.get("required", []), NOTE_ID_PARAMETER]
+
+    return tools
+
+
+def mention(term, text):
+    """share of the words of a term found in a text"""
+
+    words = [word for word in WORD.findall(normalize(term)) if word not in STOPWORDS]
+    words = words or normalize(term).split()
+    if not words:
+        return 0.0
+    text = normalize(text)
+
+    return sum(word in text for word in words) / len(words)
+
+
+def leaked(term, index, texts, threshold=0.5):
+    """
+    This function checks that a term of a packed tool call is found in the note
+    it was assigned to. If it is not, but clearly is in exactly one other note,
+    the term leaked across notes and the position of that note is returned;
+    otherwise None (terms the model paraphrased or made up are not leaks).
+    """
+
+    if mention(term, texts[index]) > 0:
+        return None
+
+    scores = [mention(term, text) for text in texts]
+    best = max(scores)
+    if best >= threshold and scores.count(best) == 1:
+        return scores.index(best)
+
+    return None
+
+
+class NotePacker:
+    """
+    This class groups short notes into packed requests.
+    Notes are added to a request while its estimated prompt tokens, plus the expected
+    completion tokens of every note, stay within token_budget, so the number of notes
+    per request adapts to their length. The system prompt and tool schemas are paid
+    once per request instead of once per note.
+    """
+
+    def __init__(
+        self, system_prompt, tools, token_budget=4000, max_notes=16, completion_tokens=150
+    ):
+        # copy settings
+        self.token_budget = token_budget
+        self.max_notes = max_notes
+        self.completion_tokens = completion_tokens
+
+        # fixed tokens of a request: system prompt, instructions and tool schemas
+        self.overhead = estimate_prompt_tokens(
+            [{"content": system_prompt + PACKED_PROMPT}, {"content": ""}], pack_tools(tools)
+        )
+
+    def note_tokens(self, text):
+        """estimated prompt and completion tokens a note adds to a request"""
+
+        return (
+            estimate_prompt_tokens([{"content": f"{DELIMITER.format(number=0)}\n{text}"}])
+            + self.completion_tokens
+        )
+
+    def batches(self, texts, packable=None):
+        """
+        This function groups the notes into requests, as lists of note positions.
+        Notes that do not fit a request with others, or are not packable, go alone.
+        """
+
+        batches = []
+        batch, tokens = [], self.overhead
+        for i, text in enumerate(texts):
+            note_tokens = self.note_tokens(text)
+
+            # notes too long to share a request are extracted alone
+            if (packable is not None and not packable(text)) or (
+                self.overhead + note_tokens > self.token_budget
+            ):
+                batches.append([i])
+                continue
+
+            # start a new request once the budget or the note limit is reached
+            if batch and (tokens + note_tokens > self.token_budget or len(batch) >= self.max_notes):
+                batches.append(batch)
+                batch, tokens = [], self.overhead
+            batch.append(i)
+            tokens += note_tokens
+
+        if batch:
+            batches.append(batch)
+
+        return batches
@@ -0,0 +1,299 @@
+import re
+import json
+import time
+import random
+import asyncio
+import logging
+import datetime
+import threading
+import email.utils
+import openai
+from gpt_fhir.metrics import metrics
+
+try:
+    import tiktoken
+
+    ENCODING = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    ENCODING = None
+
+# durations of the x-ratelimit-reset-* headers, e.g. "1s", "6m0s", "20ms"
+DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+# failures the SDK would retry itself: rate limits, 5xx, timeouts and connection errors
+RETRYABLE = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+def parse_duration(value):
+    """parse a rate-limit header duration into seconds"""
+
+    try:
+        return float(value)
+    except ValueError:
+        return sum(float(amount) * UNITS[unit] for amount, unit in DURATION.findall(value))
+
+
+def parse_retry_after(value):
+    """parse a Retry-After header, in seconds or as an HTTP date, into seconds"""
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return parse_duration(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def estimate_prompt_tokens(messages, tools=None):
+    """estimate the prompt tokens of messages plus tool schemas"""
+
+    texts = []
+    for message in messages:
+        if isinstance(message, dict):
+            texts.append(str(message.get("content") or ""))
+        else:
+            texts.append(message.model_dump_json())
+    if tools:
+        texts.append(json.dumps(tools))
+    text = "\n".join(texts)
+
+    # use the tokenizer of the chat models if available
+    if ENCODING is not None:
+        tokens = len(ENCODING.encode(text))
+    else:
+        tokens = len(text) // 4
+
+    # every message carries a few tokens of framing
+    return tokens + 4 * len(messages)
+
+
+def retry_after(error):
+    """
+    seconds to wait before retrying a failed request,
+    from the Retry-After or rate-limit reset headers (None if there are none)
+    """
+
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+
+    if "retry-after-ms" in headers:
+        return float(headers["retry-after-ms"]) / 1000
+    if "retry-after" in headers:
+        return parse_retry_after(headers["retry-after"])
+
+    resets = [
+        parse_duration(headers[name])
+        for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+        if name in headers and headers.get(name.replace("reset", "remaining")) == "0"
+    ]
+    return max(resets) if resets else None
+
+
+class RateLimiter:
+    """
+    This class schedules OpenAI requests against requests-per-minute and tokens-per-minute
+    budgets. Every request is admitted through two token buckets using an estimate of its
+    tokens; 429s pause all requests for the time the API asks for, with jittered backoff,
+    so concurrent workers do not turn one limit hit into a retry storm. As the OpenAI
+    clients do not retry under the scheduler, it also retries 5xx responses, timeouts
+    and connection errors, backing off only the failed request.
+    """
+
+    def __init__(self, rpm, tpm, completion_tokens=256, max_retries=6, max_delay=60.0):
+        # copy settings
+        self.rpm = rpm
+        self.tpm = tpm
+        self.completion_tokens = completion_tokens
+        self.max_retries = max_retries
+        self.max_delay = max_delay
+
+        # both buckets start full and refill continuously
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+
+        # no request is admitted before this time after a 429
+        self.paused_until = 0.0
+
+        # init counters
+        self.queue_depth = 0
+        self.admitted = 0
+        self.retries = 0
+        self.wait_time = 0.0
+
+        self.lock = threading.Lock()
+
+    def estimate_tokens(self, messages, tools=None):
+        """
+        This function estimates the tokens a request counts against the TPM budget:
+        the prompt (messages plus tool schemas) and the expected completion.
+        """
+
+        return estimate_prompt_tokens(messages, tools) + self.completion_tokens
+
+    def reserve(self, tokens):
+        """
+        try to take a request and its tokens from the buckets;
+        returns 0 on success or the seconds to wait before trying again
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+
+            # refill buckets
+            elapsed = now - self.updated
+            self.updated = now
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+            # a request larger than the whole budget waits for a full bucket
+            tokens = min(tokens, self.tpm)
+            if self.requests >= 1 and self.tokens >= tokens:
+                self.requests -= 1
+                self.tokens -= tokens
+                self.admitted += 1
+                return 0
+
+            return max(
+                (1 - self.requests) * 60 / self.rpm,
+                (tokens - self.tokens) * 60 / self.tpm,
+                0.001,
+            )
+
+    def settle(self, estimated, usage):
+        """correct the token bucket by the actual usage of a completed request"""
+
+        if usage is None:
+            return
+        with self.lock:
+            self.tokens = min(self.tpm, self.tokens + estimated - usage.total_tokens)
+
+    def backoff(self, error, attempt):
+        """
+        return the delay before retrying a failed request;
+        after a 429 all requests are paused for it
+        """
+
+        delay = retry_after(error)
+        if delay is None:
+            delay = min(self.max_delay, 2**attempt)
+
+        # jitter spreads the retries of concurrent workers
+        delay = delay * (1 + random.random() * 0.25)
+        with self.lock:
+            if isinstance(error, openai.RateLimitError):
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.retries += 1
+        metrics.count("rate_limit_retries", error=type(error).__name__)
+        logging.warning(
+            f"RATE LIMIT: {type(error).__name__}, retrying in {delay:.1f}s (attempt {attempt + 1})"
+        )
+
+        # a rate-limited request waits in acquire, other failures wait for themselves
+        return 0.0 if isinstance(error, openai.RateLimitError) else delay
+
+    def enqueue(self):
+        """count a request waiting for admission, returning the time it started waiting"""
+
+        with self.lock:
+            self.queue_depth += 1
+            metrics.gauge("rate_limit_queue_depth", self.queue_depth)
+        return time.monotonic()
+
+    def dequeue(self, start):
+        """count a request leaving the queue and the time it waited"""
+
+        with self.lock:
+            self.queue_depth -= 1
+            self.wait_time += time.monotonic() - start
+            metrics.gauge("rate_limit_queue_depth", self.queue_depth)
+
+    def acquire(self, tokens):
+        """
+        This function blocks until the request is admitted.
+        """
+
+        start = self.enqueue()
+        try:
+            with metrics.span("rate_limit_wait"):
+                while (delay := self.reserve(tokens)) > 0:
+                    time.sleep(delay)
+        finally:
+            self.dequeue(start)
+
+    async def aacquire(self, tokens):
+        """
+        This function waits without blocking the event loop until the request is admitted.
+        """
+
+        start = self.enqueue()
+        try:
+            with metrics.span("rate_limit_wait"):
+                while (delay := self.reserve(tokens)) > 0:
+                    await asyncio.sleep(delay)
+        finally:
+            self.dequeue(start)
+
+    def call(self, create, **kwargs):
+        """
+        This function runs a chat completion request once admitted,
+        retrying rate-limited and transiently failed attempts.
+        """
+
+        tokens = self.estimate_tokens(kwargs["messages"], kwargs.get("tools"))
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens)
+            try:
+                response = create(**kwargs)
+            except RETRYABLE as e:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.backoff(e, attempt))
+                continue
+            if not kwargs.get("stream"):
+                self.settle(tokens, response.usage)
+            return response
+
+    async def acall(self, create, **kwargs):
+        """
+        This function runs an async chat completion request once admitted,
+        retrying rate-limited and transiently failed attempts.
+        """
+
+        tokens = self.estimate_tokens(kwargs["messages"], kwargs.get("tools"))
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire(tokens)
+            try:
+                response = await create(**kwargs)
+            except RETRYABLE as e:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff(e, attempt))
+                continue
+            if not kwargs.get("stream"):
+                self.settle(tokens, response.usage)
+            return response
+
+    def stats(self):
+        """
+        This function returns the queue depth and wait time counters.
+        """
+
+        return {
+            "queue_depth": self.queue_depth,
+            "admitted": self.admitted,
+            "retries": self.retries,
+            "wait_seconds": self.wait_time,
+            "average_wait_seconds": self.wait_time / self.admitted if self.admitted else 0.0,
+        }
@@ -0,0 +1,121 @@
+import numpy as np
+from scipy import sparse
+from gpt_fhir.snomedIndex import normalize, split_semantic_tag
+
+
+def ngrams(text, n):
+    """character n-grams of a normalized text, padded at the word boundaries"""
+
+    text = f" {normalize(text)} "
+    return [text[i : i + n] for i in range(max(1, len(text) - n + 1))]
+
+
+class Reranker:
+    """
+    This class reorders the top-k SNOMED candidates of terms by how well they match.
+    Candidates are scored by the character n-gram TF-IDF cosine similarity of their label
+    to the term, a bonus (or penalty) for their semantic tag fitting the resource type
+    (for candidates that have one, like those of the offline index), and a small prior
+    for the rank the terminology service gave them.
+    The candidates of a whole batch of terms are scored in one sparse matrix operation.
+    """
+
+    def __init__(self, n=3, tag_weight=0.3, rank_weight=0.05):
+        # copy settings
+        self.n = n
+        self.tag_weight = tag_weight
+        self.rank_weight = rank_weight
+
+    def vectorize(self, texts):
+        """
+        This function returns the L2-normalized TF-IDF matrix of texts (one row per text),
+        with the IDF taken over the texts themselves.
+        """
+
+        # count n-grams into a sparse term-frequency matrix
+        vocabulary = {}
+        rows, columns = [], []
+        for row, text in enumerate(texts):
+            for gram in ngrams(text, self.n):
+                rows.append(row)
+                columns.append(vocabulary.setdefault(gram, len(vocabulary)))
+        matrix = sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, columns)), shape=(len(texts), len(vocabulary))
+        )
+        matrix.sum_duplicates()
+
+        # weight by smoothed inverse document frequency
+        frequency = np.bincount(matrix.indices, minlength=len(vocabulary))
+        idf = np.log((1 + len(texts)) / (1 + frequency)) + 1
+        matrix = matrix @ sparse.diags(idf)
+
+        # normalize rows
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+
+        return (sparse.diags(1 / norms) @ matrix).tocsr()
+
+    def tag_fit(self, owners, tags, semantic_tags):
+        """
+        This function returns +1 for every candidate whose semantic tag fits the resource
+        type of its term, -1 if it has another one, and 0 if it has none or its term has
+        no fitting tags, looked up for all candidates at once in a term-by-tag matrix.
+        """
+
+        # number the tags of the candidates; untagged ones get the extra last column
+        vocabulary = {}
+        tag_ids = np.array(
+            [-1 if tag is None else vocabulary.setdefault(tag, len(vocabulary)) for tag in tags]
+        )
+        fitting = np.zeros((len(semantic_tags), len(vocabulary) + 1), dtype=bool)
+        for row, term_tags in enumerate(semantic_tags):
+            columns = [vocabulary[tag] for tag in term_tags or () if tag in vocabulary]
+            fitting[row, np.array(columns, dtype=int)] = True
+        typed = np.array([bool(term_tags) for term_tags in semantic_tags])
+
+        fit = np.where(fitting[owners, tag_ids], 1.0, -1.0)
+        fit[(tag_ids < 0) | ~typed[owners]] = 0.0
+        return fit
+
+    def rerank_many(self, terms, candidates, semantic_tags=None):
+        """
+        This function reorders the candidate annotations of every term, best first.
+        semantic_tags holds the tags fitting the resource type of each term (or None).
+        """
+
+        sizes = np.array([len(term_candidates) for term_candidates in candidates])
+        if sizes.sum() == 0:
+            return [list(term_candidates) for term_candidates in candidates]
+        semantic_tags = semantic_tags or [None] * len(terms)
+
+        # owning term and service rank of every candidate
+        owners = np.repeat(np.arange(len(terms)), sizes)
+        ranks = np.concatenate([np.arange(size) for size in sizes])
+
+        # split labels into label and semantic tag
+        flat = [candidate for term_candidates in candidates for candidate in term_candidates]
+        labels, tags = zip(*(split_semantic_tag(c.get("label", "")) for c in flat))
+        tags = [candidate.get("semantic_tag") or tag for candidate, tag in zip(flat, tags)]
+
+        # cosine similarity of every candidate label to its term, in one operation
+        matrix = self.vectorize(list(terms) + list(labels))
+        queries = matrix[: len(terms)][owners]
+        similarity = np.asarray(matrix[len(terms) :].multiply(queries).sum(axis=1)).ravel()
+
+        # semantic tag fit, unless it is not weighted (e.g. OLS candidates carry no tags)
+        fit = self.tag_fit(owners, tags, semantic_tags) if self.tag_weight else 0.0
+
+        scores = similarity + self.tag_weight * fit - self.rank_weight * ranks / sizes[owners]
+
+        # order by term, then by descending score
+        order = np.lexsort((-scores, owners))
+        ranked = [flat[i] for i in order]
+
+        # split back into the candidates of each term
+        reranked = []
+        start = 0
+        for size in sizes:
+            reranked.append(ranked[start : start + size])
+            start += size
+
+        return reranked
@@ -0,0 +1,257 @@
+import re
+import logging
+from fhirclient.models.fhirelementfactory import FHIRElementFactory
+
+# Field -> FHIR path mapping of the tools in config.yaml.example.
+# Semantic tags are the SNOMED hierarchies a code of the resource should come from.
+# Paths are dotted FHIR element paths; "[]" marks a list element (a list parameter value
+# fans out at the first one), and a trailing "{start,end}" only accepts objects with these keys.
+DEFAULT_RESOURCES = {
+    "extract_fhir_condition": {
+        "resourceType": "Condition",
+        "name": "Condition",
+        "code": {"parameter": "condition", "path": "code"},
+        "semantic_tags": ["disorder", "finding"],
+        "static": {"subject": {"reference": "Patient/1"}},
+        "fields": {
+            "abatementAge": "abatementAge.value",
+            "abatementDateTime": "abatementDateTime",
+            "abatementPeriod": "abatementPeriod{start,end}",
+            "abatementString": "abatementString",
+            "bodySite": "bodySite[].text",
+            "category": "category[].text",
+            "clinicalStatus": "clinicalStatus.text",
+            "evidence": "evidence[].code[].text",
+            "note": "note[].text",
+            "onsetAge": "onsetAge.value",
+            "onsetDateTime": "onsetDateTime",
+            "onsetPeriod": "onsetPeriod{start,end}",
+            "onsetString": "onsetString",
+            "recordedDate": "recordedDate",
+            "severity": "severity.text",
+            "stage": "stage[].summary.text",
+            "verificationStatus": "verificationStatus.text",
+        },
+    },
+    "extract_fhir_procedure": {
+        "resourceType": "Procedure",
+        "name": "Procedure",
+        "code": {"parameter": "procedure", "path": "code"},
+        "semantic_tags": ["procedure", "regime/therapy"],
+        "static": {"subject": {"reference": "Patient/1"}},
+        "fields": {
+            "bodySite": "bodySite[].text",
+            "category": "category.text",
+            "complication": "complication[].text",
+            "followUp": "followUp[].text",
+            "note": "note[].text",
+            "outcome": "outcome.text",
+            "performedAge": "performedAge.value",
+            "performedDateTime": "performedDateTime",
+            "performedPeriod": "performedPeriod{start,end}",
+            "performedString": "performedString",
+            "reasonCode": "reasonCode[].text",
+            "status": "status",
+            "statusReason": "statusReason.text",
+            "usedCode": "usedCode[].text",
+        },
+    },
+    "extract_fhir_medication_statement": {
+        "resourceType": "MedicationStatement",
+        "name": "Medication statement",
+        "code": {"parameter": "medication_statement", "path": "medicationCodeableConcept"},
+        "semantic_tags": ["substance", "product", "medicinal product", "clinical drug"],
+        "static": {"subject": {"reference": "Patient/1"}},
+        "fields": {
+            "category": "category.text",
+            "dateAsserted": "dateAsserted",
+            "dosage": "dosage[].text",
+            "effectiveDateTime": "effectiveDateTime",
+            "effectivePeriod": "effectivePeriod{start,end}",
+            "note": "note[].text",
+            "reasonCode": "reasonCode[].text",
+            "status": "status",
+            "statusReason": "statusReason[].text",
+        },
+    },
+}
+
+# marks a parameter value that does not fit its path
+SKIP = object()
+
+# path with an optional "{key,key}" object filter
+PATH = re.compile(r"([^{}]+)(?:\{([^{}]*)\})?")
+
+
+def compile_path(path):
+    """
+    This function compiles a field path into a function
+    turning a parameter value into the resource fragment it maps to.
+    """
+
+    match = PATH.fullmatch(path)
+    if match is None:
+        raise ValueError(f"invalid FHIR path {path}")
+    segments = [
+        (segment[:-2], True) if segment.endswith("[]") else (segment, False)
+        for segment in match.group(1).split(".")
+    ]
+
+    # innermost value: as is, or an object restricted to the required keys
+    if match.group(2):
+        keys = [key.strip() for key in match.group(2).split(",")]
+
+        def build(value):
+            if isinstance(value, dict) and all(key in value for key in keys):
+                return {key: value[key] for key in keys}
+            return SKIP
+
+    else:
+
+        def build(value):
+            return value
+
+    # wrap it from the innermost to the outermost element
+    fanout = next((i for i, (_, is_list) in enumerate(segments) if is_list), None)
+    for i in reversed(range(len(segments))):
+        build = wrap(build, segments[i][0], segments[i][1], i == fanout)
+
+    return build
+
+
+def wrap(inner, name, is_list, fanout):
+    """wrap the builder of an element into the builder of its parent"""
+
+    if is_list and fanout:
+
+        def build(value):
+            items = [inner(item) for item in (value if isinstance(value, list) else [value])]
+            items = [item for item in items if item is not SKIP]
+            return {name: items} if items else SKIP
+
+    elif is_list:
+
+        def build(value):
+            value = inner(value)
+            return SKIP if value is SKIP else {name: [value]}
+
+    else:
+
+        def build(value):
+            value = inner(value)
+            return SKIP if value is SKIP else {name: value}
+
+    return build
+
+
+def merge(target, fragment):
+    """deep-merge a resource fragment into a resource"""
+
+    for key, value in fragment.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+
+
+class ResourceBuilder:
+    """
+    This class is a precompiled converter from tool call parameters to a FHIR JSON resource.
+    It is compiled once from the tool parameter schema and a declarative field mapping,
+    and emits FHIR JSON dicts directly; full fhirclient model validation is opt-in.
+    """
+
+    def __init__(self, tool_name, mapping, schema=None, validate=False):
+        # copy settings
+        self.tool_name = tool_name
+        self.resource_type = mapping["resourceType"]
+        self.name = mapping.get("name", self.resource_type)
+        self.code_parameter = mapping["code"]["parameter"]
+        self.code_path = mapping["code"]["path"]
+        self.semantic_tags = mapping.get("semantic_tags", [])
+        self.static = mapping.get("static", {})
+        self.validate = validate
+
+        # declared tool parameters, if the schema is known
+        properties = None
+        if schema is not None:
+            properties = schema.get("parameters", {}).get("properties", {})
+            for parameter in properties:
+                if parameter != self.code_parameter and parameter not in mapping["fields"]:
+                    logging.warning(f"{tool_name}: parameter {parameter} has no FHIR path")
+
+        # compile one converter per mapped parameter
+        self.fields = []
+        for parameter, path in mapping["fields"].items():
+            if properties is not None and parameter not in properties:
+                continue
+            integer = properties is not None and properties[parameter].get("type") == "integer"
+            self.fields.append((parameter, compile_path(path), integer))
+
+    def build(self, params, annotation):
+        """
+        This function builds the FHIR JSON resource from the LLM parameters
+        and the SNOMED annotation of its code.
+        """
+
+        resource = {}
+
+        # add fields present in the parameters
+        for parameter, convert, integer in self.fields:
+            if parameter in params:
+                value = params[parameter]
+                if integer and isinstance(value, str) and value.strip().isdigit():
+                    value = int(value)
+                fragment = convert(value)
+                if fragment is not SKIP:
+                    merge(resource, fragment)
+
+        # add SNOMED code
+        resource[self.code_path] = {
+            "coding": [
+                {
+                    "code": annotation["obo_id"].split(":")[1],
+                    "display": annotation["label"],
+                    "system": "http://snomed.info/sct",
+                }
+            ],
+            "text": params[self.code_parameter],
+        }
+
+        # add static elements
+        for key, value in self.static.items():
+            resource.setdefault(key, value)
+
+        # elements in the order fhirclient emits them
+        resource = dict(sorted(resource.items()))
+        resource["resourceType"] = self.resource_type
+
+        # optionally check the resource against the fhirclient model
+        if self.validate:
+            FHIRElementFactory.instantiate(self.resource_type, resource)
+
+        return resource
+
+
+def compile_builders(config=None):
+    """
+    This function compiles the resource builders of all tools.
+    Mappings in config["FHIR"]["RESOURCES"] extend or replace the default ones,
+    so a new resource type only needs a tool schema and a mapping in the config.
+    """
+
+    config = config or {}
+    resources = {**DEFAULT_RESOURCES, **config.get("FHIR", {}).get("RESOURCES", {})}
+    validate = config.get("FHIR", {}).get("VALIDATE", False)
+
+    # tool schemas by name
+    schemas = {
+        tool["function"]["name"]: tool["function"]
+        for tool in config.get("GENAI", {}).get("TOOLS", [])
+    }
+
+    return {
+        tool_name: ResourceBuilder(tool_name, mapping, schemas.get(tool_name), validate)
+        for tool_name, mapping in resources.items()
+        if not schemas or tool_name in schemas
+    }
@@ -0,0 +1,144 @@
+import os
+import json
+import hashlib
+import threading
+
+# stands for the prompt date in cached responses
+DATE_PLACEHOLDER = "{date}"
+
+
+def strip_date(text, date):
+    """replace the prompt date in a response text by the placeholder"""
+    return text if text is None else text.replace(date, DATE_PLACEHOLDER)
+
+
+def render_date(text, date):
+    """replace the placeholder in a cached response text by the prompt date"""
+    return text if text is None else text.replace(DATE_PLACEHOLDER, date)
+
+
+class ResponseCache:
+    """
+    This class is a content-addressed, size-bounded on-disk cache of LLM responses.
+    Entries hold the tool calls and token usage of a completion and are keyed on a hash
+    of everything that determines the request, so identical notes are never sent twice.
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, replay_only=False):
+        # copy settings
+        self.path = path
+        self.max_bytes = max_bytes
+
+        # in replay-only mode a miss is an error instead of an OpenAI request
+        self.replay_only = replay_only
+
+        # init counters
+        self.hits = 0
+        self.misses = 0
+
+        # entries are written from many threads
+        self.lock = threading.Lock()
+
+        # measure the current cache size
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(os.path.getsize(file) for file in self.files())
+
+    @staticmethod
+    def key(model, system_prompt, tools, text, params):
+        """
+        This function hashes a request into its cache key.
+        The system prompt is the unrendered template, so the key does not change with the
+        prompt date; the date is kept out of the entries as DATE_PLACEHOLDER instead.
+        """
+
+        request = json.dumps(
+            [model, system_prompt, tools, text, params],
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def file(self, key):
+        """path of the entry file, sharded by the first key byte"""
+        return os.path.join(self.path, key[:2], f"{key}.json")
+
+    def files(self):
+        """all entry files"""
+
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith(".json"):
+                    yield os.path.join(directory, name)
+
+    def get(self, key):
+        """
+        This function returns the cached entry of a key, or None.
+        """
+
+        file = self.file(key)
+        try:
+            with open(file) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+
+        # mark the entry as recently used
+        try:
+            os.utime(file)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+
+        return entry
+
+    def set(self, key, entry):
+        """
+        This function stores an entry and evicts the least recently used ones
+        once the cache is over its size limit.
+        """
+
+        file = self.file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+
+        # write atomically, so readers never see partial entries
+        data = json.dumps(entry).encode("utf-8")
+        temporary = f"{file}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+
+        with self.lock:
+            if os.path.exists(file):
+                self.size -= os.path.getsize(file)
+            os.replace(temporary, file)
+            self.size += len(data)
+
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """drop the least recently used entries down to 90% of the size limit"""
+
+        entries = []
+        for file in self.files():
+            stat = os.stat(file)
+            entries.append((stat.st_mtime, stat.st_size, file))
+
+        for _, size, file in sorted(entries):
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            os.remove(file)
+            self.size -= size
+
+    def stats(self):
+        """
+        This function returns the hit/miss counters.
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": self.size,
+        }
@@ -0,0 +1,324 @@
+import uuid
+import asyncio
+import logging
+from dataclasses import dataclass
+from aiohttp import web
+from gpt_fhir.cascade import Cascade
+from gpt_fhir.metrics import metrics
+from gpt_fhir.annotator import BatchingAnnotator
+
+
+@dataclass
+class QueuedNote:
+    """
+    This class holds a note waiting in the request queue.
+    """
+
+    # id the note's resources are published with
+    note_id: str
+
+    # text of the note
+    text: str
+
+    # future the result of the note is set on
+    future: asyncio.Future
+
+
+def result_record(note_id, result):
+    """
+    This function returns the JSON record of the result of a note (or of its exception).
+    """
+
+    if isinstance(result, Exception):
+        return {"note_id": note_id, "error": repr(result)}
+
+    return {
+        "note_id": note_id,
+        "resources": result.resources,
+        "tool_calls": result.tool_calls,
+        "usage": result.usage,
+        "cached": result.cached,
+        "tier": result.tier,
+    }
+
+
+def json_error(status, message, retry_after=None):
+    """JSON error response, asking the client to retry after retry_after seconds if given"""
+
+    headers = {"Retry-After": str(retry_after)} if retry_after is not None else None
+    return web.json_response({"error": message}, status=status, headers=headers)
+
+
+class ExtractionServer:
+    """
+    This class serves the extraction over HTTP from one long-running process, so all
+    requests share the warm OpenAI and OLS clients and the caches of one extraction stack.
+    Notes of all requests go through a bounded queue: a collector takes up to MAX_BATCH
+    notes arriving within BATCH_WINDOW seconds and extracts them together with
+    extract_many (packed, and through the cascade, if configured), with at most
+    MAX_IN_FLIGHT batches running. Annotation lookups of concurrent notes are
+    micro-batched by a BatchingAnnotator. When the queue is full requests are rejected
+    with 429, and requests waiting longer than REQUEST_TIMEOUT get 503.
+    """
+
+    def __init__(self, llm_extractor, config):
+        # copy settings
+        server = config.get("SERVER", {})
+        self.queue_size = server.get("QUEUE_SIZE", 256)
+        self.max_batch = server.get("MAX_BATCH", 32)
+        self.batch_window = server.get("BATCH_WINDOW", 0.02)
+        self.max_in_flight = server.get("MAX_IN_FLIGHT", 4)
+        self.concurrency = server.get("CONCURRENCY", 8)
+        self.max_notes = server.get("MAX_NOTES", 256)
+        self.request_timeout = server.get("REQUEST_TIMEOUT", 120)
+        self.retry_after = server.get("RETRY_AFTER", 1)
+
+        # micro-batch the annotation lookups of concurrent notes
+        self.fhir = llm_extractor.fhir_tools.fhir
+        annotation = server.get("ANNOTATION_BATCHING", {})
+        if annotation.get("ENABLED", True):
+            self.fhir.annotator = BatchingAnnotator(
+                self.fhir.annotator,
+                window=annotation.get("WINDOW", 0.005),
+                max_terms=annotation.get("MAX_TERMS", 64),
+                max_concurrency=annotation.get("CONCURRENCY", 8),
+            )
+
+        # optionally extract notes with the local matcher first, escalating the rest to the LLM
+        self.extractor = llm_extractor
+        if config["GENAI"].get("CASCADE", {}).get("ENABLED", False):
+            self.extractor = Cascade(llm_extractor, config)
+
+        # the request queue and the batches being extracted, created on startup
+        self.queue = None
+        self.slots = None
+        self.collector = None
+        self.batches = set()
+        self.in_flight = 0
+        self.draining = False
+
+    def app(self):
+        """
+        This function returns the aiohttp application of the server.
+        """
+
+        app = web.Application()
+        app.add_routes(
+            [
+                web.post("/extract", self.extract),
+                web.post("/extract:batch", self.extract_batch),
+                web.get("/health", self.get_health),
+                web.get("/metrics", self.get_metrics),
+            ]
+        )
+        app.on_startup.append(self.start)
+        app.on_shutdown.append(self.drain)
+        app.on_cleanup.append(self.stop)
+
+        return app
+
+    async def start(self, app):
+        """start the collector and the metrics"""
+
+        metrics.enable()
+        self.queue = asyncio.Queue(self.queue_size)
+        self.slots = asyncio.Semaphore(max(1, self.max_in_flight))
+        self.collector = asyncio.create_task(self.collect())
+
+    async def drain(self, app):
+        """stop admitting notes"""
+        self.draining = True
+
+    async def stop(self, app):
+        """stop the collector, wait for the running batches and close the FHIR sinks"""
+
+        self.collector.cancel()
+        await asyncio.gather(self.collector, *self.batches, return_exceptions=True)
+        await asyncio.to_thread(self.fhir.close)
+
+    async def collect(self):
+        """
+        This function takes batches of notes off the queue and starts their extraction,
+        waiting for a free slot first so the notes queue up while all slots are busy.
+        """
+
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+
+            # the first note opens a batch, which closes after the window or when full
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self.run_batch(batch))
+            self.batches.add(task)
+            task.add_done_callback(self.batches.discard)
+
+    async def run_batch(self, batch):
+        """extract a batch of notes and hand every note its result"""
+
+        # notes whose requests timed out or were cancelled are dropped
+        notes = [note for note in batch if not note.future.done()]
+        self.in_flight += len(notes)
+        metrics.count("server_batches")
+        metrics.count("server_batch_notes", len(notes))
+        try:
+            if notes:
+                # extract_many hands the resources to the FHIR sinks from a worker thread
+                with metrics.span("server_batch"):
+                    results = await self.extractor.extract_many(
+                        [note.text for note in notes],
+                        max_concurrency=self.concurrency,
+                        note_ids=[note.note_id for note in notes],
+                    )
+                for note, result in zip(notes, results):
+                    if not note.future.done():
+                        note.future.set_result(result)
+        except Exception as e:
+            logging.exception(f"extraction of a batch of {len(notes)} notes failed")
+            for note in notes:
+                if not note.future.done():
+                    note.future.set_result(e)
+        finally:
+            self.in_flight -= len(notes)
+            self.slots.release()
+
+    def admit(self, notes):
+        """
+        This function queues notes, all or none, returning their futures
+        or the error response if they cannot be admitted.
+        """
+
+        if self.draining:
+            metrics.count("server_rejected", reason="draining")
+            return None, json_error(503, "server is shutting down")
+
+        if self.queue.maxsize - self.queue.qsize() < len(notes):
+            metrics.count("server_rejected", reason="queue_full")
+            return None, json_error(429, "request queue is full", self.retry_after)
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for note_id, text in notes:
+            future = loop.create_future()
+            self.queue.put_nowait(QueuedNote(note_id, text, future))
+            futures.append(future)
+
+        return futures, None
+
+    def read_note(self, body):
+        """(note id, text) of a note object of a request, or a text"""
+
+        if isinstance(body, str):
+            body = {"text": body}
+        if not isinstance(body, dict) or not isinstance(body.get("text"), str):
+            raise ValueError('a note needs a "text" string')
+        if not body["text"].strip():
+            raise ValueError("the text of a note is empty")
+
+        # ids such as 0 or "" are ids of their own
+        note_id = body.get("id")
+        return (uuid.uuid4().hex if note_id is None else str(note_id)), body["text"]
+
+    async def extract(self, request):
+        """
+        POST /extract {"text": ..., "id": ...}
+        Extracts one note and returns its result record.
+        """
+
+        try:
+            note = self.read_note(await request.json())
+        except ValueError as e:
+            return json_error(400, str(e))
+
+        with metrics.span("server_request", endpoint="extract"):
+            futures, error = self.admit([note])
+            if error is not None:
+                return error
+
+            # the note is dropped from the queue if the request times out
+            try:
+                result = await asyncio.wait_for(futures[0], self.request_timeout)
+            except asyncio.TimeoutError:
+                metrics.count("server_rejected", reason="timeout")
+                return json_error(503, "extraction timed out", self.retry_after)
+
+        record = result_record(note[0], result)
+        return web.json_response(record, status=500 if "error" in record else 200)
+
+    async def extract_batch(self, request):
+        """
+        POST /extract:batch {"notes": [{"text": ..., "id": ...}, ...]}
+        Extracts many notes and returns their result records in order;
+        notes that failed or timed out get an error record.
+        """
+
+        try:
+            body = await request.json()
+            if not isinstance(body, dict) or not isinstance(body.get("notes"), list):
+                raise ValueError('the request needs a "notes" list')
+            notes = [self.read_note(note) for note in body["notes"]]
+        except ValueError as e:
+            return json_error(400, str(e))
+        if len(notes) > self.max_notes:
+            return json_error(413, f"at most {self.max_notes} notes per request")
+
+        with metrics.span("server_request", endpoint="extract:batch"):
+            futures, error = self.admit(notes)
+            if error is not None:
+                return error
+            if futures:
+                _, pending = await asyncio.wait(futures, timeout=self.request_timeout)
+                for future in pending:
+                    future.set_result(asyncio.TimeoutError("extraction timed out"))
+                if pending:
+                    metrics.count("server_rejected", len(pending), reason="timeout")
+
+        return web.json_response(
+            {
+                "results": [
+                    result_record(note_id, future.result())
+                    for (note_id, _), future in zip(notes, futures)
+                ]
+            }
+        )
+
+    async def get_health(self, request):
+        """
+        GET /health
+        Returns the queue and batch load; 503 while the server is shutting down.
+        """
+
+        return web.json_response(
+            {
+                "status": "draining" if self.draining else "ok",
+                "queued": self.queue.qsize(),
+                "queue_size": self.queue.maxsize,
+                "in_flight": self.in_flight,
+                "batches": len(self.batches),
+            },
+            status=503 if self.draining else 200,
+        )
+
+    async def get_metrics(self, request):
+        """
+        GET /metrics
+        Returns the stage timers and counters in the Prometheus text format.
+        """
+
+        return web.Response(text=metrics.render(), content_type="text/plain")
+
+    def run(self, host="127.0.0.1", port=8000):
+        """
+        This function serves until the process is interrupted.
+        """
+
+        web.run_app(self.app(), host=host, port=port, print=logging.info)
@@ -0,0 +1,240 @@
+import re
+import csv
+import mmap
+import struct
+import argparse
+
+# RF2 description types
+FSN_TYPE_ID = "900000000000003001"
+SYNONYM_TYPE_ID = "900000000000013009"
+
+# index file layout
+MAGIC = b"SNOMIDX1"
+HEADER = struct.Struct("<8sIIQQQ")  # magic, concepts, keys, offsets of the 3 sections
+CONCEPT = struct.Struct("<QII")  # concept id, label offset, label length
+KEY = struct.Struct("<III")  # term offset, term length, concept index
+
+# trailing semantic tag of a fully specified name, e.g. "Pneumonia (disorder)"
+SEMANTIC_TAG = re.compile(r"^(.*\S)\s+\(([^()]+)\)$")
+
+
+def normalize(text):
+    """normalize a term for lookups"""
+    return " ".join(text.casefold().split())
+
+
+def split_semantic_tag(term):
+    """split a fully specified name into its label and semantic tag"""
+
+    match = SEMANTIC_TAG.match(term)
+    if match is None:
+        return term, None
+    return match.group(1), match.group(2)
+
+
+def read_descriptions(path):
+    """
+    This function yields (concept id, term, is fully specified name) from a terminology file.
+    It accepts an RF2 description snapshot, or a TSV stand-in with "conceptId<TAB>term" rows.
+    """
+
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE)
+        header = next(reader, None)
+        if header is None:
+            return
+
+        # RF2 release file
+        if "typeId" in header:
+            columns = {name: i for i, name in enumerate(header)}
+            for row in reader:
+                if row[columns["active"]] != "1":
+                    continue
+                type_id = row[columns["typeId"]]
+                if type_id not in (FSN_TYPE_ID, SYNONYM_TYPE_ID):
+                    continue
+                yield int(row[columns["conceptId"]]), row[columns["term"]], type_id == FSN_TYPE_ID
+
+        # simple TSV stand-in, with or without a header row
+        else:
+            if header[0].isdigit():
+                yield int(header[0]), header[1], False
+            for row in reader:
+                if len(row) >= 2 and row[0].isdigit():
+                    yield int(row[0]), row[1], False
+
+
+def build_index(source_path, index_path):
+    """
+    This function parses a terminology file once and writes the compact lookup index.
+    """
+
+    # collect labels and searchable terms
+    labels = {}
+    fsns = {}
+    terms = set()
+    for concept_id, term, is_fsn in read_descriptions(source_path):
+        if is_fsn or SEMANTIC_TAG.match(term):
+            fsns.setdefault(concept_id, term)
+            term = split_semantic_tag(term)[0]
+        else:
+            labels.setdefault(concept_id, term)
+        terms.add((normalize(term), concept_id))
+
+    # the fully specified name is the label, the first synonym is the fallback
+    concept_ids = sorted(set(labels) | set(fsns))
+    concept_index = {concept_id: i for i, concept_id in enumerate(concept_ids)}
+
+    # write strings into one pool, reusing identical terms
+    pool = bytearray()
+    offsets = {}
+
+    def intern(text):
+        data = text.encode("utf-8")
+        if data not in offsets:
+            offsets[data] = len(pool)
+            pool.extend(data)
+        return offsets[data], len(data)
+
+    concepts = bytearray()
+    for concept_id in concept_ids:
+        offset, length = intern(fsns.get(concept_id) or labels[concept_id])
+        concepts.extend(CONCEPT.pack(concept_id, offset, length))
+
+    # sort terms bytewise so they can be binary searched in place;
+    # for equal terms, concepts whose label is the term come first
+    def rank(item):
+        term, concept_id = item
+        label = split_semantic_tag(fsns.get(concept_id) or labels[concept_id])[0]
+        return term.encode("utf-8"), normalize(label) != term, concept_id
+
+    keys = bytearray()
+    for term, concept_id in sorted(terms, key=rank):
+        offset, length = intern(term)
+        keys.extend(KEY.pack(offset, length, concept_index[concept_id]))
+
+    # write sections after the header
+    concepts_offset = HEADER.size
+    keys_offset = concepts_offset + len(concepts)
+    pool_offset = keys_offset + len(keys)
+    with open(index_path, "wb") as f:
+        f.write(
+            HEADER.pack(
+                MAGIC,
+                len(concept_ids),
+                len(terms),
+                concepts_offset,
+                keys_offset,
+                pool_offset,
+            )
+        )
+        f.write(concepts)
+        f.write(keys)
+        f.write(pool)
+
+    return len(concept_ids), len(terms)
+
+
+class SnomedIndex:
+    """
+    This class is a read-only, memory-mapped view of an index written by build_index.
+    Loading it only maps the file, so worker startup does not re-parse the release.
+    """
+
+    def __init__(self, index_path):
+        with open(index_path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # read header
+        (
+            magic,
+            self.n_concepts,
+            self.n_keys,
+            self.concepts_offset,
+            self.keys_offset,
+            self.pool_offset,
+        ) = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{index_path} is not a SNOMED index file")
+
+    def __len__(self):
+        return self.n_keys
+
+    def _key(self, i):
+        """get term bytes and concept index of the i-th key"""
+
+        offset, length, concept = KEY.unpack_from(self.mm, self.keys_offset + i * KEY.size)
+        start = self.pool_offset + offset
+        return self.mm[start : start + length], concept
+
+    def _concept(self, i):
+        """get the annotation dict of the i-th concept"""
+
+        concept_id, offset, length = CONCEPT.unpack_from(
+            self.mm, self.concepts_offset + i * CONCEPT.size
+        )
+        start = self.pool_offset + offset
+        label, semantic_tag = split_semantic_tag(
+            self.mm[start : start + length].decode("utf-8")
+        )
+        return {
+            "iri": f"http://snomed.info/id/{concept_id}",
+            "obo_id": f"SNOMED:{concept_id}",
+            "label": label,
+            "semantic_tag": semantic_tag,
+        }
+
+    def _lower_bound(self, term):
+        """first key position that is not smaller than term"""
+
+        low, high = 0, self.n_keys
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle)[0] < term:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, text, limit=10):
+        """
+        This function returns the concepts having text as a term or synonym.
+        If there is no exact match, concepts with terms starting with text are returned.
+        """
+
+        term = normalize(text).encode("utf-8")
+        if not term:
+            return []
+
+        # collect the exact matches, then fall back to prefix matches
+        concepts = []
+        position = self._lower_bound(term)
+        for exact in (True, False):
+            i = position
+            while i < self.n_keys and len(concepts) < limit:
+                key, concept = self._key(i)
+                if key != term if exact else not key.startswith(term):
+                    break
+                if concept not in concepts:
+                    concepts.append(concept)
+                i += 1
+            if concepts:
+                break
+
+        return [self._concept(concept) for concept in concepts]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a SNOMED lookup index from an RF2 description file or a TSV stand-in"
+    )
+    parser.add_argument("source", help="RF2 description snapshot or conceptId<TAB>term file")
+    parser.add_argument("index", help="index file to write")
+    args = parser.parse_args()
+
+    n_concepts, n_terms = build_index(args.source, args.index)
+    print(f"indexed {n_terms} terms of {n_concepts} concepts into {args.index}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+import re
+import copy
+import time
+from collections import Counter
+from gpt_fhir.rateLimiter import estimate_prompt_tokens
+from gpt_fhir.resourceBuilder import DEFAULT_RESOURCES
+
+# cues of the resource each tool extracts, as regular expressions matched at word starts
+DEFAULT_LEXICON = {
+    "extract_fhir_condition": [
+        r"diagnos",
+        r"history of",
+        r"complain",
+        r"present(?:ed|s|ing)? with",
+        r"suffer",
+        r"symptom",
+        r"disease",
+        r"disorder",
+        r"syndrome",
+        r"infection",
+        r"cancer",
+        r"tumou?r",
+        r"pain",
+        r"experienc",
+        r"allerg",
+        r"spasm",
+        r"congestion",
+        r"dizz",
+        r"blood pressure",
+        r"cholesterol",
+        r"ache",
+        r"cough",
+        r"fever",
+        r"shortness of breath",
+        r"hypertension",
+        r"diabet",
+        r"asthma",
+        r"depress",
+        r"anxiety",
+        r"pneumonia",
+        r"fracture",
+        r"\w+(?:itis|osis|emia|oma|pathy|algia)\b",
+    ],
+    "extract_fhir_medication_statement": [
+        r"medicat",
+        r"prescri",
+        r"taking",
+        r"takes",
+        r"took",
+        r"been on",
+        r"started on",
+        r"dose",
+        r"dosage",
+        r"\d+\s?(?:mg|mcg|ml|units?)\b",
+        r"tablet",
+        r"capsule",
+        r"inhaler",
+        r"injection",
+        r"daily",
+        r"twice",
+        r"as needed",
+        r"insulin",
+        r"cream",
+        r"ointment",
+        r"\w+(?:pril|sartan|olol|statin|pine|mab|cillin|mycin|cycline|floxacin|azole|prazole|tidine|oxetine|aline|triptan|lukast|sone|olone|formin|gliptin|xaban|parin|trexate|butamol|terol)\b",
+    ],
+    "extract_fhir_procedure": [
+        r"surgery",
+        r"surgical",
+        r"operation",
+        r"procedure",
+        r"underwent",
+        r"performed",
+        r"transplant",
+        r"replacement",
+        r"graft",
+        r"bypass",
+        r"fusion",
+        r"biopsy",
+        r"excision",
+        r"removed",
+        r"removal",
+        r"implant",
+        r"examination",
+        r"x-?ray",
+        r"mri\b",
+        r"ct\b",
+        r"scan",
+        r"ecg\b",
+        r"ekg\b",
+        r"ultrasound",
+        r"imaging",
+        r"tests?\b",
+        r"analysis",
+        r"vaccinat",
+        r"\w+(?:ectomy|otomy|ostomy|plasty|scopy|graphy)\b",
+    ],
+}
+
+# tools sent with every note: conditions are the most common resource and their cues
+# (any finding, complaint or reason for a medication) are too open to enumerate
+DEFAULT_ALWAYS = ["extract_fhir_condition"]
+
+# sentence boundaries, and capitalized terms inside a sentence (likely drug or procedure names)
+SENTENCE = re.compile(r"(?<=[.!?;])\s+|\n+")
+NAME = re.compile(r"(?<=[a-z0-9,:)]\s)[A-Z][A-Za-z-]{3,}")
+
+# descriptions worth keeping in compact schemas: enumerations and format hints
+KEEP_DESCRIPTION = re.compile(r"\||JSON")
+
+
+# tool creating each resource type, and the element holding its code
+RESOURCE_TOOLS = {mapping["resourceType"]: name for name, mapping in DEFAULT_RESOURCES.items()}
+CODE_PATHS = {
+    mapping["resourceType"]: mapping["code"]["path"] for mapping in DEFAULT_RESOURCES.values()
+}
+
+
+def resource_key(resource):
+    """resource type and code (or text) of a resource"""
+
+    concept = resource.get(CODE_PATHS.get(resource.get("resourceType"), "code")) or {}
+    coding = (concept.get("coding") or [{}])[0]
+    return resource.get("resourceType"), coding.get("code") or concept.get("text")
+
+
+def recall(expected, extracted):
+    """
+    This function returns the share of the expected resources of every note (a list of
+    resource lists) that are also in the extracted ones, matched on type and code.
+    """
+
+    found = total = 0
+    for note_expected, note_extracted in zip(expected, extracted):
+        keys = Counter(map(resource_key, note_expected))
+        found += sum((keys & Counter(map(resource_key, note_extracted))).values())
+        total += sum(keys.values())
+
+    return found / total if total else 1.0
+
+
+def compact_tools(tools):
+    """
+    This function returns a copy of the tool schemas with shortened descriptions.
+    Descriptions of self-explanatory parameters are dropped; enumerations are kept
+    and format hints are shortened.
+    """
+
+    tools = copy.deepcopy(tools)
+    for tool in tools:
+        parameters = tool["function"]["parameters"]
+        for name, schema in parameters.get("properties", {}).items():
+            description = schema.get("description", "")
+            if "JSON" in description:
+                schema["description"] = "JSON {'start': date, 'end': date}"
+            elif not KEEP_DESCRIPTION.search(description):
+                schema.pop("description", None)
+
+    return tools
+
+
+class ToolRouter:
+    """
+    This class is a cheap local pre-router picking the tools to send for a note.
+    Each tool has a lexicon of cues; a note only gets the tools whose cues it mentions
+    and the tools sent with every note. Routing only drops a tool when the cues explain
+    the whole note: notes with a sentence or a capitalized name matching no cue, or
+    without any cue at all, get all tools.
+    """
+
+    def __init__(self, tools, lexicon=None, always=None, compact=False):
+        # optionally use compact schemas
+        self.tools = compact_tools(tools) if compact else tools
+
+        # tools sent with every note
+        self.always = set(DEFAULT_ALWAYS if always is None else always)
+
+        # configured cues extend the default ones
+        cues = {name: list(tool_cues) for name, tool_cues in DEFAULT_LEXICON.items()}
+        for name, tool_cues in (lexicon or {}).items():
+            cues.setdefault(name, []).extend(tool_cues)
+
+        # compile one pattern per tool
+        self.patterns = {
+            name: re.compile(r"\b(?:" + "|".join(tool_cues) + ")", re.IGNORECASE)
+            for name, tool_cues in cues.items()
+        }
+
+    def ambiguous(self, text):
+        """
+        This function returns whether the cues leave part of a note unexplained:
+        a sentence without any cue or a capitalized name no cue matches.
+        """
+
+        for sentence in SENTENCE.split(text):
+            if sentence.strip() and not any(p.search(sentence) for p in self.patterns.values()):
+                return True
+
+        return any(
+            not any(p.match(name) for p in self.patterns.values()) for name in NAME.findall(text)
+        )
+
+    def select(self, text):
+        """
+        This function returns the tool schemas to send for a note.
+        """
+
+        # ambiguous notes get all tools rather than a guess
+        if self.ambiguous(text):
+            return self.tools
+
+        selected = []
+        matched = False
+        for tool in self.tools:
+            name = tool["function"]["name"]
+            pattern = self.patterns.get(name)
+            if pattern is not None and pattern.search(text):
+                matched = True
+                selected.append(tool)
+
+            # tools without a lexicon cannot be routed, so they are always sent
+            elif pattern is None or name in self.always:
+                selected.append(tool)
+
+        # fall back to all tools rather than guessing
+        return selected if matched else self.tools
+
+
+def measure_tokens(llm_extractor, notes, results=None):
+    """
+    This function measures the average prompt tokens per note of the baseline
+    (all full tool schemas) against routing, compact schemas and both combined.
+    For the routed variants it also reports the share of notes getting all tools and,
+    given the resources of every note extracted with all tools (results), the resources
+    routing would have withheld by not sending their tool, and the remaining recall.
+    """
+
+    tools = llm_extractor.fhir_tools.tools
+    variants = {
+        "baseline": lambda text: tools,
+        "routed": ToolRouter(tools).select,
+        "compact": lambda text, compact=compact_tools(tools): compact,
+        "routed_compact": ToolRouter(tools, compact=True).select,
+    }
+
+    totals = dict.fromkeys(variants, 0)
+    all_tools = dict.fromkeys(variants, 0)
+    withheld = dict.fromkeys(variants, 0)
+    notes = list(notes)
+    results = list(results) if results is not None else None
+    for i, text in enumerate(notes):
+        messages = llm_extractor.messages(text)
+        for variant, select in variants.items():
+            selected = select(text)
+            totals[variant] += estimate_prompt_tokens(messages, selected)
+            all_tools[variant] += len(selected) == len(tools)
+
+            # resources of the note whose tool was not sent
+            if results is not None:
+                names = {tool["function"]["name"] for tool in selected}
+                withheld[variant] += sum(
+                    RESOURCE_TOOLS.get(resource.get("resourceType")) not in names
+                    for resource in results[i]
+                )
+
+    resources = sum(map(len, results)) if results is not None else 0
+    report = {}
+    for variant, total in totals.items():
+        average = total / len(notes) if notes else 0.0
+        report[variant] = {
+            "prompt_tokens": average,
+            "saved": 1 - total / totals["baseline"] if totals["baseline"] else 0.0,
+        }
+        if variant.startswith("routed"):
+            report[variant]["all_tools"] = all_tools[variant] / len(notes) if notes else 0.0
+            if results is not None:
+                report[variant]["withheld"] = withheld[variant]
+                report[variant]["recall"] = 1 - withheld[variant] / resources if resources else 1.0
+
+    return report
+
+
+async def measure_latency(llm_extractor, notes, max_concurrency=8):
+    """
+    This function runs the notes once with all tool schemas and once with the configured
+    router, reporting the wall time, the average latency, the prompt tokens and the
+    extracted resources of each run. For the routed run it also reports the change in
+    resources and the recall of the resources of the baseline run, over the notes
+    extracted by both. The response cache is bypassed, so both runs pay for real completions.
+    """
+
+    configured_router = llm_extractor.tool_router
+    router = configured_router or ToolRouter(llm_extractor.fhir_tools.tools)
+    response_cache = llm_extractor.response_cache
+    llm_extractor.response_cache = None
+
+    report = {}
+    runs = {}
+    try:
+        for variant, variant_router in (("baseline", None), ("routed", router)):
+            llm_extractor.tool_router = variant_router
+            start = time.monotonic()
+            runs[variant] = await llm_extractor.extract_many(
+                notes, max_concurrency=max_concurrency
+            )
+            elapsed = time.monotonic() - start
+            results = [result for result in runs[variant] if not isinstance(result, Exception)]
+            report[variant] = {
+                "seconds": elapsed,
+                "seconds_per_note": elapsed * min(max_concurrency, len(notes)) / len(notes)
+                if notes
+                else 0.0,
+                "prompt_tokens": sum(result.usage["prompt_tokens"] for result in results)
+                / max(1, len(results)),
+                "failed": len(notes) - len(results),
+                "resources": sum(len(result.resources) for result in results),
+            }
+    finally:
+        llm_extractor.tool_router = configured_router
+        llm_extractor.response_cache = response_cache
+
+    # compare the resources of the notes extracted by both runs
+    pairs = [
+        (baseline.resources, routed.resources)
+        for baseline, routed in zip(runs["baseline"], runs["routed"])
+        if not isinstance(baseline, Exception) and not isinstance(routed, Exception)
+    ]
+    report["routed"]["resources_change"] = sum(
+        len(routed) - len(baseline) for baseline, routed in pairs
+    )
+    report["routed"]["recall"] = recall(*zip(*pairs)) if pairs else 1.0
+
+    return report
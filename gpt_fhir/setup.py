@@ -11,5 +11,20 @@ setup(
         "fhirclient",
         "ols_client",
         "langchain",
+        "pyyaml",
+        "numpy",
+        "requests",
+        "scipy",
+        "pandas",
+        "pyarrow",
+        "aiohttp",
     ],
+    extras_require={
+        "test": ["pytest", "pytest-aiohttp"],
+    },
+    entry_points={
+        "console_scripts": [
+            "gpt-fhir=gpt_fhir.cli:main",
+        ],
+    },
 )
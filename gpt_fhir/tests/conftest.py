@@ -0,0 +1,85 @@
+import copy
+import pathlib
+import yaml
+import pytest
+from gpt_fhir.snomedIndex import normalize
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.fhirTools import FHIRTools
+from gpt_fhir.annotator import Annotator
+from gpt_fhir.llmExtractor import LLMExtractor
+from gpt_fhir.mockServers import MockServers, parse_trace
+
+# repository root, holding the example config, the data and the recorded trace
+ROOT = pathlib.Path(__file__).resolve().parents[2]
+
+
+class TraceAnnotator:
+    """
+    Annotator stand-in answering with the OLS annotations recorded in a trace.
+    """
+
+    def __init__(self, trace):
+        self.annotations = trace["annotations"]
+        self.ontology = "snomed"
+        self.calls = []
+
+    def run(self, text):
+        self.calls.append(text)
+        return self.annotations.get(normalize(text), [])
+
+    def run_many(self, terms, max_concurrency=8):
+        return [self.run(term) for term in terms]
+
+
+@pytest.fixture(scope="session")
+def trace():
+    """tool calls, annotations and latencies of the recorded extraction run"""
+    return parse_trace(ROOT / "notebooks" / "logs.txt")
+
+
+@pytest.fixture
+def config():
+    """the example config, without a real API key"""
+
+    with open(ROOT / "config.yaml.example") as f:
+        config = yaml.safe_load(f)
+    config["OPENAI"]["API_KEY"] = "mock"
+
+    return copy.deepcopy(config)
+
+
+@pytest.fixture
+def annotator(trace):
+    """annotator answering from the trace"""
+    return TraceAnnotator(trace)
+
+
+@pytest.fixture
+def servers(trace):
+    """OpenAI, OLS and FHIR stand-ins answering without latency"""
+
+    with MockServers(trace, latency_scale=0) as servers:
+        yield servers
+
+
+@pytest.fixture
+def mock_config(config, servers):
+    """the example config pointed at the stand-ins"""
+
+    config["OPENAI"]["BASE_URL"] = servers.openai_url
+    config["GENAI"]["FOLLOW_UP_COMPLETION"] = False
+    return config
+
+
+@pytest.fixture
+def llm_extractor(mock_config, servers):
+    """extraction stack against the stand-ins"""
+
+    fhir = FHIR(Annotator(base_url=servers.ols_url), mock_config)
+    return LLMExtractor(mock_config, FHIRTools(mock_config, fhir))
+
+
+@pytest.fixture
+def notes(trace):
+    """recorded notes, in trace order"""
+    return list(trace["notes"])
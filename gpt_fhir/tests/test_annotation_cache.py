@@ -0,0 +1,116 @@
+import types
+import pytest
+from gpt_fhir.annotator import Annotator
+from gpt_fhir.annotationCache import AnnotationCache
+
+ASTHMA = [{"obo_id": "SNOMED:195967001", "label": "Asthma"}]
+
+
+class SearchCounter(Annotator):
+    """annotator answering without OLS, counting its lookups"""
+
+    def __init__(self, cache):
+        super().__init__(cache=cache, base_url="http://localhost")
+        self.searched = []
+
+    def search(self, text):
+        self.searched.append(text)
+        return ASTHMA if "asthma" in text.lower() else []
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """settable time of the cache"""
+
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(
+        "gpt_fhir.annotationCache.time", types.SimpleNamespace(time=lambda: clock.now)
+    )
+    return clock
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = AnnotationCache(ttl=100, negative_ttl=10)
+    cache.set("Asthma", "snomed", ASTHMA)
+    cache.set("Unknown", "snomed", [])
+
+    # empty results expire first
+    clock.now += 11
+    assert cache.get("asthma", "snomed") == ASTHMA
+    assert cache.get("unknown", "snomed") is None
+
+    clock.now += 90
+    assert cache.get("asthma", "snomed") is None
+    assert cache.stats()["misses"] == 2
+
+
+def test_keys_are_normalized_per_ontology(clock):
+    cache = AnnotationCache()
+    cache.set("Type 2  Diabetes", "snomed", ASTHMA)
+
+    assert cache.get(" type 2 diabetes", "snomed") == ASTHMA
+    assert cache.get("type 2 diabetes", "icd10") is None
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    cache = AnnotationCache(max_entries=2)
+    cache.set("a", "snomed", ASTHMA)
+    cache.set("b", "snomed", ASTHMA)
+    cache.get("a", "snomed")
+    cache.set("c", "snomed", ASTHMA)
+
+    assert cache.get("b", "snomed") is None
+    assert cache.get("a", "snomed") == ASTHMA
+    assert cache.stats()["size"] == 2
+
+
+def test_disk_tier_survives_restarts(clock, tmp_path):
+    path = str(tmp_path / "annotations.sqlite")
+    AnnotationCache(path, ttl=100).set("Asthma", "snomed", ASTHMA)
+
+    cache = AnnotationCache(path)
+    assert cache.get("asthma", "snomed") == ASTHMA
+    assert cache.get("asthma", "snomed") == ASTHMA
+    assert cache.stats() == {
+        "hits": 1,
+        "disk_hits": 1,
+        "misses": 0,
+        "hit_rate": 1.0,
+        "size": 1,
+    }
+
+    # the stored expiry still holds after the restart
+    clock.now += 101
+    assert AnnotationCache(path).get("asthma", "snomed") is None
+
+
+def test_disk_tier_evicts_the_oldest_entries(clock, tmp_path):
+    cache = AnnotationCache(str(tmp_path / "annotations.sqlite"), max_disk_entries=2)
+    for term in ["a", "b", "c"]:
+        cache.set(term, "snomed", ASTHMA)
+        clock.now += 1
+
+    (size,) = cache.db.execute("SELECT COUNT(*) FROM annotations").fetchone()
+    assert size == 2
+    assert cache.db.execute("SELECT key FROM annotations WHERE key = 'snomed:a'").fetchone() is None
+
+
+def test_purge_drops_expired_entries(clock, tmp_path):
+    cache = AnnotationCache(str(tmp_path / "annotations.sqlite"), ttl=100, negative_ttl=10)
+    cache.set("Asthma", "snomed", ASTHMA)
+    cache.set("Unknown", "snomed", [])
+    clock.now += 11
+    cache.purge()
+
+    assert list(cache.memory) == ["snomed:asthma"]
+    assert cache.db.execute("SELECT key FROM annotations").fetchall() == [("snomed:asthma",)]
+
+
+def test_annotator_only_searches_cold_misses(clock):
+    annotator = SearchCounter(AnnotationCache())
+    for term in ["Asthma", "asthma ", "Unknown", "unknown"]:
+        annotator.run(term)
+
+    # "no annotation found" is cached too
+    assert annotator.searched == ["Asthma", "Unknown"]
+    assert annotator.run("ASTHMA") == ASTHMA
@@ -0,0 +1,65 @@
+import time
+import threading
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.annotator import Annotator
+from gpt_fhir.annotationCache import AnnotationCache
+from gpt_fhir.extractionContext import ExtractionContext
+
+
+class SlowAnnotator(Annotator):
+    """annotator answering after 0.1 s without OLS, recording its lookups"""
+
+    def __init__(self, cache=None):
+        super().__init__(cache=cache, base_url="http://localhost")
+        self.searched = []
+        self.lock = threading.Lock()
+
+    def search(self, text):
+        time.sleep(0.1)
+        with self.lock:
+            self.searched.append(text)
+        return [{"obo_id": f"SNOMED:{len(text)}", "label": text.strip().title()}]
+
+
+def test_run_many_resolves_every_distinct_term_once():
+    annotator = SlowAnnotator()
+    terms = ["Diabetes", "MRI", " diabetes", "Hypertension", "mri", "DIABETES", "Asthma"]
+    start = time.perf_counter()
+    annotations = annotator.run_many(terms, max_concurrency=4)
+
+    # four distinct terms, looked up concurrently with their first spelling
+    assert time.perf_counter() - start < 0.3
+    assert sorted(annotator.searched) == ["Asthma", "Diabetes", "Hypertension", "MRI"]
+
+    # results are fanned back out in input order
+    assert len(annotations) == len(terms)
+    assert [a[0]["label"] for a in annotations] == [
+        "Diabetes", "Mri", "Diabetes", "Hypertension", "Mri", "Diabetes", "Asthma"
+    ]
+
+
+def test_run_many_goes_through_the_cache():
+    annotator = SlowAnnotator(AnnotationCache())
+    annotator.run_many(["Diabetes", "MRI"])
+    annotator.run_many(["MRI", "Asthma", "diabetes"])
+
+    assert sorted(annotator.searched) == ["Asthma", "Diabetes", "MRI"]
+
+
+def test_prefetch_resolves_the_terms_of_a_batch_once():
+    annotator = SlowAnnotator()
+    fhir = FHIR(annotator)
+
+    # notes of a batch share their annotations
+    annotations = {}
+    first, second = ExtractionContext(1, annotations), ExtractionContext(2, annotations)
+    fhir.prefetch(["Diabetes", "MRI", "diabetes"], first)
+    fhir.prefetch(["MRI", "Asthma"], second)
+
+    assert sorted(annotator.searched) == ["Asthma", "Diabetes", "MRI"]
+    assert sorted(annotations) == ["asthma", "diabetes", "mri"]
+
+    # the writers use the prefetched annotations
+    fhir.write_condition({"condition": "Asthma", "clinicalStatus": "active"}, second)
+    assert annotator.searched.count("Asthma") == 1
+    assert second.resources[0]["code"]["coding"][0]["code"] == "6"
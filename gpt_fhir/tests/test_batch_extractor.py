@@ -0,0 +1,80 @@
+import json
+import pytest
+from gpt_fhir.snomedIndex import normalize
+from gpt_fhir.batchExtractor import BatchExtractor
+
+
+@pytest.fixture
+def batch_extractor(llm_extractor):
+    return BatchExtractor(llm_extractor, poll_interval=0)
+
+
+def test_write_input(batch_extractor, notes, tmp_path):
+    path = tmp_path / "input.jsonl"
+    assert batch_extractor.write_input(notes[:3], str(path)) == 3
+
+    requests = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [request["custom_id"] for request in requests] == ["0", "1", "2"]
+    assert requests[0]["url"] == "/v1/chat/completions"
+    assert requests[0]["body"]["tools"]
+    assert requests[0]["body"]["messages"][-1]["content"] == notes[0]
+
+
+def test_submit_wait_download_replay(batch_extractor, servers, trace, notes, tmp_path):
+    path = str(tmp_path / "input.jsonl")
+    batch_extractor.write_input({f"note-{i}": note for i, note in enumerate(notes[:5])}, path)
+
+    # the batch is polled until it completes
+    servers.batch_polls = 2
+    batch_id = batch_extractor.submit(path)
+    batch = batch_extractor.wait(batch_id)
+    assert batch.status == "completed"
+    assert servers.batches[batch_id]["polls"] == 3
+
+    results = batch_extractor.download(batch)
+    assert sorted(result["custom_id"] for result in results) == [f"note-{i}" for i in range(5)]
+
+    # every note gets the resources of its recorded tool calls
+    extractions = batch_extractor.replay(results)
+    for i, note in enumerate(notes[:5]):
+        extraction = extractions[f"note-{i}"]
+        assert [call["name"] for call in extraction.tool_calls] == [
+            call["name"] for call in trace["notes"][note]
+        ]
+        assert len(extraction.resources) == len(trace["notes"][note])
+        assert extraction.usage["prompt_tokens"] > 0
+
+
+def test_extract_resumes_by_batch_id(batch_extractor, notes, tmp_path):
+    path = str(tmp_path / "input.jsonl")
+    batch_extractor.write_input(notes[:2], path)
+    batch_id = batch_extractor.submit(path)
+
+    # a restarted backfill only needs the batch id
+    extractions = batch_extractor.extract(batch_id=batch_id)
+    assert sorted(extractions) == ["0", "1"]
+    assert all(extraction.resources for extraction in extractions.values())
+
+
+def test_failed_requests_get_their_error(batch_extractor, servers, notes, tmp_path):
+    servers.failing_notes = {normalize(notes[1])}
+
+    extractions = batch_extractor.extract(notes[:3], path=str(tmp_path / "input.jsonl"))
+    assert isinstance(extractions["1"], RuntimeError)
+    assert "batch request failed" in str(extractions["1"])
+    assert extractions["0"].resources and extractions["2"].resources
+
+
+def test_expired_batch_errors_every_note(batch_extractor, servers, notes, tmp_path):
+    servers.batch_status = "expired"
+
+    extractions = batch_extractor.extract(notes[:2], path=str(tmp_path / "input.jsonl"))
+    assert sorted(extractions) == ["0", "1"]
+    assert all("batch_expired" in str(extraction) for extraction in extractions.values())
+
+
+def test_failed_batch_raises(batch_extractor, servers, notes, tmp_path):
+    servers.batch_status = "failed"
+
+    with pytest.raises(RuntimeError, match="ended failed without results"):
+        batch_extractor.extract(notes[:2], path=str(tmp_path / "input.jsonl"))
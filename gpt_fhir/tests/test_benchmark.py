@@ -0,0 +1,75 @@
+import json
+import pytest
+from conftest import ROOT
+from gpt_fhir.metrics import metrics
+from gpt_fhir.benchmark import compare, percentile, read_corpus, run_benchmark, summarize
+
+TRACE = ROOT / "notebooks" / "logs.txt"
+
+
+def report(throughput=10.0, p95=0.5, memory=1000):
+    return {
+        "throughput": throughput,
+        "stages": {"completion": {"p95": p95}},
+        "peak_memory_bytes": memory,
+    }
+
+
+def test_percentiles_are_nearest_rank():
+    samples = [float(i) for i in range(1, 101)]
+
+    assert percentile(samples, 50) == 50.0
+    assert percentile(samples, 99) == 99.0
+    assert percentile([], 95) == 0.0
+    assert summarize([3.0, 1.0, 2.0]) == {
+        "count": 3,
+        "mean": 2.0,
+        "p50": 2.0,
+        "p95": 3.0,
+        "p99": 3.0,
+    }
+
+
+def test_corpus_is_repeated_up_to_size(tmp_path):
+    path = tmp_path / "notes.csv"
+    path.write_text('note\n"first, note"\nsecond\n')
+
+    assert read_corpus(str(path)) == ["first, note", "second"]
+    assert read_corpus(str(path), size=5) == ["first, note", "second"] * 2 + ["first, note"]
+
+
+def test_trace_holds_tool_calls_and_latencies(trace):
+    assert len(trace["notes"]) == 60
+    for stage in ["completion", "annotation", "follow_up"]:
+        assert trace["latency"][stage]
+        assert all(seconds >= 0 for seconds in trace["latency"][stage])
+    assert all(call["term"] for calls in trace["notes"].values() for call in calls)
+
+
+@pytest.mark.parametrize(
+    "changed, regressions",
+    [
+        (report(throughput=9.5, p95=0.54, memory=1090), []),
+        (report(throughput=8.0), ["throughput 8.00 < 10.00 notes/s"]),
+        (report(p95=0.6), ["completion p95 0.600000s > 0.500000s"]),
+        (report(memory=1200), ["peak memory 1200 > 1000 bytes"]),
+    ],
+)
+def test_regressions_beyond_the_tolerance_are_listed(changed, regressions):
+    assert compare(report(), changed, tolerance=0.1) == regressions
+
+
+def test_benchmark_replays_the_corpus(config, notes):
+    result = run_benchmark(config, notes[:6], str(TRACE), concurrency=3, latency_scale=0)
+
+    assert result["notes"] == 6
+    assert result["failed"] == 0
+    assert result["throughput"] > 0
+    assert result["resources"] > 0
+    for stage in ["extraction", "completion", "tool_call", "fhir_write", "annotation"]:
+        assert result["stages"][stage]["count"] > 0
+    assert result["peak_memory_bytes"] > 0
+
+    # the report is saved as JSON, and the instrumentation is left as it was
+    assert json.loads(json.dumps(result)) == result
+    assert not metrics.enabled
@@ -0,0 +1,124 @@
+import os
+import gzip
+import json
+import shutil
+from gpt_fhir.bulkExport import BulkExporter
+
+
+def condition(i):
+    return {"resourceType": "Condition", "id": str(i)}
+
+
+def read(path):
+    with gzip.open(path, "rt") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_parts_are_renamed_when_complete(tmp_path):
+    exporter = BulkExporter(str(tmp_path), max_bytes=100)
+    for i in range(6):
+        exporter.add(condition(i))
+    assert any(name.endswith(".tmp") for name in os.listdir(tmp_path))
+
+    manifest = exporter.close()
+    assert not any(name.endswith(".tmp") for name in os.listdir(tmp_path))
+    assert sum(output["count"] for output in manifest["output"]) == 6
+    ids = [resource["id"] for output in manifest["output"] for resource in read(output["url"])]
+    assert ids == [str(i) for i in range(6)]
+
+
+def test_resume_recovers_the_parts_of_a_crashed_run(tmp_path):
+    crashed = tmp_path / "crashed"
+    exporter = BulkExporter(str(crashed))
+    for i in range(5):
+        exporter.add(condition(i))
+    exporter.flush()
+    exporter.add(condition(5))
+
+    # the process dies with the part half written
+    data = (crashed / "Condition.001.ndjson.gz.tmp").read_bytes()
+    export = tmp_path / "export"
+    export.mkdir()
+    (export / "Condition.001.ndjson.gz.tmp").write_bytes(data[:-3])
+
+    resumed = BulkExporter(str(export))
+    resumed.add(condition(6))
+    manifest = resumed.close()
+
+    assert sorted(os.listdir(export)) == [
+        "Condition.001.ndjson.gz",
+        "Condition.002.ndjson.gz",
+        "manifest.json",
+    ]
+    assert [output["count"] for output in manifest["output"]] == [5, 1]
+    assert [resource["id"] for resource in read(export / "Condition.001.ndjson.gz")] == [
+        str(i) for i in range(5)
+    ]
+
+
+def test_resume_counts_the_complete_lines_of_a_truncated_part(tmp_path):
+    exporter = BulkExporter(str(tmp_path))
+    for i in range(50):
+        exporter.add(condition(i))
+    exporter.close()
+
+    # a part cut off in the middle of its gzip stream
+    path = tmp_path / "Condition.001.ndjson.gz"
+    data = path.read_bytes()
+    path.write_bytes(data[: len(data) // 2])
+
+    resumed = BulkExporter(str(tmp_path))
+    assert 0 < resumed.outputs[0]["count"] < 50
+    assert resumed.parts == {"Condition": 1}
+
+
+def test_resume_drops_empty_unfinished_parts(tmp_path):
+    shutil.copyfile(os.devnull, tmp_path / "Procedure.001.ndjson.gz.tmp")
+
+    resumed = BulkExporter(str(tmp_path))
+    assert resumed.outputs == []
+    assert os.listdir(tmp_path) == []
+
+
+def test_resume_drops_the_resources_after_the_last_checkpoint(tmp_path):
+    crashed = tmp_path / "crashed"
+    exporter = BulkExporter(str(crashed), max_bytes=100, checkpoints=True)
+    for i in range(5):
+        exporter.add(condition(i))
+    exporter.checkpoint()
+
+    # the process dies after the sink flush, before the notes are checkpointed
+    for i in range(5, 8):
+        exporter.add(condition(i))
+    exporter.flush()
+    export = tmp_path / "export"
+    shutil.copytree(crashed, export)
+
+    # the notes are extracted again
+    resumed = BulkExporter(str(export), max_bytes=100, checkpoints=True)
+    for i in range(5, 8):
+        resumed.add(condition(i))
+    manifest = resumed.close()
+
+    ids = [resource["id"] for output in manifest["output"] for resource in read(output["url"])]
+    assert sorted(ids, key=int) == [str(i) for i in range(8)]
+    assert sum(output["count"] for output in manifest["output"]) == 8
+    assert not any(name.endswith((".tmp", ".recovering")) for name in os.listdir(export))
+
+
+def test_resume_drops_a_run_crashing_before_its_first_checkpoint(tmp_path):
+    crashed = tmp_path / "crashed"
+    with BulkExporter(str(crashed), checkpoints=True) as exporter:
+        exporter.add(condition(0))
+
+    # the next run dies before it completes any note
+    exporter = BulkExporter(str(crashed), checkpoints=True)
+    exporter.add(condition(1))
+    exporter.flush()
+    export = tmp_path / "export"
+    shutil.copytree(crashed, export)
+
+    resumed = BulkExporter(str(export), checkpoints=True)
+    assert [output["count"] for output in resumed.outputs] == [1]
+    assert resumed.parts == {"Condition": 2}
+    assert "Condition.002.ndjson.gz.tmp" not in os.listdir(export)
@@ -0,0 +1,43 @@
+import pytest
+from gpt_fhir.cascade import Cascade
+from gpt_fhir.columnar import key_elements
+from gpt_fhir.extractionContext import ExtractionContext
+
+
+@pytest.fixture
+def cascade(llm_extractor, mock_config):
+    """cascade in front of the extraction stack against the stand-ins"""
+    return Cascade(llm_extractor, mock_config)
+
+
+def resource_types(result):
+    return sorted(key_elements(resource)["resource_type"] for resource in result.resources)
+
+
+def test_simple_notes_are_extracted_locally(cascade):
+    text = "Patient has been taking Lisinopril."
+    result, reason = cascade.extract_local(text, ExtractionContext())
+
+    assert reason is None
+    assert result.tier == "local"
+    assert resource_types(result) == ["MedicationStatement"]
+
+
+@pytest.mark.parametrize(
+    "text, reason",
+    [
+        ("Mentioned taking Omeprazole for acid reflux regularly.", "reason"),
+        ("Patient is taking Lisinopril because of hypertension.", "reason"),
+        ("Patient is taking Omeprazole. Acid reflux.", "residual"),
+    ],
+)
+def test_notes_with_unmatched_conditions_are_escalated(cascade, text, reason):
+    assert cascade.extract_local(text, ExtractionContext()) == (None, reason)
+
+
+def test_escalated_notes_keep_their_condition(cascade):
+    result = cascade.extract("Mentioned taking Omeprazole for acid reflux regularly.")
+
+    assert result.tier == "llm"
+    assert resource_types(result) == ["Condition", "MedicationStatement"]
+    assert cascade.report()["escalations"] == {"reason": 1}
@@ -0,0 +1,133 @@
+import csv
+import gzip
+import json
+import yaml
+import pytest
+from gpt_fhir import cli
+from gpt_fhir.columnar import read_resources
+from gpt_fhir.snomedIndex import normalize
+
+
+@pytest.fixture
+def run(mock_config, servers, notes, tmp_path, monkeypatch):
+    """run gpt-fhir extract over the first notes of the trace"""
+
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(yaml.safe_dump(mock_config))
+    input_path = tmp_path / "notes.csv"
+    with open(input_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "note"])
+        writer.writerows((f"n{i}", note) for i, note in enumerate(notes[:4]))
+
+    def run(*options):
+        monkeypatch.setattr(
+            "sys.argv",
+            [
+                "gpt-fhir",
+                "extract",
+                str(input_path),
+                str(tmp_path / "out.ndjson"),
+                "--config",
+                str(config_path),
+                "--ols-url",
+                servers.ols_url,
+                "--chunk-size",
+                "2",
+                *options,
+            ],
+        )
+        cli.main()
+
+    return run
+
+
+def read(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def read_bulk(path):
+    with gzip.open(path, "rt") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_failed_notes_are_retried_without_duplicates(run, servers, notes, tmp_path):
+    servers.failing_notes = {normalize(notes[1])}
+    run()
+
+    assert [record["note_id"] for record in read(tmp_path / "out.ndjson")] == ["n0", "n2", "n3"]
+    assert [record["note_id"] for record in read(tmp_path / "out.ndjson.errors")] == ["n1"]
+    assert (tmp_path / "out.ndjson.done").read_text().split() == ["n0", "n2", "n3"]
+
+    # the next run only extracts the failed note
+    servers.failing_notes = set()
+    run()
+
+    records = read(tmp_path / "out.ndjson")
+    assert [record["note_id"] for record in records] == ["n0", "n2", "n3", "n1"]
+    assert all("error" not in record for record in records)
+
+
+def test_results_written_before_a_crash_are_not_repeated(run, tmp_path):
+    run()
+
+    # a crash after writing results, before checkpointing them, and in the middle of a line
+    (tmp_path / "out.ndjson.done").write_text("n0\n")
+    with open(tmp_path / "out.ndjson", "a") as f:
+        f.write('{"note_id": "n9", "resou')
+    run()
+
+    records = read(tmp_path / "out.ndjson")
+    assert [record["note_id"] for record in records] == ["n0", "n1", "n2", "n3"]
+
+
+def test_resumed_runs_complete_the_columnar_and_bulk_exports(run, servers, notes, tmp_path):
+    options = ["--columnar", str(tmp_path / "resources"), "--bulk-export", str(tmp_path / "bulk")]
+    servers.failing_notes = {normalize(notes[2])}
+    run(*options)
+    servers.failing_notes = set()
+    run(*options)
+
+    # every note has its resources once, across the partitions of both runs
+    records = read(tmp_path / "out.ndjson")
+    rows = read_resources(str(tmp_path / "resources"))
+    assert len(list((tmp_path / "resources").iterdir())) == 2
+    assert rows.groupby("note_id").size().to_dict() == {
+        record["note_id"]: len(record["resources"]) for record in records
+    }
+
+    manifest = json.loads((tmp_path / "bulk" / "manifest.json").read_text())
+    assert sum(output["count"] for output in manifest["output"]) == len(rows)
+
+
+def test_resumed_bulk_exports_hold_the_resources_of_every_note_once(
+    run, tmp_path, monkeypatch
+):
+    # the run dies after the sinks are flushed, before the second chunk is written
+    result_record = cli.result_record
+
+    def crash(note_id, result):
+        if note_id == "n2":
+            raise KeyboardInterrupt
+        return result_record(note_id, result)
+
+    monkeypatch.setattr(cli, "result_record", crash)
+    with pytest.raises(KeyboardInterrupt):
+        run("--bulk-export", str(tmp_path / "bulk"))
+    monkeypatch.setattr(cli, "result_record", result_record)
+    run("--bulk-export", str(tmp_path / "bulk"))
+
+    records = read(tmp_path / "out.ndjson")
+    manifest = json.loads((tmp_path / "bulk" / "manifest.json").read_text())
+    exported = [
+        json.dumps(resource, sort_keys=True)
+        for output in manifest["output"]
+        for resource in read_bulk(output["url"])
+    ]
+    extracted = [
+        json.dumps(resource, sort_keys=True)
+        for record in records
+        for resource in record["resources"]
+    ]
+    assert [record["note_id"] for record in records] == ["n0", "n1", "n2", "n3"]
+    assert sorted(exported) == sorted(extracted)
@@ -0,0 +1,57 @@
+import os
+from gpt_fhir.columnar import ColumnarDatasetWriter, iter_rows, read_resources
+
+
+def condition(code):
+    return {"resourceType": "Condition", "code": {"coding": [{"code": code}]}}
+
+
+def test_resumed_runs_replace_the_resources_of_their_notes(tmp_path):
+    path = str(tmp_path / "resources")
+
+    # the first run is interrupted after writing n0 and part of n1
+    first = ColumnarDatasetWriter(path, row_group_size=2)
+    first.add(condition("1"), "n0")
+    first.add(condition("2"), "n1")
+    first.add(condition("3"), "n1")
+
+    # the resumed run extracts n1 again and n2
+    second = ColumnarDatasetWriter(path, row_group_size=2)
+    second.add(condition("4"), "n1")
+    second.add(condition("5"), "n2")
+    second.add(condition("6"), None)
+    second.close()
+
+    rows = read_resources(path, columns=["note_id", "code"])
+    assert sorted(map(tuple, rows.fillna("-").values)) == [
+        ("-", "6"),
+        ("n0", "1"),
+        ("n1", "4"),
+        ("n2", "5"),
+    ]
+    assert sorted(row["code"] for row in iter_rows(path, batch_size=1)) == ["1", "4", "5", "6"]
+
+    filtered = read_resources(path, filters=[("code", "in", ["1", "2", "4"])])
+    assert sorted(filtered["code"]) == ["1", "4"]
+    assert "run" not in filtered
+
+
+def test_unfinished_part_files_are_ignored(tmp_path):
+    path = str(tmp_path / "resources")
+    writer = ColumnarDatasetWriter(path, row_group_size=1)
+    writer.add(condition("1"), "n0")
+
+    # a part file the process died writing
+    with open(os.path.join(writer.directory, ".part-00001.parquet.tmp"), "wb") as f:
+        f.write(b"PAR1")
+
+    assert read_resources(path)["code"].tolist() == ["1"]
+
+
+def test_empty_dataset(tmp_path):
+    path = str(tmp_path / "resources")
+    ColumnarDatasetWriter(path).close()
+    os.makedirs(path, exist_ok=True)
+
+    assert read_resources(path).empty
+    assert list(iter_rows(path)) == []
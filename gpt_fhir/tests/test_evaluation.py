@@ -0,0 +1,66 @@
+import json
+from gpt_fhir import cli
+from gpt_fhir.columnar import ColumnarWriter, read_resources
+from gpt_fhir.evaluation import Evaluator
+
+
+def condition(code, status):
+    return {
+        "resourceType": "Condition",
+        "code": {"coding": [{"code": code, "display": f"condition {code}"}]},
+        "clinicalStatus": {"text": status},
+    }
+
+
+TRUTH = [[condition("1", "active")], [condition("2", "Resolved")]]
+EXTRACTED = [[condition("1", " Active ")], [condition("2", "re  solved"), condition("3", "active")]]
+
+
+def test_scores_without_attribute_checks():
+    report = Evaluator(attributes=[]).evaluate(TRUTH, EXTRACTED)
+
+    assert report["scores"].loc["all", "tp"] == 2
+    assert report["scores"].loc["all", "fp"] == 1
+    assert report["attributes"].empty
+
+
+def test_status_is_normalized_alike_for_columnar_files(tmp_path):
+    path = str(tmp_path / "extracted.parquet")
+    with ColumnarWriter(path) as writer:
+        for note_id, resources in enumerate(EXTRACTED):
+            for resource in resources:
+                writer.add(resource, note_id)
+
+    evaluator = Evaluator(attributes=["status"])
+    from_dicts = evaluator.frame(EXTRACTED)
+    from_file = evaluator.frame(read_resources(path))
+
+    assert from_file["status"].tolist() == from_dicts["status"].tolist()
+    assert from_file["status"].tolist() == ["active", "re solved", "active"]
+    accuracy = evaluator.evaluate(TRUTH, read_resources(path))["attributes"]["accuracy"]
+    assert accuracy.to_dict() == {("Condition", "status"): 0.5}
+
+
+def test_cli_evaluate_without_attributes(tmp_path, monkeypatch, capsys):
+    for name, results in (("truth", TRUTH), ("extracted", EXTRACTED)):
+        with open(tmp_path / f"{name}.ndjson", "w") as f:
+            for note_id, resources in enumerate(results):
+                f.write(json.dumps({"note_id": str(note_id), "resources": resources}) + "\n")
+
+    monkeypatch.setattr(
+        "sys.argv",
+        [
+            "gpt-fhir",
+            "evaluate",
+            str(tmp_path / "truth.ndjson"),
+            str(tmp_path / "extracted.ndjson"),
+            "--attributes",
+            "--output",
+            str(tmp_path / "report.json"),
+        ],
+    )
+    cli.main()
+
+    report = json.loads((tmp_path / "report.json").read_text())
+    assert report["scores"]["all"]["tp"] == 2
+    assert report["attributes"] == []
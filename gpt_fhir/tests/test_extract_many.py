@@ -0,0 +1,63 @@
+import asyncio
+
+
+def names(result):
+    return [tool_call["name"] for tool_call in result.tool_calls]
+
+
+def arguments(result):
+    return [tool_call["arguments"] for tool_call in result.tool_calls]
+
+
+def recorded(trace, note):
+    return [call["name"] for call in trace["notes"][note]]
+
+
+async def test_results_are_in_input_order(llm_extractor, trace, notes):
+    notes = notes[:10]
+    results = await llm_extractor.extract_many(notes, max_concurrency=4)
+
+    assert [names(result) for result in results] == [recorded(trace, note) for note in notes]
+    assert all(result.resources for result in results)
+
+
+async def test_at_most_max_concurrency_notes_are_in_flight(llm_extractor, notes):
+    create = llm_extractor.async_client.chat.completions.create
+    in_flight = peak = 0
+
+    async def slow_create(**kwargs):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.02)
+        try:
+            return await create(**kwargs)
+        finally:
+            in_flight -= 1
+
+    llm_extractor.async_client.chat.completions.create = slow_create
+    await llm_extractor.extract_many(notes[:9], max_concurrency=3)
+
+    assert peak == 3
+
+
+async def test_failures_are_isolated_per_note(llm_extractor, notes):
+    create = llm_extractor.async_client.chat.completions.create
+
+    async def failing_create(**kwargs):
+        if kwargs["messages"][-1]["content"] == notes[1]:
+            raise RuntimeError("model unavailable")
+        return await create(**kwargs)
+
+    llm_extractor.async_client.chat.completions.create = failing_create
+    results = await llm_extractor.extract_many(notes[:3], max_concurrency=3)
+
+    assert isinstance(results[1], RuntimeError)
+    assert results[0].resources and results[2].resources
+
+
+async def test_async_and_sync_extractions_agree(llm_extractor, notes):
+    results = await llm_extractor.extract_many(notes[:3])
+
+    for note, result in zip(notes, results):
+        assert arguments(llm_extractor.extract(note)) == arguments(result)
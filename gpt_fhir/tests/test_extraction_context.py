@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.extractionContext import ExtractionContext
+
+ASTHMA = {"condition": "Asthma", "clinicalStatus": "active"}
+
+
+def test_writers_collect_into_the_context(annotator):
+    annotator.annotations["asthma"] = [{"obo_id": "SNOMED:195967001", "label": "Asthma"}]
+    fhir = FHIR(annotator)
+    context = ExtractionContext("n1")
+    fhir.write_condition(ASTHMA, context)
+
+    assert fhir.get_resources() == []
+    assert [r["code"]["coding"][0]["code"] for r in context.resources] == ["195967001"]
+
+    # without a context the shared list is used, as before
+    fhir.write_condition(ASTHMA)
+    assert fhir.get_resources() == context.resources
+
+
+def test_one_stack_serves_concurrent_extractions(llm_extractor, notes):
+    notes = notes[:12]
+    alone = [llm_extractor.extract(note).resources for note in notes]
+
+    contexts = [ExtractionContext(note_id=i) for i in range(len(notes))]
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(llm_extractor.extract, notes, contexts))
+
+    # every note gets exactly its own resources
+    for result, context, resources in zip(results, contexts, alone):
+        assert result.resources is context.resources
+        assert result.resources == resources
+    assert llm_extractor.fhir_tools.fhir.get_resources() == []
@@ -0,0 +1,135 @@
+import asyncio
+import time
+from types import SimpleNamespace
+import pytest
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.fhirSink import FHIRSink
+
+
+def condition(i):
+    return {"resourceType": "Condition", "subject": {"reference": "Patient/1"}, "id": str(i)}
+
+
+@pytest.fixture
+def sink(servers):
+    """sink of small Bundles to the FHIR stand-in, retrying without backoff"""
+
+    with FHIRSink(servers.fhir_url, bundle_size=2, max_in_flight=2) as sink:
+        sink.session.get_adapter(servers.fhir_url).max_retries.backoff_factor = 0
+        yield sink
+
+
+def test_bundles_are_stored_and_invalid_entries_recorded(sink, servers):
+    for i in range(4):
+        sink.add(condition(i), note_id=f"n{i}")
+    sink.add({"resourceType": "Procedure"}, note_id="n4")
+    sink.flush()
+
+    assert servers.stored == {"Condition": 4}
+    assert sink.stats() == {"bundles": 3, "written": 4, "failed": 1, "queued": 0}
+    assert sink.errors[0]["note_id"] == "n4"
+
+
+def test_rejected_bundles_are_retried(sink, servers):
+    servers.fhir_errors = [(503, {"Retry-After": "0"}, False), (429, {"Retry-After": "0"}, False)]
+    sink.add(condition(0))
+    sink.add(condition(1))
+    sink.flush()
+
+    assert servers.stored == {"Condition": 2}
+    assert sink.stats()["failed"] == 0
+
+
+@pytest.mark.parametrize(
+    "error", [(502, None, True), (504, None, True), (503, None, False), (500, None, True)]
+)
+def test_possibly_stored_bundles_are_not_retried(sink, servers, error):
+    servers.fhir_errors = [error]
+    sink.add(condition(0))
+    sink.add(condition(1))
+    sink.flush()
+
+    # a Bundle stored before the error is not sent again
+    assert servers.stored == ({"Condition": 2} if error[2] else {})
+    assert sink.stats()["failed"] == 2
+    assert servers.fhir_errors == []
+
+
+class SlowSink:
+    """sink blocking on every resource, like a FHIRSink with all Bundles in flight"""
+
+    def __init__(self):
+        self.added = []
+
+    def add(self, resource, note_id=None):
+        time.sleep(0.2)
+        self.added.append(note_id)
+
+
+async def test_apublish_does_not_block_the_event_loop(config, annotator):
+    fhir = FHIR(annotator, config)
+    sink = SlowSink()
+    fhir.add_sink(sink)
+
+    # the loop keeps ticking while the sink blocks
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    ticker = asyncio.create_task(tick())
+    await fhir.apublish([condition(0)], "n0")
+    ticker.cancel()
+
+    assert sink.added == ["n0"]
+    assert ticks > 5
+
+
+async def test_extracted_resources_reach_the_server(llm_extractor, servers, notes):
+    fhir = llm_extractor.fhir_tools.fhir
+    fhir.add_sink(FHIRSink(servers.fhir_url, bundle_size=5))
+
+    results = await llm_extractor.extract_many(notes[:4], note_ids=["a", "b", "c", "d"])
+    fhir.close()
+
+    assert sum(servers.stored.values()) == sum(len(result.resources) for result in results)
+
+
+def test_entries_left_out_of_the_response_fail(sink):
+    # the server answers for the first entry of the Bundle only
+    response = {"entry": [{"response": {"status": "201 Created"}}]}
+    sink.session.post = lambda *args, **kwargs: SimpleNamespace(
+        status_code=200, json=lambda: response, text=""
+    )
+    sink.add(condition(0), note_id="n0")
+    sink.add(condition(1), note_id="n1")
+    sink.flush()
+
+    assert sink.stats() == {"bundles": 1, "written": 1, "failed": 1, "queued": 0}
+    assert sink.errors[0]["note_id"] == "n1"
+    assert sink.errors[0]["status"] is None
+
+
+def test_resent_notes_are_stored_once(sink, servers):
+    # a resumed run sends the resources of a note again
+    for _ in range(2):
+        sink.add(condition(0), note_id="n0")
+        sink.add(condition(1), note_id="n0")
+        sink.flush()
+    sink.add(condition(0), note_id="n1")
+    sink.flush()
+
+    assert servers.stored == {"Condition": 3}
+    assert sink.stats()["failed"] == 0
+
+
+def test_own_identifiers_are_kept(sink):
+    resource = {**condition(0), "identifier": [{"system": "urn:test", "value": "c0"}]}
+    entry = sink.entry("n0", resource)
+
+    assert entry["resource"]["identifier"] == resource["identifier"]
+    assert entry["request"]["ifNoneExist"] == "identifier=urn:test|c0"
+    assert "ifNoneExist" not in sink.entry(None, condition(0))["request"]
@@ -0,0 +1,59 @@
+import time
+import pytest
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.fhirTools import FHIRTools
+from gpt_fhir.metrics import MetricsHook, metrics
+from gpt_fhir.llmExtractor import LLMExtractor
+
+
+class SpanRecorder(MetricsHook):
+    """metrics consumer keeping every span"""
+
+    def __init__(self):
+        self.spans = []
+
+    def on_span(self, name, seconds, labels):
+        self.spans.append((name, seconds, labels))
+
+
+@pytest.fixture
+def recorder():
+    """spans recorded with the instrumentation enabled for one test"""
+
+    recorder = SpanRecorder()
+    metrics.add_hook(recorder)
+    metrics.enable(exporter=False)
+    yield recorder
+    metrics.remove_hook(recorder)
+    metrics.disable()
+
+
+def test_config_does_not_enable_metrics(config, annotator):
+    config["METRICS"] = {"ENABLED": True}
+    LLMExtractor(config, FHIRTools(config, FHIR(annotator, config)))
+
+    assert not metrics.enabled
+
+
+def test_streamed_completion_span_ends_with_the_stream(mock_config, servers, annotator, recorder):
+    mock_config["GENAI"]["STREAM"] = True
+    fhir = FHIR(annotator, mock_config)
+    llm_extractor = LLMExtractor(mock_config, FHIRTools(mock_config, fhir))
+
+    # every chunk of the stream takes a while to arrive
+    create = llm_extractor.client.chat.completions.create
+    chunks = []
+
+    def slow_create(**kwargs):
+        for chunk in create(**kwargs):
+            time.sleep(0.01)
+            chunks.append(chunk)
+            yield chunk
+
+    llm_extractor.client.chat.completions.create = slow_create
+    result = llm_extractor.extract(next(iter(servers.trace["notes"])))
+
+    completions = [seconds for name, seconds, _ in recorder.spans if name == "completion"]
+    assert result.resources
+    assert len(completions) == 1
+    assert completions[0] >= 0.01 * len(chunks)
@@ -0,0 +1,104 @@
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.fhirTools import FHIRTools
+from gpt_fhir.annotator import Annotator
+from gpt_fhir.llmExtractor import LLMExtractor
+from gpt_fhir.columnar import key_elements
+from gpt_fhir.noteChunker import NoteChunker, merge_resources, split_sections, split_sentences
+
+CODE_PATHS = {"Condition": "code"}
+
+SUMMARY = """HISTORY:
+Patient has a long history of asthma. Symptoms worsened over the winter.
+He was admitted with shortness of breath.
+
+HOSPITAL COURSE:
+A chest X-ray showed pneumonia. Antibiotics were started on admission.
+Fever resolved on day three. Oxygen was weaned off.
+
+MEDICATIONS:
+Amoxicillin was continued for five days."""
+
+
+def condition(code, **elements):
+    coding = [{"system": "http://snomed.info/sct", "code": code}]
+    return {"code": {"coding": coding}, **elements, "resourceType": "Condition"}
+
+
+def test_short_notes_are_one_window():
+    chunker = NoteChunker(max_chars=len(SUMMARY))
+    assert chunker.windows(SUMMARY) == [SUMMARY]
+
+
+def test_windows_overlap_by_whole_sentences():
+    windows = NoteChunker(max_chars=120, overlap=1).windows(SUMMARY)
+
+    assert len(windows) > 2
+    assert all(len(window) <= 120 for window in windows)
+
+    # every window starts with the last sentence of the one before
+    for previous, window in zip(windows, windows[1:]):
+        assert window.startswith(split_sentences(previous)[-1])
+
+    # and no sentence is lost or cut
+    for section in split_sections(SUMMARY):
+        for sentence in split_sentences(section):
+            assert any(sentence in window for window in windows)
+
+
+def test_sections_that_fit_start_a_new_window():
+    windows = NoteChunker(max_chars=150, overlap=0).windows(SUMMARY)
+
+    assert [window.split(":")[0] for window in windows] == [
+        "HISTORY",
+        "HOSPITAL COURSE",
+        "MEDICATIONS",
+    ]
+
+
+def test_duplicates_of_overlapping_windows_are_merged():
+    resources = [
+        condition("195967001", clinicalStatus={"text": "active"}, note=[{"text": "winter"}]),
+        condition("233604007"),
+        condition("195967001", onsetDateTime="2020", note=[{"text": "winter"}, {"text": "mild"}]),
+        {"resourceType": "Condition", "code": {"text": "uncoded"}},
+    ]
+
+    merged = merge_resources(resources, CODE_PATHS)
+
+    assert len(merged) == 3
+    assert merged[0] == condition(
+        "195967001",
+        clinicalStatus={"text": "active"},
+        note=[{"text": "winter"}, {"text": "mild"}],
+        onsetDateTime="2020",
+    )
+    assert list(merged[0])[-1] == "resourceType"
+    assert merged[2]["code"] == {"text": "uncoded"}
+
+
+def test_chunked_extraction_finds_the_findings_of_every_window(mock_config, servers, notes):
+    def build(chunking):
+        if chunking is not None:
+            mock_config["GENAI"]["CHUNKING"] = chunking
+        fhir = FHIR(Annotator(base_url=servers.ols_url), mock_config)
+        return LLMExtractor(mock_config, FHIRTools(mock_config, fhir))
+
+    def codes(resources):
+        return {(key_elements(r)["resource_type"], key_elements(r)["code"]) for r in resources}
+
+    # windows large enough for any single note
+    notes = notes[:4]
+    max_chars = max(len(note) for note in notes) + 100
+    single = build(None)
+    chunked = build({"MAX_CHARS": max_chars, "OVERLAP": 1})
+
+    # short notes are extracted exactly as without chunking
+    assert chunked.extract(notes[0]).resources == single.extract(notes[0]).resources
+
+    # a long note gets the resources of all its parts, each once
+    long_note = "\n\n".join(notes)
+    assert len(chunked.windows(long_note)) > 1
+    resources = chunked.extract(long_note).resources
+    expected = set().union(*(codes(single.extract(note).resources) for note in notes))
+    assert codes(resources) == expected
+    assert len(resources) == len(codes(resources))
@@ -0,0 +1,156 @@
+import json
+import pytest
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.fhirTools import FHIRTools
+from gpt_fhir.annotator import Annotator
+from gpt_fhir.llmExtractor import LLMExtractor
+from gpt_fhir.metrics import MetricsHook, metrics
+from gpt_fhir.columnar import key_elements
+
+
+class CountRecorder(MetricsHook):
+    """metrics consumer summing every counter and counting every span"""
+
+    def __init__(self):
+        self.counts = {}
+
+    def on_span(self, name, seconds, labels):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def on_count(self, name, value, labels):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+
+class PublishedSink:
+    """sink keeping the note id every resource was published with"""
+
+    def __init__(self):
+        self.published = []
+
+    def add(self, resource, note_id=None):
+        self.published.append((note_id, resource))
+
+
+@pytest.fixture
+def counts():
+    """counters recorded with the instrumentation enabled for one test"""
+
+    recorder = CountRecorder()
+    metrics.add_hook(recorder)
+    metrics.enable(exporter=False)
+    yield recorder.counts
+    metrics.remove_hook(recorder)
+    metrics.disable()
+
+
+def build(config, servers, packing):
+    """extraction stack against the stand-ins, with or without packing"""
+
+    if packing:
+        config["GENAI"]["PACKING"] = {"ENABLED": True, "TOKEN_BUDGET": 8000, "MAX_NOTES": 4}
+    else:
+        config["GENAI"].pop("PACKING", None)
+    fhir = FHIR(Annotator(base_url=servers.ols_url), config)
+    return LLMExtractor(config, FHIRTools(config, fhir))
+
+
+def codes(resources):
+    return sorted((key_elements(r)["resource_type"], key_elements(r)["code"]) for r in resources)
+
+
+async def test_packed_resources_get_their_note_id(mock_config, servers, notes, counts):
+    notes = notes[:8]
+    note_ids = [f"n{i}" for i in range(len(notes))]
+    packed_extractor = build(mock_config, servers, packing=True)
+    sink = PublishedSink()
+    packed_extractor.fhir_tools.fhir.add_sink(sink)
+
+    packed = await packed_extractor.extract_many(notes, note_ids=note_ids)
+    single = await build(mock_config, servers, packing=False).extract_many(notes)
+
+    # every note gets the resources it has when extracted alone
+    assert counts["packed_extraction"] == 2
+    for packed_result, single_result in zip(packed, single):
+        assert packed_result.resources
+        assert codes(packed_result.resources) == codes(single_result.resources)
+
+    # and they are published with its id
+    for note_id, result in zip(note_ids, packed):
+        published = [resource for owner, resource in sink.published if owner == note_id]
+        assert codes(published) == codes(result.resources)
+    assert counts.get("packing_leaks", 0) == 0
+    assert counts.get("packing_unassigned", 0) == 0
+
+
+async def test_leaks_and_bad_note_tags_are_detected(mock_config, servers, notes, counts):
+    notes = notes[:2]
+    llm_extractor = build(mock_config, servers, packing=True)
+
+    # the model mixes up the note tags of the first three tool calls
+    create = llm_extractor.async_client.chat.completions.create
+
+    async def mislabelled(**kwargs):
+        response = await create(**kwargs)
+        tool_calls = response.choices[0].message.tool_calls
+        for tool_call, note_id in zip(tool_calls, (2, None, 99)):
+            arguments = json.loads(tool_call.function.arguments)
+            assert arguments.pop("note_id") == 1
+            if note_id is not None:
+                arguments["note_id"] = note_id
+            tool_call.function.arguments = json.dumps(arguments)
+        return response
+
+    llm_extractor.async_client.chat.completions.create = mislabelled
+    first, second = await llm_extractor.extract_many(notes)
+
+    # the call tagged with the other note is counted as a leak, but kept
+    alone = build(mock_config, servers, packing=False).extract(notes[1])
+    assert counts["packing_leaks"] == 1
+    assert len(second.resources) == len(alone.resources) + 1
+
+    # calls without a valid note are counted and add no resource
+    assert counts["packing_unassigned"] == 2
+    assert len(first.resources) == len(servers.trace["notes"][notes[0]]) - 3
+
+
+@pytest.mark.parametrize("failure", ["demultiplex", "publish"])
+async def test_notes_are_published_once(mock_config, servers, notes, counts, failure):
+    notes = notes[:3]
+    note_ids = ["a", "b", "c"]
+    llm_extractor = build(mock_config, servers, packing=True)
+    fhir = llm_extractor.fhir_tools.fhir
+    sink = PublishedSink()
+    fhir.add_sink(sink)
+
+    if failure == "demultiplex":
+        # the packed request fails once its resources are built
+        arun_packed = llm_extractor.fhir_tools.arun_packed
+
+        async def failing_arun_packed(*args):
+            await arun_packed(*args)
+            raise RuntimeError("demultiplexing failed")
+
+        llm_extractor.fhir_tools.arun_packed = failing_arun_packed
+    else:
+        # publishing the second note fails
+        apublish = fhir.apublish
+
+        async def failing_apublish(resources, note_id=None):
+            if note_id == "b":
+                raise RuntimeError("sink unavailable")
+            await apublish(resources, note_id)
+
+        fhir.apublish = failing_apublish
+
+    results = await llm_extractor.extract_many(notes, note_ids=note_ids)
+
+    # the fallback extracts the notes of a failed request alone, publishing each once
+    single = await build(mock_config, servers, packing=False).extract_many(notes)
+    assert counts["packed_extraction"] == 1
+    for note_id, result, alone in zip(note_ids, results, single):
+        published = [resource for owner, resource in sink.published if owner == note_id]
+        if failure == "publish" and note_id == "b":
+            assert isinstance(result, RuntimeError)
+            assert published == []
+        else:
+            assert codes(published) == codes(result.resources) == codes(alone.resources)
@@ -0,0 +1,166 @@
+import time
+import asyncio
+import email.utils
+from types import SimpleNamespace
+import openai
+import pytest
+from gpt_fhir.metrics import MetricsHook, PrometheusExporter, metrics
+from gpt_fhir.rateLimiter import RateLimiter, parse_retry_after, retry_after
+
+# stand-ins for the request and responses the errors are raised with
+REQUEST = SimpleNamespace(method="POST", url="https://api.openai.com/v1/chat/completions")
+MESSAGES = [{"role": "user", "content": "note"}]
+RESPONSE = SimpleNamespace(usage=None)
+
+
+def status_error(cls, status, headers=None):
+    """an API status error with the given response headers"""
+    response = SimpleNamespace(status_code=status, headers=headers or {}, request=REQUEST)
+    return cls("error", response=response, body=None)
+
+
+def failing(errors):
+    """create function raising the given errors in turn before succeeding"""
+
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        if errors:
+            raise errors.pop(0)
+        return RESPONSE
+
+    return create, calls
+
+
+class Recorder(MetricsHook):
+    """metrics consumer keeping every event"""
+
+    def __init__(self):
+        self.spans = []
+        self.counts = []
+        self.gauges = []
+
+    def on_span(self, name, seconds, labels):
+        self.spans.append((name, seconds))
+
+    def on_count(self, name, value, labels):
+        self.counts.append((name, value, labels))
+
+    def on_gauge(self, name, value, labels):
+        self.gauges.append((name, value))
+
+
+@pytest.fixture
+def recorder():
+    """events recorded with the instrumentation enabled for one test"""
+
+    recorder = Recorder()
+    exporter = PrometheusExporter()
+    metrics.add_hook(recorder)
+    metrics.add_hook(exporter)
+    metrics.enable(exporter=False)
+    recorder.exporter = exporter
+    yield recorder
+    metrics.remove_hook(recorder)
+    metrics.remove_hook(exporter)
+    metrics.disable()
+
+
+def test_retry_after_parses_seconds_and_http_dates():
+    assert parse_retry_after("2") == 2.0
+    assert parse_retry_after("1m30s") == 90.0
+
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 <= parse_retry_after(date) <= 30
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+    error = status_error(openai.RateLimitError, 429, {"retry-after": date})
+    assert 25 <= retry_after(error) <= 30
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        status_error(openai.InternalServerError, 502, {"retry-after": "0"}),
+        status_error(openai.RateLimitError, 429, {"retry-after": "0"}),
+        openai.APITimeoutError(REQUEST),
+        openai.APIConnectionError(request=REQUEST),
+    ],
+)
+def test_transient_errors_are_retried(error):
+    limiter = RateLimiter(rpm=1000, tpm=100000, max_delay=0.01)
+    create, calls = failing([error, error])
+
+    assert limiter.call(create, model="m", messages=MESSAGES) is RESPONSE
+    assert len(calls) == 3
+    assert limiter.retries == 2
+
+
+def test_server_errors_do_not_pause_other_requests():
+    limiter = RateLimiter(rpm=1000, tpm=100000, max_delay=0.01)
+    create, _ = failing([status_error(openai.InternalServerError, 503, {"retry-after": "0.01"})])
+
+    limiter.call(create, model="m", messages=MESSAGES)
+    assert limiter.paused_until == 0.0
+
+
+def test_client_errors_are_not_retried():
+    limiter = RateLimiter(rpm=1000, tpm=100000, max_delay=0.01)
+    create, calls = failing([status_error(openai.BadRequestError, 400)])
+
+    with pytest.raises(openai.BadRequestError):
+        limiter.call(create, model="m", messages=MESSAGES)
+    assert len(calls) == 1
+
+
+async def test_async_retries_give_up_after_max_retries():
+    limiter = RateLimiter(rpm=1000, tpm=100000, max_retries=2, max_delay=0.01)
+    errors = [openai.APIConnectionError(request=REQUEST) for _ in range(3)]
+    sync_create, calls = failing(errors)
+
+    async def create(**kwargs):
+        return sync_create(**kwargs)
+
+    with pytest.raises(openai.APIConnectionError):
+        await limiter.acall(create, model="m", messages=MESSAGES)
+    assert len(calls) == 3
+
+
+async def test_queue_depth_and_wait_time_are_exported(recorder):
+    # an empty token bucket refilling 10000 tokens per second
+    limiter = RateLimiter(rpm=1000, tpm=600000, completion_tokens=1000)
+    limiter.tokens = 0.0
+
+    async def create(**kwargs):
+        return RESPONSE
+
+    await asyncio.gather(
+        *(limiter.acall(create, model="m", messages=MESSAGES) for _ in range(3))
+    )
+
+    # all requests queued up, and waited about 0.1 s each after the one before
+    depths = [value for name, value in recorder.gauges if name == "rate_limit_queue_depth"]
+    assert max(depths) == 3
+    assert depths[-1] == 0
+    waits = [seconds for name, seconds in recorder.spans if name == "rate_limit_wait"]
+    assert len(waits) == 3
+    assert max(waits) >= 0.25
+
+    stats = limiter.stats()
+    assert stats["queue_depth"] == 0
+    assert stats["admitted"] == 3
+    assert stats["wait_seconds"] == pytest.approx(sum(waits), abs=0.01)
+
+    prometheus = recorder.exporter.render()
+    assert "# TYPE gpt_fhir_rate_limit_queue_depth gauge" in prometheus
+    assert "gpt_fhir_rate_limit_queue_depth 0" in prometheus
+    assert 'gpt_fhir_rate_limit_wait_seconds_bucket{le="+Inf"} 3' in prometheus
+
+
+def test_retries_are_counted_by_error(recorder):
+    limiter = RateLimiter(rpm=1000, tpm=100000, max_delay=0.01)
+    create, _ = failing([status_error(openai.RateLimitError, 429, {"retry-after": "0.01"})])
+    limiter.call(create, model="m", messages=MESSAGES)
+
+    assert ("rate_limit_retries", 1, {"error": "RateLimitError"}) in recorder.counts
@@ -0,0 +1,68 @@
+import logging
+import pytest
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.reranker import Reranker
+
+RERANK = {"FHIR": {"RERANK": {"ENABLED": True}}}
+
+
+def labels(candidates):
+    return [candidate["label"] for candidate in candidates]
+
+
+def annotations(*labels, tags=None):
+    tags = tags or [None] * len(labels)
+    return [
+        {"obo_id": f"SNOMED:{i}", "label": label, "semantic_tag": tag}
+        for i, (label, tag) in enumerate(zip(labels, tags))
+    ]
+
+
+def test_closest_labels_come_first():
+    candidates = [
+        annotations("Lipoatrophic diabetes", "Diabetes mellitus", "Diabetes"),
+        annotations("CLASP shortness of breath score", "Shortness of breath"),
+    ]
+    reranked = Reranker().rerank_many(["Diabetes", "Shortness of breath"], candidates)
+
+    assert labels(reranked[0]) == ["Diabetes", "Diabetes mellitus", "Lipoatrophic diabetes"]
+    assert labels(reranked[1]) == ["Shortness of breath", "CLASP shortness of breath score"]
+
+
+def test_fitting_semantic_tags_win_over_equal_labels():
+    candidates = [annotations("Asthma", "Asthma", tags=["situation", "disorder"])]
+    reranker = Reranker()
+
+    reranked = reranker.rerank_many(["Asthma"], candidates, [["disorder", "finding"]])
+    assert [c["semantic_tag"] for c in reranked[0]] == ["disorder", "situation"]
+
+    # without tags to fit, or without weight, the service rank decides
+    assert reranker.rerank_many(["Asthma"], candidates, [None]) == candidates
+    assert Reranker(tag_weight=0).rerank_many(["Asthma"], candidates, [["disorder"]]) == candidates
+
+
+def test_tags_in_labels_are_split_off():
+    candidates = [annotations("Paracetamol (product)", "Paracetamol (substance)")]
+    reranked = Reranker().rerank_many(["paracetamol"], candidates, [["substance"]])
+
+    assert labels(reranked[0]) == ["Paracetamol (substance)", "Paracetamol (product)"]
+    assert Reranker().tag_fit([0, 0], ["product", None], [["substance"]]).tolist() == [-1.0, 0.0]
+
+
+def test_terms_without_candidates_are_kept():
+    candidates = [[], annotations("Migraine"), []]
+    tags = [None, ["disorder"], None]
+    reranked = Reranker().rerank_many(["a", "Migraine", "b"], candidates, tags)
+
+    assert reranked == [[], annotations("Migraine"), []]
+    assert Reranker().rerank_many(["a"], [[]]) == [[]]
+
+
+def test_tag_weight_is_dropped_for_annotators_without_tags(annotator, caplog):
+    with caplog.at_level(logging.WARNING):
+        fhir = FHIR(annotator, RERANK)
+    assert fhir.reranker.tag_weight == 0
+    assert "no semantic tags" in caplog.text
+
+    annotator.semantic_tags = True
+    assert FHIR(annotator, RERANK).reranker.tag_weight == pytest.approx(0.3)
@@ -0,0 +1,60 @@
+import pytest
+from gpt_fhir.fhir import FHIR
+from baseline_fhir import FHIR as BaselineFHIR
+
+# writer of the original implementation for every tool
+BASELINE_WRITERS = {
+    "extract_fhir_condition": "write_condition",
+    "extract_fhir_procedure": "write_procedure",
+    "extract_fhir_medication_statement": "write_medication_statement",
+}
+
+
+def tool_calls(trace):
+    """all recorded tool calls"""
+    return [call for calls in trace["notes"].values() for call in calls]
+
+
+def test_builders_match_baseline_writers(trace, annotator):
+    # no reranking, so both take the first candidate
+    fhir = FHIR(annotator)
+    baseline = BaselineFHIR(annotator)
+
+    compared = 0
+    for call in tool_calls(trace):
+        # free-text dates ("2 years ago") fail the fhirclient models of the original writers
+        try:
+            getattr(baseline, BASELINE_WRITERS[call["name"]])(call["arguments"])
+        except ValueError:
+            continue
+        fhir.write(call["name"], call["arguments"])
+        compared += 1
+
+    assert compared > 100
+    assert fhir.get_resources() == baseline.get_resources()
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"condition": "Asthma", "clinicalStatus": "active", "onsetAge": 12},
+        {"condition": "Asthma", "clinicalStatus": "active", "bodySite": ["Lung", "Bronchi"]},
+        {
+            "condition": "Asthma",
+            "clinicalStatus": "resolved",
+            "abatementPeriod": {"start": "2020-01-01", "end": "2021-01-01"},
+            "stage": "mild",
+            "note": ["seasonal", "mild"],
+        },
+    ],
+)
+def test_condition_fields_match_baseline(params, annotator):
+    annotator.annotations["asthma"] = [{"obo_id": "SNOMED:195967001", "label": "Asthma"}]
+
+    fhir = FHIR(annotator)
+    baseline = BaselineFHIR(annotator)
+    fhir.write_condition(params)
+    baseline.write_condition(params)
+
+    assert fhir.get_resources() == baseline.get_resources()
+
@@ -0,0 +1,62 @@
+import json
+import datetime
+import pytest
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.fhirTools import FHIRTools
+from gpt_fhir.annotator import Annotator
+from gpt_fhir.llmExtractor import LLMExtractor
+
+
+def build(config, servers):
+    fhir = FHIR(Annotator(base_url=servers.ols_url), config)
+    return LLMExtractor(config, FHIRTools(config, fhir))
+
+
+@pytest.fixture
+def cache_config(mock_config, tmp_path):
+    mock_config["GENAI"]["RESPONSE_CACHE"] = {"PATH": str(tmp_path / "cache")}
+    mock_config["GENAI"]["PROMPT_DATE"] = "2023-12-27"
+    return mock_config
+
+
+def test_same_prompt_date_is_replayed(cache_config, servers, notes):
+    first = build(cache_config, servers).extract(notes[0])
+    second = build(cache_config, servers).extract(notes[0])
+
+    assert not first.cached
+    assert second.cached
+    assert second.resources == first.resources
+
+
+def test_cache_hit_survives_a_change_of_date(cache_config, servers, notes):
+    first = build(cache_config, servers).extract(notes[3])
+    assert "2023-12-27" in json.dumps(first.resources)
+
+    # the entry is replayed the next day, with the dates the model took from the prompt moved
+    cache_config["GENAI"]["PROMPT_DATE"] = "2023-12-28"
+    cache_config["GENAI"]["RESPONSE_CACHE"]["REPLAY_ONLY"] = True
+    second = build(cache_config, servers).extract(notes[3])
+
+    assert second.cached
+    assert json.dumps(second.resources) == json.dumps(first.resources).replace(
+        "2023-12-27", "2023-12-28"
+    )
+
+
+def test_prompt_date_is_kept_out_of_entries(cache_config, servers, notes, tmp_path):
+    build(cache_config, servers).extract(notes[3])
+
+    [entry] = (tmp_path / "cache").glob("*/*.json")
+    assert "2023-12-27" not in entry.read_text()
+    assert "{date}" in entry.read_text()
+
+
+def test_replay_only_misses_raise(cache_config, servers, notes):
+    cache_config["GENAI"]["RESPONSE_CACHE"]["REPLAY_ONLY"] = True
+    with pytest.raises(LookupError):
+        build(cache_config, servers).extract(notes[0])
+
+
+def test_today_is_the_default_prompt_date(mock_config, servers):
+    llm_extractor = build(mock_config, servers)
+    assert datetime.date.today().isoformat() in llm_extractor.system_prompt()
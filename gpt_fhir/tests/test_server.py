@@ -0,0 +1,144 @@
+import time
+import asyncio
+import pytest
+from gpt_fhir.server import ExtractionServer
+from gpt_fhir.metrics import MetricsHook, metrics
+
+
+class CountRecorder(MetricsHook):
+    """metrics consumer summing every counter"""
+
+    def __init__(self):
+        self.counts = {}
+
+    def on_count(self, name, value, labels):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+
+class SlowSink:
+    """sink blocking on every resource"""
+
+    def __init__(self):
+        self.added = []
+
+    def add(self, resource, note_id=None):
+        time.sleep(0.1)
+        self.added.append(note_id)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def counts():
+    """counters recorded while the server runs, which enables the metrics"""
+
+    recorder = CountRecorder()
+    metrics.add_hook(recorder)
+    yield recorder.counts
+    metrics.remove_hook(recorder)
+    metrics.disable()
+
+
+@pytest.fixture
+def server(llm_extractor, mock_config, counts):
+    """server of the extraction stack against the stand-ins"""
+
+    mock_config["SERVER"] = {"QUEUE_SIZE": 4, "MAX_IN_FLIGHT": 1, "BATCH_WINDOW": 0.2}
+    return ExtractionServer(llm_extractor, mock_config)
+
+
+@pytest.fixture
+async def client(server, aiohttp_client):
+    """test client of the server"""
+    return await aiohttp_client(server.app())
+
+
+async def test_extract_returns_the_result_record(client, notes):
+    response = await client.post("/extract", json={"id": "n1", "text": notes[0]})
+    record = await response.json()
+
+    assert response.status == 200
+    assert record["note_id"] == "n1"
+    assert record["tier"] == "llm"
+    assert record["resources"]
+
+
+async def test_falsy_note_ids_are_kept(client, notes):
+    response = await client.post("/extract:batch", json={"notes": [{"id": 0, "text": notes[0]}]})
+    records = await response.json()
+
+    assert response.status == 200
+    assert [record["note_id"] for record in records["results"]] == ["0"]
+
+
+@pytest.mark.parametrize(
+    "body", ["{not json", '{"id": "n1"}', '{"text": "  "}', '{"notes": "text"}']
+)
+async def test_invalid_requests_are_rejected(client, body):
+    for path in ["/extract", "/extract:batch"]:
+        response = await client.post(path, data=body)
+
+        assert response.status == 400
+        assert "error" in await response.json()
+
+
+async def test_concurrent_requests_are_coalesced(client, counts, notes):
+    responses = await asyncio.gather(
+        *[client.post("/extract", json={"text": text}) for text in notes[:4]]
+    )
+
+    assert [response.status for response in responses] == [200] * 4
+    assert counts["server_batches"] == 1
+    assert counts["server_batch_notes"] == 4
+
+
+async def test_requests_beyond_the_queue_are_rejected(client, server, notes):
+    # hold the only batch slot until the queue has filled up
+    started, release = asyncio.Event(), asyncio.Event()
+    extract_many = server.extractor.extract_many
+
+    async def blocked_extract_many(*args, **kwargs):
+        started.set()
+        await release.wait()
+        return await extract_many(*args, **kwargs)
+
+    server.extractor.extract_many = blocked_extract_many
+    running = asyncio.ensure_future(client.post("/extract", json={"text": notes[0]}))
+    await started.wait()
+    queued = asyncio.ensure_future(
+        client.post("/extract:batch", json={"notes": notes[1:5]})
+    )
+    while server.queue.qsize() < 4:
+        await asyncio.sleep(0.01)
+
+    response = await client.post("/extract", json={"text": notes[5]})
+    assert response.status == 429
+    assert response.headers["Retry-After"] == "1"
+
+    release.set()
+    assert (await running).status == 200
+    records = (await (await queued).json())["results"]
+    assert [record.get("error") for record in records] == [None] * 4
+
+
+async def test_publishing_does_not_block_the_server(client, server, notes):
+    sink = SlowSink()
+    server.fhir.add_sink(sink)
+
+    # the loop keeps ticking while the sink blocks
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    ticker = asyncio.create_task(tick())
+    response = await client.post("/extract", json={"id": "n1", "text": notes[0]})
+    ticker.cancel()
+
+    assert response.status == 200
+    assert set(sink.added) == {"n1"}
+    assert ticks >= 10 * len(sink.added)
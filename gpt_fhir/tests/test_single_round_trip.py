@@ -0,0 +1,56 @@
+import json
+import pytest
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.fhirTools import FHIRTools
+from gpt_fhir.annotator import Annotator
+from gpt_fhir.llmExtractor import LLMExtractor
+
+
+def build(config, servers, follow_up):
+    """extraction stack recording the completions it requests"""
+
+    config["GENAI"]["FOLLOW_UP_COMPLETION"] = follow_up
+    fhir = FHIR(Annotator(base_url=servers.ols_url), config)
+    llm_extractor = LLMExtractor(config, FHIRTools(config, fhir))
+
+    create = llm_extractor.client.chat.completions.create
+    llm_extractor.requests = []
+
+    def recording_create(**kwargs):
+        llm_extractor.requests.append(kwargs)
+        return create(**kwargs)
+
+    llm_extractor.client.chat.completions.create = recording_create
+    return llm_extractor
+
+
+@pytest.mark.parametrize("follow_up, completions", [(True, 2), (False, 1)])
+def test_follow_up_completion_is_optional(mock_config, servers, notes, follow_up, completions):
+    llm_extractor = build(mock_config, servers, follow_up)
+    result = llm_extractor.extract(notes[0])
+
+    assert len(llm_extractor.requests) == completions
+    assert "tools" in llm_extractor.requests[0]
+    assert len(result.resources) == len(servers.trace["notes"][notes[0]])
+
+
+def test_result_holds_tool_call_outcomes_and_usage(mock_config, servers, notes):
+    result = build(mock_config, servers, follow_up=False).extract(notes[0])
+
+    recorded = servers.trace["notes"][notes[0]]
+    assert [call["name"] for call in result.tool_calls] == [call["name"] for call in recorded]
+    for call, outcome in zip(recorded, result.tool_calls):
+        assert json.loads(outcome["arguments"]) == call["arguments"]
+        assert outcome["output"]
+    assert result.usage["total_tokens"] > 0
+    assert result.usage["total_tokens"] == (
+        result.usage["prompt_tokens"] + result.usage["completion_tokens"]
+    )
+
+
+def test_follow_up_usage_is_added(mock_config, servers, notes):
+    single = build(mock_config, servers, follow_up=False).extract(notes[0])
+    double = build(mock_config, servers, follow_up=True).extract(notes[0])
+
+    assert double.usage["prompt_tokens"] > single.usage["prompt_tokens"]
+    assert double.resources == single.resources
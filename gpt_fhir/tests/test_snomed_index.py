@@ -0,0 +1,105 @@
+import pytest
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.annotator import OfflineAnnotator
+from gpt_fhir.snomedIndex import SnomedIndex, build_index, read_descriptions
+
+# RF2 description snapshot header
+RF2_COLUMNS = ["id", "effectiveTime", "active", "moduleId", "conceptId", "languageCode"]
+RF2_HEADER = "\t".join(RF2_COLUMNS + ["typeId", "term", "caseSignificanceId"]) + "\n"
+FSN = "900000000000003001"
+SYNONYM = "900000000000013009"
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    """index of a TSV stand-in of a terminology release"""
+
+    source = tmp_path / "terms.tsv"
+    source.write_text(
+        "conceptId\tterm\n"
+        "195967001\tAsthma (disorder)\n"
+        "195967001\tAsthma\n"
+        "233678006\tChildhood asthma (disorder)\n"
+        "387517004\tParacetamol (substance)\n"
+        "387517004\tAcetaminophen\n"
+        "38341003\tHypertensive disorder (disorder)\n"
+        "38341003\tHypertension\n"
+        "38341003\tHigh blood pressure\n"
+    )
+    build_index(str(source), str(tmp_path / "snomed.idx"))
+    return str(tmp_path / "snomed.idx")
+
+
+def test_synonyms_resolve_to_the_fully_specified_name(index_path):
+    annotations = SnomedIndex(index_path).lookup("  ACETAMINOPHEN ")
+
+    assert annotations == [
+        {
+            "iri": "http://snomed.info/id/387517004",
+            "obo_id": "SNOMED:387517004",
+            "label": "Paracetamol",
+            "semantic_tag": "substance",
+        }
+    ]
+
+
+def test_exact_matches_come_before_prefix_matches(index_path):
+    index = SnomedIndex(index_path)
+
+    assert [a["obo_id"] for a in index.lookup("asthma")] == ["SNOMED:195967001"]
+    assert [a["obo_id"] for a in index.lookup("high blood")] == ["SNOMED:38341003"]
+    assert index.lookup("ast", limit=1)[0]["obo_id"] == "SNOMED:195967001"
+    assert index.lookup("zzz") == []
+    assert index.lookup("   ") == []
+
+
+def test_binary_search_finds_every_term(tmp_path):
+    source = tmp_path / "terms.tsv"
+    source.write_text("".join(f"{1000 + i}\tterm {i:04d}\n" for i in range(500)))
+    build_index(str(source), str(tmp_path / "snomed.idx"))
+    index = SnomedIndex(str(tmp_path / "snomed.idx"))
+
+    assert len(index) == 500
+    for i in [0, 1, 249, 250, 498, 499]:
+        assert index.lookup(f"Term {i:04d}") == [
+            {
+                "iri": f"http://snomed.info/id/{1000 + i}",
+                "obo_id": f"SNOMED:{1000 + i}",
+                "label": f"term {i:04d}",
+                "semantic_tag": None,
+            }
+        ]
+    assert index.lookup("term 5000") == []
+
+
+def test_rf2_keeps_active_fsns_and_synonyms(tmp_path):
+    source = tmp_path / "sct2_Description_Snapshot.txt"
+    source.write_text(
+        RF2_HEADER
+        + f"1\t20240101\t1\t0\t22298006\ten\t{FSN}\tMyocardial infarction (disorder)\t0\n"
+        + f"2\t20240101\t1\t0\t22298006\ten\t{SYNONYM}\tHeart attack\t0\n"
+        + f"3\t20240101\t0\t0\t22298006\ten\t{SYNONYM}\tCardiac infarction\t0\n"
+        + f"4\t20240101\t1\t0\t22298006\ten\t900000000000550004\tDefinition\t0\n"
+    )
+
+    assert list(read_descriptions(str(source))) == [
+        (22298006, "Myocardial infarction (disorder)", True),
+        (22298006, "Heart attack", False),
+    ]
+
+
+def test_other_files_are_not_loaded(tmp_path):
+    path = tmp_path / "snomed.idx"
+    path.write_bytes(b"\0" * 64)
+
+    with pytest.raises(ValueError):
+        SnomedIndex(str(path))
+
+
+def test_offline_annotations_feed_the_writers(index_path):
+    fhir = FHIR(OfflineAnnotator(index_path))
+    fhir.write_medication_statement({"medication_statement": "Acetaminophen", "status": "active"})
+
+    coding = fhir.get_resources()[0]["medicationCodeableConcept"]["coding"][0]
+    assert coding["code"] == "387517004"
+    assert coding["display"] == "Paracetamol"
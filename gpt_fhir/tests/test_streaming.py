@@ -0,0 +1,65 @@
+import json
+from types import SimpleNamespace
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.fhirTools import FHIRTools
+from gpt_fhir.annotator import Annotator
+from gpt_fhir.llmExtractor import LLMExtractor, ToolCallAssembler
+
+
+def chunk(index=None, id=None, name=None, arguments=None, content=None):
+    """streamed completion chunk with one tool call delta"""
+
+    tool_calls = None
+    if index is not None:
+        function = SimpleNamespace(name=name, arguments=arguments)
+        tool_calls = [SimpleNamespace(index=index, id=id, function=function)]
+    delta = SimpleNamespace(content=content, tool_calls=tool_calls)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+
+
+def test_tool_calls_complete_as_soon_as_their_arguments_parse():
+    assembler = ToolCallAssembler()
+
+    assert assembler.add(chunk(0, "call_0", "extract_fhir_condition", '{"condition": ')) == []
+    assert assembler.add(chunk(0, arguments='"Asthma {mild}"')) == []
+    assert assembler.add(chunk(1, "call_1", "extract_fhir_procedure", '{"procedure"')) == []
+
+    # the first call is handed out while the second is still generated
+    [(index, tool_call)] = assembler.add(chunk(0, arguments="}"))
+    assert index == 0
+    assert tool_call.id == "call_0"
+    assert json.loads(tool_call.function.arguments) == {"condition": "Asthma {mild}"}
+
+    assert assembler.add(chunk(1, arguments=': "MRI"}')) == [(1, assembler.completed[1])]
+    assert assembler.add(chunk(0, arguments="")) == []
+    assert assembler.finish() == []
+    assert [call.id for call in assembler.message().tool_calls] == ["call_0", "call_1"]
+
+
+def test_unparsable_tool_calls_are_handed_out_at_the_end():
+    assembler = ToolCallAssembler()
+    assembler.add(chunk(content="Extracting"))
+    assembler.add(chunk(0, "call_0", "extract_fhir_condition", '{"condition": "Asthma"'))
+
+    [(index, tool_call)] = assembler.finish()
+    assert index == 0
+    assert tool_call.function.arguments == '{"condition": "Asthma"'
+    assert assembler.message().content == "Extracting"
+
+
+def test_streamed_extraction_matches_unstreamed(mock_config, servers, notes):
+    def build(stream):
+        mock_config["GENAI"]["STREAM"] = stream
+        fhir = FHIR(Annotator(base_url=servers.ols_url), mock_config)
+        return LLMExtractor(mock_config, FHIRTools(mock_config, fhir))
+
+    streamed, unstreamed = build(True), build(False)
+    for note in notes[:5]:
+        result = streamed.extract(note)
+        expected = unstreamed.extract(note)
+
+        assert result.resources == expected.resources
+        assert [c["arguments"] for c in result.tool_calls] == [
+            c["arguments"] for c in expected.tool_calls
+        ]
+        assert result.usage["total_tokens"] > 0
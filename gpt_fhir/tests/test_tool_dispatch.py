@@ -0,0 +1,88 @@
+import json
+import time
+import pytest
+from openai.types.chat import ChatCompletionMessageToolCall
+from gpt_fhir.fhir import FHIR
+from gpt_fhir.fhirTools import FHIRTools
+from gpt_fhir.extractionContext import ExtractionContext
+
+
+class ManyCounter:
+    """annotator wrapper recording the batches it resolves"""
+
+    def __init__(self, annotator):
+        self.annotator = annotator
+        self.ontology = annotator.ontology
+        self.batches = []
+
+    def run(self, text):
+        raise AssertionError(f"{text} was not prefetched")
+
+    def run_many(self, terms, max_concurrency=8):
+        self.batches.append(list(terms))
+        return self.annotator.run_many(terms)
+
+
+def as_tool_calls(calls):
+    return [
+        ChatCompletionMessageToolCall(
+            id=f"call_{i}",
+            type="function",
+            function={"name": call["name"], "arguments": json.dumps(call["arguments"])},
+        )
+        for i, call in enumerate(calls)
+    ]
+
+
+@pytest.fixture
+def tools(config, annotator):
+    """FHIRTools whose tool calls take longer the earlier they come"""
+
+    fhir_tools = FHIRTools(config, FHIR(ManyCounter(annotator), config))
+    run = fhir_tools.run
+
+    def slow_run(tool_call, context=None):
+        time.sleep(0.1 * (4 - int(tool_call.id.split("_")[1])))
+        return run(tool_call, context)
+
+    fhir_tools.run = slow_run
+    return fhir_tools
+
+
+@pytest.fixture
+def tool_calls(trace):
+    """the four tool calls of the recorded pneumonia note"""
+
+    calls = [calls for calls in trace["notes"].values() if len(calls) == 4][0]
+    return as_tool_calls(calls)
+
+
+def check(tools, tool_calls, responses, context, seconds):
+    # the calls overlap (1 s one after another), and their lookups are resolved in one pass
+    assert seconds < 0.7
+    conditions = [json.loads(call.function.arguments)["condition"] for call in tool_calls]
+    assert tools.fhir.annotator.batches == [conditions]
+
+    # responses and resources keep the tool call order
+    alone = ExtractionContext(annotations=context.annotations)
+    assert responses == [
+        tools.fhir.write(call.function.name, json.loads(call.function.arguments), alone)
+        for call in tool_calls
+    ]
+    assert context.resources == alone.resources
+
+
+def test_run_all_dispatches_in_parallel(tools, tool_calls):
+    context = ExtractionContext()
+    start = time.perf_counter()
+    responses = tools.run_all(tool_calls, context)
+
+    check(tools, tool_calls, responses, context, time.perf_counter() - start)
+
+
+async def test_arun_all_dispatches_in_parallel(tools, tool_calls):
+    context = ExtractionContext()
+    start = time.perf_counter()
+    responses = await tools.arun_all(tool_calls, context)
+
+    check(tools, tool_calls, responses, context, time.perf_counter() - start)
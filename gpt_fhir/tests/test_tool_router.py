@@ -0,0 +1,58 @@
+from gpt_fhir.toolRouter import ToolRouter, measure_latency, measure_tokens
+
+
+def names(tools):
+    return {tool["function"]["name"] for tool in tools}
+
+
+def test_routing_keeps_the_tools_of_the_recorded_calls(config, trace):
+    router = ToolRouter(config["GENAI"]["TOOLS"])
+
+    calls = [
+        (note, call["name"]) for note, note_calls in trace["notes"].items() for call in note_calls
+    ]
+    withheld = [(note, name) for note, name in calls if name not in names(router.select(note))]
+
+    # the one call left is a drug the model inferred from a diagnosis the note does not name
+    assert len(withheld) <= 1
+
+
+def test_condition_tool_is_always_sent(config):
+    router = ToolRouter(config["GENAI"]["TOOLS"])
+
+    selected = names(router.select("Mentioned taking Omeprazole for acid reflux regularly."))
+    assert selected == {"extract_fhir_condition", "extract_fhir_medication_statement"}
+
+
+def test_ambiguous_notes_get_all_tools(config):
+    tools = config["GENAI"]["TOOLS"]
+    router = ToolRouter(tools)
+
+    # a drug name without a cue, and a sentence without any cue
+    assert router.select("Patient with a history of seizures, on Levetiracetam.") == tools
+    assert router.select("Came in for a routine check-up. Takes Lisinopril daily.") == tools
+
+
+def test_measure_tokens_reports_withheld_resources(llm_extractor):
+    notes = ["Underwent an appendectomy.", "Takes Metformin 500 mg daily."]
+    results = [
+        [{"resourceType": "Procedure"}, {"resourceType": "Condition"}],
+        [{"resourceType": "MedicationStatement"}, {"resourceType": "Procedure"}],
+    ]
+
+    report = measure_tokens(llm_extractor, notes, results)
+
+    assert report["routed"]["saved"] > 0
+    assert report["routed"]["all_tools"] == 0
+    assert report["routed"]["withheld"] == 1
+    assert report["routed"]["recall"] == 0.75
+
+
+async def test_measure_latency_reports_resources_and_recall(llm_extractor, notes):
+    report = await measure_latency(llm_extractor, notes[:6], max_concurrency=3)
+
+    assert report["baseline"]["resources"] > 0
+    assert report["routed"]["resources_change"] == (
+        report["routed"]["resources"] - report["baseline"]["resources"]
+    )
+    assert 0 <= report["routed"]["recall"] <= 1